@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of Cournal.
+# Copyright (C) 2012 Fabian Henze
+#
+# Cournal is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cournal is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cournal.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import gettext
+import gzip
+import os
+import random
+import shutil
+import sys
+import tempfile
+import tracemalloc
+from array import array
+from time import time
+try:
+    import resource
+except ImportError:
+    # Not available on Windows. Only the RSS is not reported without it.
+    resource = None
+
+import cournal.document.stroke
+from cournal.document import codec, xojparser
+from cournal.document.page import Page
+from cournal.document.stroke import Stroke, find_strokes_near, unpack_coords
+from cournal.loadtest import random_walk
+from cournal.viewer.tools.eraser import THICKNESS
+
+"""
+Micro-benchmarks. Every benchmark runs several times for synthetic documents
+with a given total number of points. The fastest run is reported.
+
+parse -- Parse Xournal files, which are written to a temporary directory
+join -- Decode the pages sent by the server to a client, which joins a
+        document, and add their strokes to the pages of the client
+eraser -- Find the strokes near random points on a single page, like the
+          eraser does, with the spatial index of the page and by testing
+          every stroke
+memory -- Measure the memory used by a document with a given number of
+          strokes. It runs once, as the result does not vary.
+
+Usage: python3 -m cournal.benchmark [-b benchmark [benchmark ...]] [-p points [points ...]] [-s strokes]
+                                    [-r repeat] [--no-numpy]
+"""
+
+BENCHMARKS = ["parse", "join", "eraser", "memory"]
+DEFAULT_POINTS = [1000, 10000, 100000, 1000000]
+DEFAULT_MEMORY_STROKES = 100000
+DEFAULT_REPEAT = 3
+# Shape of the synthetic documents
+POINTS_PER_STROKE = 50
+STROKES_PER_PAGE = 100
+# Every n-th stroke has a width for every point, like strokes drawn with
+# pressure sensitive devices
+VARIABLE_WIDTH_INTERVAL = 3
+COLORS = ["black", "blue", "red", "#3c7d2eff", "#ffff0080"]
+PAGE_SIZE = (612.0, 792.0)
+# Number of eraser positions per run
+ERASER_QUERIES = 100
+
+
+class _BlankPage:
+    """Stands in for a PopplerPage object, as Page only needs its size."""
+    def get_size(self):
+        return PAGE_SIZE
+
+
+def write_xoj(filename, points):
+    """
+    Write a synthetic Xournal file.
+
+    Positional arguments:
+    filename -- Name of the file to write
+    points -- Total number of points of all strokes
+
+    Return value: Number of strokes
+    """
+    strokes = 0
+    with gzip.open(filename, "wt") as file:
+        file.write('<?xml version="1.0" standalone="no"?>\n<xournal version="0.4.5">\n<title>Benchmark</title>\n')
+        while points > 0:
+            file.write('<page width="612.00" height="792.00">\n')
+            if strokes == 0:
+                file.write('<background type="pdf" domain="absolute" filename="benchmark.pdf" pageno="1" />\n')
+            else:
+                file.write('<background type="pdf" pageno="{}" />\n'.format(strokes // STROKES_PER_PAGE + 1))
+            file.write('<layer>\n')
+            for i in range(STROKES_PER_PAGE):
+                if points <= 0:
+                    break
+                length = min(POINTS_PER_STROKE, max(points, 2))
+                coords = " ".join("{:.2f} {:.2f}".format(x, y) for x, y in random_walk(length))
+                width = "1.41"
+                if strokes % VARIABLE_WIDTH_INTERVAL == 0:
+                    width += "".join(" {:.2f}".format(random.uniform(1, 2)) for j in range(length - 1))
+                file.write('<stroke tool="pen" color="{}" width="{}">\n{}\n</stroke>\n'.format(
+                           COLORS[strokes % len(COLORS)], width, coords))
+                points -= length
+                strokes += 1
+            file.write('</layer>\n</page>\n')
+        file.write('</xournal>\n')
+    return strokes
+
+
+def measure(function, repeat):
+    """
+    Returns the shortest duration of several calls of a function in seconds.
+
+    Positional arguments:
+    function -- The function to call without arguments
+    repeat -- Number of calls
+    """
+    durations = []
+    for i in range(repeat):
+        start = time()
+        function()
+        durations.append(time() - start)
+    return min(durations)
+
+
+def random_strokes(points):
+    """
+    Returns a list of synthetic strokes.
+
+    Positional arguments:
+    points -- Total number of points of all strokes
+    """
+    return [Stroke((0, 0, 0, 255), 1.41, coords=random_walk(POINTS_PER_STROKE))
+            for i in range(max(points // POINTS_PER_STROKE, 1))]
+
+
+def benchmark_parse(directory, points, repeat):
+    """
+    Write a synthetic file, parse it and print the results.
+
+    Positional arguments:
+    directory -- Directory for the synthetic file
+    points -- Total number of points of all strokes
+    repeat -- Number of runs of every benchmark
+    """
+    filename = os.path.join(directory, "benchmark-{}.xoj".format(points))
+    strokes = write_xoj(filename, points)
+
+    def parse():
+        for pdfname, page_strokes in xojparser.iterate_pages(filename):
+            pass
+
+    # Coordinates and widths of all strokes, to measure parse_numbers() alone
+    texts = []
+    with gzip.open(filename, "rt") as file:
+        for line in file:
+            if line.startswith("<stroke"):
+                texts.append(line.split('width="')[1].split('"')[0])
+            elif not line.startswith("<"):
+                texts.append(line)
+
+    def parse_numbers():
+        for text in texts:
+            xojparser.parse_numbers(text)
+
+    parse_time = measure(parse, repeat)
+    numbers_time = measure(parse_numbers, repeat)
+    print(_("{:>8} points, {:>6} strokes, {:>8.1f} KiB: parse {:>8.1f} ms ({:>5.2f} M points/s), "
+            "numbers {:>8.1f} ms").format(points, strokes, os.path.getsize(filename) / 1024,
+                                           parse_time * 1000, points / parse_time / 1e6,
+                                           numbers_time * 1000))
+
+
+def benchmark_join(points, repeat):
+    """
+    Encode synthetic pages like the server does, when a user joins a document,
+    and measure how long the client takes to decode them and to add their
+    strokes one by one or all at once.
+
+    Positional arguments:
+    points -- Total number of points of all strokes
+    repeat -- Number of runs of every benchmark
+    """
+    strokes = random_strokes(points)
+    pages = [codec.encode_page(strokes[i:i + STROKES_PER_PAGE]) for i in range(0, len(strokes), STROKES_PER_PAGE)]
+
+    def decode():
+        for data in pages:
+            codec.decode_page(data)
+
+    def add_single():
+        for number, data in enumerate(pages):
+            page = Page(None, _BlankPage(), number)
+            for stroke in codec.decode_page(data):
+                page.new_stroke(stroke)
+
+    def add_bulk():
+        for number, data in enumerate(pages):
+            page = Page(None, _BlankPage(), number)
+            page.add_strokes(codec.decode_page(data))
+
+    decode_time = measure(decode, repeat)
+    single_time = measure(add_single, repeat)
+    bulk_time = measure(add_bulk, repeat)
+    print(_("{:>8} points, {:>6} strokes, {:>8.1f} KiB: decode {:>8.1f} ms, "
+            "join with new_stroke {:>8.1f} ms, with add_strokes {:>8.1f} ms").format(
+          points, len(strokes), sum(len(data) for data in pages) / 1024, decode_time * 1000,
+          single_time * 1000, bulk_time * 1000))
+
+
+def benchmark_eraser(points, repeat):
+    """
+    Put all synthetic strokes on a single page and measure how long it takes
+    to find the strokes near random points with the spatial index of the page
+    and by testing the bounding box of every stroke.
+
+    Positional arguments:
+    points -- Total number of points of all strokes
+    repeat -- Number of runs of every benchmark
+    """
+    page = Page(None, _BlankPage(), 0)
+    page.add_strokes(random_strokes(points))
+    strokes = page.layers[0].strokes
+    queries = [(random.uniform(0, PAGE_SIZE[0]), random.uniform(0, PAGE_SIZE[1])) for i in range(ERASER_QUERIES)]
+
+    def spatial_index():
+        for x, y in queries:
+            list(page.get_strokes_near(x, y, THICKNESS))
+
+    def linear_scan():
+        for x, y in queries:
+            find_strokes_near([stroke for stroke in strokes if stroke.in_bounds(x, y)], x, y, THICKNESS)
+
+    index_time = measure(spatial_index, repeat)
+    linear_time = measure(linear_scan, repeat)
+    print(_("{:>8} points, {:>6} strokes: spatial index {:>7.3f} ms, linear scan {:>7.3f} ms per query").format(
+          points, len(strokes), index_time * 1000 / ERASER_QUERIES, linear_time * 1000 / ERASER_QUERIES))
+
+
+def benchmark_memory(strokes):
+    """
+    Measure the memory used by a synthetic document. The growth of the
+    peak RSS is measured, while the strokes and client pages with their
+    indexes are created. Then tracemalloc measures copies of the Stroke
+    objects, the same strokes as lists of coordinates, as Stroke stored
+    them before, and the pages.
+
+    Positional arguments:
+    strokes -- Number of strokes
+    """
+    def create_pages(document):
+        pages = []
+        for i in range(0, len(document), STROKES_PER_PAGE):
+            page = Page(None, _BlankPage(), len(pages))
+            page.add_strokes(document[i:i + STROKES_PER_PAGE])
+            pages.append(page)
+        return pages
+
+    def traced():
+        return tracemalloc.get_traced_memory()[0]
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource is not None else 0
+    document = random_strokes(strokes * POINTS_PER_STROKE)
+    pages = create_pages(document)
+    if resource is not None:
+        # ru_maxrss is in KiB on Linux
+        rss = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss) / 1024
+    del pages
+
+    tracemalloc.start()
+    start = traced()
+    copies = [Stroke(stroke.color, stroke.linewidth, coords=array("d", stroke.coords),
+                     widths=array("d", stroke.widths) if stroke.widths is not None else None)
+              for stroke in document]
+    packed = traced() - start
+
+    start = traced()
+    lists = [unpack_coords(stroke.coords, stroke.widths) for stroke in document]
+    unpacked = traced() - start
+    del lists
+
+    start = traced()
+    pages = create_pages(copies)
+    indexes = traced() - start
+    tracemalloc.stop()
+
+    points = len(document) * POINTS_PER_STROKE
+    print(_("{:>8} strokes, {:>8} points: Stroke objects {:>7.1f} MiB ({:>5.1f} bytes per point), "
+            "as lists {:>7.1f} MiB ({:>5.1f} bytes per point), pages and indexes {:>7.1f} MiB").format(
+          len(document), points, packed / 2**20, packed / points, unpacked / 2**20, unpacked / points,
+          indexes / 2**20))
+    if resource is not None:
+        print(_("Peak RSS grew by {:.1f} MiB for the strokes and pages").format(rss))
+
+
+class CmdlineParser:
+    """
+    Parse commandline options. Results are available as attributes of this class
+    """
+    def __init__(self):
+        """Constructor. All variables initialized here are public."""
+        self.benchmarks = BENCHMARKS
+        self.points = DEFAULT_POINTS
+        self.strokes = DEFAULT_MEMORY_STROKES
+        self.repeat = DEFAULT_REPEAT
+        self.no_numpy = False
+
+    def parse(self):
+        """
+        Parse commandline options.
+        """
+        parser = argparse.ArgumentParser(description=_("Benchmarks for parsing Xournal files, joining documents, erasing and memory use."),
+                                         epilog=_("e.g.: %(prog)s -b parse -p 1000 100000 -r 5"))
+        parser.add_argument("-b", "--benchmarks", nargs="+", choices=BENCHMARKS, default=self.benchmarks,
+                            help=_("Benchmarks to run (defaults to all)"))
+        parser.add_argument("-p", "--points", nargs="+", type=int, default=self.points,
+                            help=_("Total number of points of the synthetic files"))
+        parser.add_argument("-s", "--strokes", nargs=1, type=int, default=[self.strokes],
+                            help=_("Number of strokes of the document measured by the memory benchmark"))
+        parser.add_argument("-r", "--repeat", nargs=1, type=int, default=[self.repeat],
+                            help=_("Number of runs of every benchmark. The fastest is reported."))
+        parser.add_argument("--no-numpy", action="store_true",
+                            help=_("Parse numbers and find strokes without NumPy, even if it is installed"))
+        args = parser.parse_args()
+
+        self.benchmarks = args.benchmarks
+        self.points = args.points
+        self.strokes = max(args.strokes[0], 1)
+        self.repeat = max(args.repeat[0], 1)
+        self.no_numpy = args.no_numpy
+        return self
+
+
+def main():
+    """Run the benchmarks"""
+    gettext.install("cournal")
+
+    args = CmdlineParser().parse()
+    if args.no_numpy:
+        xojparser.numpy = None
+        cournal.document.stroke.numpy = None
+
+    random.seed(0)
+    directory = tempfile.mkdtemp(prefix="cournal-benchmark-")
+    try:
+        if "parse" in args.benchmarks:
+            print(_("Parsing numbers with {}").format("NumPy" if xojparser.numpy is not None else "Python"))
+            for points in args.points:
+                benchmark_parse(directory, points, args.repeat)
+        if "join" in args.benchmarks:
+            for points in args.points:
+                benchmark_join(points, args.repeat)
+        if "eraser" in args.benchmarks:
+            print(_("Finding strokes with {}").format("NumPy" if cournal.document.stroke.numpy is not None else "Python"))
+            for points in args.points:
+                benchmark_eraser(points, args.repeat)
+        if "memory" in args.benchmarks:
+            benchmark_memory(args.strokes)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
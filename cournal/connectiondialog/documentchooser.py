@@ -86,14 +86,15 @@ def response(self, widget, response_id):
         if response_id == Gtk.ResponseType.ACCEPT:
             documentname = self.doc_name.get_text()
             self.deferred = network.join_document_session(documentname)
-            self.deferred.addCallback(self.joined_document)
+            # If joining failed, we are disconnected and the dialog is closed, too
+            self.deferred.addBoth(self.joined_document)
             self.emit("joining_document", documentname)
         else:
             network.disconnect()
             self.dialog.destroy()
 
     def joined_document(self, _):
-        """Called, when we got the remote document from the server"""
+        """Called, when we got the remote document from the server or joining failed"""
         self.emit("joined_document")
 
     def on_map_event(self, _):
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of Cournal.
+# Copyright (C) 2012 Fabian Henze
+#
+# Cournal is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cournal is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cournal.  If not, see <http://www.gnu.org/licenses/>.
+
+import struct
+import sys
+from array import array
+from itertools import accumulate
+
+"""
+A compact binary encoding of the coordinates of a stroke.
+
+Strokes drawn in Cournal are quantized to multiples of 1/PRECISION pt. Their
+points are encoded as differences to the previous point, which are small
+integers and stored as variable length integers (one or two bytes for most
+points). Coordinates, that are not quantized (e.g. imported from Xournal),
+are stored as raw doubles instead, so that decoding always restores exactly
+the same coordinates. This matters, as strokes are identified by them.
+
+Layout: one byte of flags, the number of points as variable length integer,
+then either the encoded differences of x, y (and width) of every point or the
+raw coordinates followed by the raw widths.
+
+Whole pages are encoded differently, as they are stored by the server and sent
+to clients joining a document: the number of strokes (4 bytes), followed by
+the strokes. Every stroke consists of its color (4 bytes), line width (8
+bytes), flags (1 byte), number of points (4 bytes), followed by the packed
+coordinates (x0, y0, x1, y1, ...) and, if STROKE_WIDTHS is set, the packed
+widths. All numbers are little-endian. Coordinates are stored as 4 byte
+integer multiples of 1/PRECISION pt, if STROKE_QUANTIZED is set, else as 8
+byte floats. Packed arrays are read without decoding every single point.
+"""
+
+# Coordinates are quantized to multiples of 1/PRECISION pt
+PRECISION = 100
+
+FLAG_QUANTIZED = 1
+FLAG_WIDTHS = 2
+
+# Flags of strokes in encoded pages
+STROKE_QUANTIZED = 1
+STROKE_WIDTHS = 2
+
+_count = struct.Struct("<I")
+_stroke_header = struct.Struct("<4BdBI")
+
+
+def quantize(value):
+    """
+    Round a coordinate to the nearest multiple of 1/PRECISION pt. Quantized
+    coordinates are encoded with fewer bytes.
+
+    Positional arguments:
+    value -- The coordinate as float
+    """
+    return round(value * PRECISION) / PRECISION
+
+
+def quantized_integers(values):
+    """
+    Returns the values as list of integer multiples of 1/PRECISION or None,
+    if any of them would not be restored exactly by dividing by PRECISION.
+
+    Positional arguments:
+    values -- Iterable of floats
+    """
+    try:
+        integers = [round(value * PRECISION) for value in values]
+    except (OverflowError, ValueError):
+        # Infinity or NaN
+        return None
+    if [integer / PRECISION for integer in integers] != list(values):
+        return None
+    return integers
+
+
+def encode_coords(coords, widths=None):
+    """
+    Encode the coordinates of a stroke.
+
+    Positional arguments:
+    coords -- Packed coordinates (x0, y0, x1, y1, ...)
+
+    Keyword arguments:
+    widths -- Packed widths of every point or None
+
+    Return value: bytes
+    """
+    flags = 0
+    columns = [coords[0::2], coords[1::2]]
+    if widths is not None:
+        flags |= FLAG_WIDTHS
+        columns.append(widths)
+    columns = [quantized_integers(column) for column in columns]
+
+    data = bytearray()
+    _write_varint(data, len(coords) // 2)
+    if None in columns:
+        raw = array("d", coords)
+        if widths is not None:
+            raw.extend(widths)
+        if sys.byteorder != "little":
+            raw.byteswap()
+        return bytes((flags,)) + bytes(data) + raw.tobytes()
+
+    flags |= FLAG_QUANTIZED
+    # Every point is stored as difference to the previous point
+    deltas = [[column[0]] + [b - a for a, b in zip(column, column[1:])] if column else []
+              for column in columns]
+    for delta in zip(*deltas):
+        for value in delta:
+            # Zigzag encoding maps small negative numbers to small positive numbers
+            value = value << 1 if value >= 0 else (-value << 1) - 1
+            if value < 0x80:
+                data.append(value)
+            else:
+                _write_varint(data, value)
+    return bytes((flags,)) + bytes(data)
+
+
+def decode_coords(data):
+    """
+    Decode coordinates encoded by encode_coords().
+
+    Positional arguments:
+    data -- The encoded bytes
+
+    Return value: tuple of two: (packed coordinates, packed widths or None)
+    """
+    flags = data[0]
+    length, position = _read_varint(data, 1)
+    has_widths = flags & FLAG_WIDTHS
+
+    if not flags & FLAG_QUANTIZED:
+        raw = array("d")
+        raw.frombytes(data[position:position + length * (3 if has_widths else 2) * raw.itemsize])
+        if sys.byteorder != "little":
+            raw.byteswap()
+        if has_widths:
+            return raw[:length * 2], raw[length * 2:]
+        return raw, None
+
+    values = []
+    value = shift = 0
+    for byte in data[position:]:
+        if byte < 0x80:
+            values.append(value | byte << shift)
+            value = shift = 0
+        else:
+            value |= (byte & 0x7f) << shift
+            shift += 7
+    values = [(value >> 1) ^ -(value & 1) for value in values]
+
+    stride = 3 if has_widths else 2
+    coords = array("d", bytes(length * 2 * 8))
+    coords[0::2] = _restore(values[0::stride])
+    coords[1::2] = _restore(values[1::stride])
+    if has_widths:
+        return coords, _restore(values[2::stride])
+    return coords, None
+
+
+def delta_encode(coords, last_point):
+    """
+    Encode packed coordinates as differences to their previous point in
+    multiples of 1/PRECISION pt. Used to send the points of unfinished
+    strokes, while they are drawn.
+
+    Positional arguments:
+    coords -- Packed coordinates (x0, y0, x1, y1, ...)
+    last_point -- The last encoded point as tuple of two integers, use (0, 0)
+                  for the first batch of a stroke
+
+    Return value: tuple of two: (list of integers, new last point)
+    """
+    last_x, last_y = last_point
+    deltas = []
+    for x, y in zip(coords[0::2], coords[1::2]):
+        x, y = round(x * PRECISION), round(y * PRECISION)
+        deltas.append(x - last_x)
+        deltas.append(y - last_y)
+        last_x, last_y = x, y
+    return deltas, (last_x, last_y)
+
+
+def delta_decode(deltas, last_point):
+    """
+    Decode coordinates encoded by delta_encode().
+
+    Positional arguments:
+    deltas -- The list of integers
+    last_point -- The last decoded point, use (0, 0) for the first batch
+
+    Return value: tuple of two: (list of coordinates (x0, y0, x1, ...), new last point)
+    """
+    last_x, last_y = last_point
+    coords = []
+    for dx, dy in zip(deltas[0::2], deltas[1::2]):
+        last_x += dx
+        last_y += dy
+        coords.append(last_x / PRECISION)
+        coords.append(last_y / PRECISION)
+    return coords, (last_x, last_y)
+
+
+def encode_page(strokes):
+    """
+    Encode all strokes of a page.
+
+    Positional arguments:
+    strokes -- List of Stroke objects
+
+    Return value: bytes
+    """
+    parts = [_count.pack(len(strokes))]
+    for stroke in strokes:
+        flags = 0
+        values = stroke.coords
+        if stroke.widths is not None:
+            flags |= STROKE_WIDTHS
+            values = stroke.coords + stroke.widths
+        packed = _pack_quantized(values)
+        if packed is not None:
+            flags |= STROKE_QUANTIZED
+        else:
+            packed = array("d", values)
+        if sys.byteorder != "little":
+            packed.byteswap()
+        parts.append(_stroke_header.pack(*stroke.color, stroke.linewidth, flags, len(stroke.coords) // 2))
+        parts.append(packed.tobytes())
+    return b"".join(parts)
+
+
+def decode_page(data):
+    """
+    Decode the strokes of a page encoded by encode_page().
+
+    Positional arguments:
+    data -- The encoded bytes
+
+    Return value: List of Stroke objects
+    """
+    # Imported here, as cournal.document.stroke imports this module
+    from cournal.document.stroke import Stroke
+
+    count, = _count.unpack_from(data)
+    position = _count.size
+    strokes = []
+    for i in range(count):
+        r, g, b, opacity, linewidth, flags, length = _stroke_header.unpack_from(data, position)
+        position += _stroke_header.size
+        values = array("i" if flags & STROKE_QUANTIZED else "d")
+        if flags & STROKE_WIDTHS:
+            length *= 3
+        else:
+            length *= 2
+        values.frombytes(data[position:position + length * values.itemsize])
+        position += length * values.itemsize
+        if sys.byteorder != "little":
+            values.byteswap()
+        if flags & STROKE_QUANTIZED:
+            values = array("d", [value / PRECISION for value in values])
+
+        widths = None
+        if flags & STROKE_WIDTHS:
+            widths = values[length // 3 * 2:]
+            values = values[:length // 3 * 2]
+        strokes.append(Stroke(color=(r, g, b, opacity), linewidth=linewidth, coords=values, widths=widths))
+    return strokes
+
+
+def _restore(deltas):
+    """Returns an array of values from their differences in 1/PRECISION pt."""
+    return array("d", [value / PRECISION for value in accumulate(deltas)])
+
+
+def _write_varint(data, value):
+    """
+    Append a non-negative integer to a bytearray, 7 bits per byte. The highest
+    bit is set in all bytes but the last one.
+    """
+    while value >= 0x80:
+        data.append(value & 0x7f | 0x80)
+        value >>= 7
+    data.append(value)
+
+
+def _read_varint(data, position):
+    """
+    Read an integer written by _write_varint().
+
+    Return value: tuple of two: (the integer, position after it)
+    """
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+def _pack_quantized(values):
+    """
+    Returns the values as packed array of integer multiples of 1/PRECISION or
+    None, if they can not be stored exactly that way.
+    """
+    integers = quantized_integers(values)
+    if integers is None:
+        return None
+    try:
+        return array("i", integers)
+    except OverflowError:
+        return None
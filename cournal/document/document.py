@@ -21,7 +21,6 @@
 from os.path import abspath
 
 from gi.repository import Poppler, GLib
-import cairo
 
 from cournal.document.page import Page
 from cournal.document import history
@@ -75,41 +74,16 @@ def clear_pages(self):
             for stroke in page.layers[0].strokes[:]:
                 page.delete_stroke(stroke, send_to_network=False)
 
-    def export_pdf(self, filename):
-        """
-        Save the whole document (PDF+annotations) as a PDF file.
-
-        Positional arguments:
-        filename -- filename of the new PDF file.
-        """
-        try:
-            surface = cairo.PDFSurface(filename, 0, 0)
-        except IOError as ex:
-            print(_("Error saving document: {}").format(ex))
-            # FIXME: Move error handler to mainwindow.py and show error message
-            return
-
-        for page in self.pages:
-            surface.set_size(page.width, page.height)
-            context = cairo.Context(surface)
-
-            page.pdf.render_for_printing(context)
-
-            for stroke in page.layers[0].strokes:
-                stroke.draw(context)
-
-            surface.show_page()  # aka "next page"
-
     def save_xoj_file(self, filename):
         """
-        Save the whole document as a .xoj file.
+        Save the whole document as a .xoj file. The file is written stroke by
+        stroke, so the document is never held in memory as one large string.
 
         Positional arguments:
         filename -- filename of the new .xoj file
         """
-        pagenum = 1
         try:
-            f = open_xoj(filename, "wb")
+            f = open_xoj(filename, "wt", encoding="utf-8")
         except IOError as ex:
             print(_("Error saving document: {}").format(ex))
             # FIXME: Move error handler to mainwindow.py and show error message
@@ -117,33 +91,29 @@ def save_xoj_file(self, filename):
 
         # Thanks to Xournal's awesome XML(-not)-parsing, we can't use ElementTree here.
         # In "Xournal World", <t a="a" b="b"> is not the same as <t b="b" a="a"> ...
-
-        r = "<?xml version=\"1.0\" standalone=\"no\"?>\n"
-        r += "<xournal version=\"0.4.6\">\n"
-        r += "<title>Xournal document - see http://math.mit.edu/~auroux/software/xournal/</title>\n"
-
-        for page in self.pages:
-            r += "<page width=\"{}\" height=\"{}\">\n".format(round(page.width, 2), round(page.height, 2))
-            r += "<background type=\"pdf\""
-            if pagenum == 1:
-                r += " domain=\"absolute\" filename=\"{}\"".format(self.pdfname)
-            r += " pageno=\"{}\" />\n".format(pagenum)
-            pagenum += 1
-
-            for layer in page.layers:
-                r += "<layer>\n"
-                for stroke in layer.strokes:
-                    red, g, b, opacity = stroke.color
-                    r += "<stroke tool=\"pen\" color=\"#{:02X}{:02X}{:02X}{:02X}\" width=\"{}\">\n".format(red, g, b, opacity, stroke.linewidth)
-                    first = stroke.coords[0]
-                    for coord in stroke.coords:
-                        r += " {} {}".format(coord[0], coord[1])
-                    if len(stroke.coords) < 2:
-                        r += " {} {}".format(first[0], first[1])
-                    r += "\n</stroke>\n"
-                r += "</layer>\n"
-                r += "</page>\n"
-        r += "</xournal>"
-
-        f.write(bytes(r, "UTF-8"))
-        f.close()
+        with f:
+            f.write("<?xml version=\"1.0\" standalone=\"no\"?>\n")
+            f.write("<xournal version=\"0.4.6\">\n")
+            f.write("<title>Xournal document - see http://math.mit.edu/~auroux/software/xournal/</title>\n")
+
+            for pagenum, page in enumerate(self.pages, 1):
+                f.write("<page width=\"{}\" height=\"{}\">\n".format(round(page.width, 2), round(page.height, 2)))
+                if pagenum == 1:
+                    f.write("<background type=\"pdf\" domain=\"absolute\" filename=\"{}\" pageno=\"1\" />\n"
+                            .format(self.pdfname))
+                else:
+                    f.write("<background type=\"pdf\" pageno=\"{}\" />\n".format(pagenum))
+
+                for layer in page.layers:
+                    f.write("<layer>\n")
+                    for stroke in layer.strokes:
+                        red, g, b, opacity = stroke.color
+                        coords = stroke.coords
+                        # Xournal needs at least two points
+                        if len(coords) < 4:
+                            coords = coords * 2
+                        f.write("<stroke tool=\"pen\" color=\"#{:02X}{:02X}{:02X}{:02X}\" width=\"{}\">\n {}\n</stroke>\n"
+                                .format(red, g, b, opacity, stroke.linewidth, " ".join(map(str, coords))))
+                    f.write("</layer>\n")
+                f.write("</page>\n")
+            f.write("</xournal>")
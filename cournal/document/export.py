@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of Cournal.
+# Copyright (C) 2012 Fabian Henze
+#
+# Cournal is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cournal is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cournal.  If not, see <http://www.gnu.org/licenses/>.
+
+import gettext
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+import cairo
+from twisted.internet import reactor, protocol, threads
+from twisted.python.failure import Failure
+
+import cournal
+from cournal.document import codec
+
+"""
+Export of documents as PDF files in worker processes.
+
+The strokes of all pages are encoded by cournal.document.codec and written to
+a temporary file in a thread, so the user can continue to draw while the
+document is exported. Every page is preceded by its length (4 bytes). Worker
+processes render ranges of pages to separate PDF files, which are
+merged with pdfunite from poppler-utils. Without pdfunite, a single worker
+renders all pages. Every worker prints a line, when it finished a page.
+
+Usage of a worker: python3 -m cournal.document.export pdfname strokes output first last
+"""
+
+# Page ranges are not rendered in parallel, if they would be shorter
+MIN_PAGES_PER_WORKER = 20
+
+_length = struct.Struct("<I")
+
+
+def render_pages(filename, pages, progress=None):
+    """
+    Render pages of a PDF document and their strokes to a new PDF file.
+
+    Positional arguments:
+    filename -- Filename of the new PDF file
+    pages -- Iterable of tuples (PopplerPage object, list of Stroke objects)
+
+    Keyword arguments:
+    progress -- Function, which is called after every page (defaults to None)
+    """
+    surface = cairo.PDFSurface(filename, 0, 0)
+    for pdf, strokes in pages:
+        width, height = pdf.get_size()
+        surface.set_size(width, height)
+        context = cairo.Context(surface)
+
+        pdf.render_for_printing(context)
+
+        for stroke in strokes:
+            stroke.draw(context)
+
+        surface.show_page()  # aka "next page"
+        if progress is not None:
+            progress()
+    surface.finish()
+
+
+def write_snapshot(filename, pages):
+    """
+    Write the strokes of several pages to a file. Called in a thread.
+
+    Positional arguments:
+    filename -- Filename of the new file
+    pages -- List of lists of Stroke objects, one for every page
+    """
+    with open(filename, "wb") as file:
+        for strokes in pages:
+            data = codec.encode_page(strokes)
+            file.write(_length.pack(len(data)))
+            file.write(data)
+
+
+def read_snapshot(filename, first, last):
+    """
+    Read the strokes of a range of pages from a file written by
+    write_snapshot().
+
+    Positional arguments:
+    filename -- Filename of the file
+    first -- Number of the first page to read
+    last -- Number of the page after the last page to read
+
+    Return value: List of lists of Stroke objects
+    """
+    pages = []
+    with open(filename, "rb") as file:
+        for i in range(last):
+            length, = _length.unpack(file.read(_length.size))
+            if i < first:
+                file.seek(length, os.SEEK_CUR)
+            else:
+                pages.append(codec.decode_page(file.read(length)))
+    return pages
+
+
+class PDFExport:
+    """
+    Exports a document in the background.
+    """
+    def __init__(self, document, filename, progress, finished):
+        """
+        Constructor. Call start() to start the export.
+
+        Positional arguments:
+        document -- The Document object to export
+        filename -- Filename of the new PDF file
+        progress -- Function, which is called with the fraction of exported
+                    pages, whenever a page was exported
+        finished -- Function, which is called with None, when the export
+                    succeeded, or with an error message
+        """
+        self.document = document
+        self.filename = filename
+        self.progress = progress
+        self.finished = finished
+        self.directory = None
+        # ProcessProtocol objects of all running processes
+        self.processes = []
+        self.parts = []
+        self.pages_done = 0
+        self.is_merging = False
+        self.is_cancelled = False
+        # Stops the processes, if Cournal quits during the export
+        self.shutdown_trigger = None
+
+    def start(self):
+        """
+        Save a snapshot of the strokes in a thread and start the workers.
+        """
+        self.shutdown_trigger = reactor.addSystemEventTrigger("before", "shutdown", self.cancel)
+        self.directory = tempfile.mkdtemp(prefix="cournal-export-")
+        snapshot = os.path.join(self.directory, "strokes")
+        # Strokes don't change after they were drawn, so copies of the lists
+        # of strokes are enough to encode them, while the user continues
+        pages = [list(page.layers[0].strokes) for page in self.document.pages]
+        d = threads.deferToThread(write_snapshot, snapshot, pages)
+        d.addBoth(self.snapshot_saved, snapshot)
+
+    def snapshot_saved(self, result, snapshot):
+        """
+        Start the workers, when the snapshot of the strokes was saved.
+
+        Positional arguments:
+        result -- None or a Failure, if the snapshot could not be saved
+        snapshot -- Filename of the snapshot
+        """
+        if self.is_cancelled:
+            # The thread may have created the file, while cancel() deleted the
+            # temporary directory
+            shutil.rmtree(os.path.dirname(snapshot), ignore_errors=True)
+            return
+        if isinstance(result, Failure):
+            self.cancel()
+            self.done(result.getErrorMessage())
+            return
+
+        num_of_pages = len(self.document.pages)
+        workers = 1
+        if shutil.which("pdfunite") is not None:
+            workers = max(1, min(os.cpu_count() or 1, num_of_pages // MIN_PAGES_PER_WORKER))
+        for worker in range(workers):
+            first = num_of_pages * worker // workers
+            last = num_of_pages * (worker + 1) // workers
+            part = os.path.join(self.directory, "part-{}.pdf".format(worker))
+            self.parts.append(part)
+            self.spawn([sys.executable, "-m", "cournal.document.export",
+                        self.document.pdfname, snapshot, part, str(first), str(last)])
+
+    def spawn(self, command):
+        """
+        Start a process, which can use this version of cournal.
+
+        Positional arguments:
+        command -- List of the executable and its arguments
+        """
+        environment = dict(os.environ)
+        package_root = os.path.dirname(os.path.dirname(os.path.abspath(cournal.__file__)))
+        environment["PYTHONPATH"] = os.pathsep.join(filter(None, [package_root, environment.get("PYTHONPATH")]))
+
+        process = _ExportProcess(self)
+        self.processes.append(process)
+        reactor.spawnProcess(process, command[0], command, env=environment)
+
+    def page_done(self):
+        """Called, when a worker finished a page."""
+        self.pages_done += 1
+        self.progress(self.pages_done / max(len(self.document.pages), 1))
+
+    def process_ended(self, process, error):
+        """
+        Called, when a process exited. Merges the rendered parts, when all
+        workers succeeded.
+
+        Positional arguments:
+        process -- The _ExportProcess object
+        error -- An error message or None, if the process succeeded
+        """
+        self.processes.remove(process)
+        if self.is_cancelled:
+            return
+        if error is not None:
+            self.cancel()
+            self.done(error)
+            return
+        if len(self.processes) > 0:
+            return
+
+        if len(self.parts) > 1 and not self.is_merging:
+            # process_ended() is called again, when pdfunite exits
+            self.is_merging = True
+            self.spawn(["pdfunite"] + self.parts + [self.filename])
+            return
+        error = None
+        try:
+            if not self.is_merging:
+                shutil.move(self.parts[0], self.filename)
+        except (IOError, OSError) as ex:
+            error = str(ex)
+        self.clean_up()
+        self.done(error)
+
+    def done(self, error):
+        """
+        Report the end of the export.
+
+        Positional arguments:
+        error -- An error message or None, if the export succeeded
+        """
+        if self.shutdown_trigger is not None:
+            reactor.removeSystemEventTrigger(self.shutdown_trigger)
+            self.shutdown_trigger = None
+        self.finished(error)
+
+    def cancel(self):
+        """
+        Stop all processes and delete the temporary files.
+        """
+        if self.shutdown_trigger is not None:
+            reactor.removeSystemEventTrigger(self.shutdown_trigger)
+            self.shutdown_trigger = None
+        self.is_cancelled = True
+        for process in self.processes:
+            process.transport.signalProcess("TERM")
+        if self.is_merging and os.path.exists(self.filename):
+            # Don't leave an incomplete file
+            os.remove(self.filename)
+        self.clean_up()
+
+    def clean_up(self):
+        """Delete the temporary files."""
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+
+class _ExportProcess(protocol.ProcessProtocol):
+    """
+    Receives the progress of a process started by PDFExport.
+    """
+    def __init__(self, export):
+        """
+        Constructor
+
+        Positional arguments:
+        export -- The PDFExport object
+        """
+        self.export = export
+        self.errors = b""
+
+    def outReceived(self, data):
+        """Called with output of the process. Every line is a finished page."""
+        for i in range(data.count(b"\n")):
+            self.export.page_done()
+
+    def errReceived(self, data):
+        """Called with error messages of the process."""
+        self.errors += data
+
+    def processEnded(self, reason):
+        """Called, when the process exited."""
+        error = None
+        if reason.value.exitCode != 0:
+            # The last line of a traceback contains the exception
+            errors = self.errors.decode("utf-8", "replace").strip().splitlines()
+            error = errors[-1] if len(errors) > 0 else str(reason.value)
+        self.export.process_ended(self, error)
+
+
+def main():
+    """Render a range of pages. Run by PDFExport in a worker process."""
+    gettext.install("cournal")
+    from gi.repository import Poppler, GLib
+
+    pdfname, snapshot, filename = sys.argv[1:4]
+    first, last = int(sys.argv[4]), int(sys.argv[5])
+
+    pdf = Poppler.Document.new_from_file(GLib.filename_to_uri(pdfname, None), None)
+    strokes = read_snapshot(snapshot, first, last)
+
+    def page_done():
+        print(flush=True)
+
+    pages = ((pdf.get_page(i), strokes[i - first]) for i in range(first, last))
+    render_pages(filename, pages, page_done)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
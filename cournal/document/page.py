@@ -18,7 +18,9 @@
 # along with Cournal.  If not, see <http://www.gnu.org/licenses/>.
 
 from cournal.document.layer import Layer
-from cournal.document.stroke import Stroke
+from cournal.document.stroke import Stroke, unpack_coords, find_strokes_near
+from cournal.document.strokeindex import StrokeIndex
+from cournal.document.spatialindex import SpatialIndex
 from cournal.network import network
 from cournal.document import history
 
@@ -49,6 +51,12 @@ def __init__(self, document, pdf, number, layers=None):
         self.widget = None
         self.width, self.height = pdf.get_size()
         self.search_marker = None
+        self.stroke_index = StrokeIndex()
+        self.spatial_index = SpatialIndex()
+        for layer in self.layers:
+            for stroke in layer.strokes:
+                self.stroke_index.add(stroke)
+                self.spatial_index.add(stroke)
 
     def new_stroke(self, stroke, send_to_network=False):
         """
@@ -63,13 +71,41 @@ def new_stroke(self, stroke, send_to_network=False):
                            (defaults to False)
         """
         self.layers[0].strokes.append(stroke)
+        self.stroke_index.add(stroke)
         stroke.calculate_bounding_box()
+        self.spatial_index.add(stroke)
         stroke.layer = self.layers[0]
         if self.widget:
             self.widget.draw_remote_stroke(stroke)
         if send_to_network:
             network.new_stroke(self.number, stroke)
 
+    def add_strokes(self, strokes, send_to_network=False):
+        """
+        Add many strokes to this page at once and possibly send them to the
+        server, if connected. Unlike calling new_stroke() for every stroke,
+        the page is redrawn only once and the strokes are sent in a few large
+        messages.
+
+        Positional arguments:
+        strokes -- List of Stroke objects, that will be added to this page
+
+        Keyword arguments:
+        send_to_network -- Set True, to send the strokes to the server
+                           (defaults to False)
+        """
+        layer = self.layers[0]
+        layer.strokes.extend(strokes)
+        for stroke in strokes:
+            self.stroke_index.add(stroke)
+            stroke.calculate_bounding_box()
+            self.spatial_index.add(stroke)
+            stroke.layer = layer
+        if self.widget:
+            self.widget.draw_remote_strokes(strokes)
+        if send_to_network:
+            network.new_strokes(self.number, strokes)
+
     def new_unfinished_stroke(self, color, linewidth):
         """
         Add a new empty stroke, which is not sent to the server, till
@@ -90,7 +126,9 @@ def finish_stroke(self, stroke):
         stroke -- The Stroke object, that was finished
         """
         history.register_draw_stroke(stroke, self)
+        self.stroke_index.add(stroke)
         stroke.calculate_bounding_box()
+        self.spatial_index.add(stroke)
         network.new_stroke(self.number, stroke)
 
     def delete_stroke_with_coords(self, coords):
@@ -100,9 +138,8 @@ def delete_stroke_with_coords(self, coords):
         Positional arguments
         coords -- The list of coordinates
         """
-        for stroke in self.layers[0].strokes[:]:
-            if stroke.coords == coords:
-                self.delete_stroke(stroke, send_to_network=False)
+        for stroke in self.stroke_index.find(coords):
+            self.delete_stroke(stroke, send_to_network=False)
 
     def delete_stroke(self, stroke, send_to_network=False, register_in_history=True):
         """
@@ -118,10 +155,12 @@ def delete_stroke(self, stroke, send_to_network=False, register_in_history=True)
         register_in_history -- Make this command undoable
         """
         self.layers[0].strokes.remove(stroke)
+        self.stroke_index.remove(stroke)
+        self.spatial_index.remove(stroke)
         if self.widget:
             self.widget.delete_remote_stroke(stroke)
         if send_to_network:
-            network.delete_stroke_with_coords(self.number, stroke.coords)
+            network.delete_stroke_with_coords(self.number, unpack_coords(stroke.coords, stroke.widths))
             if register_in_history:
                 history.register_delete_stroke(stroke, self)
 
@@ -136,11 +175,6 @@ def get_strokes_near(self, x, y, radius):
 
         Return value: Generator for a list of all strokes, which are near that point
         """
-        for stroke in self.layers[0].strokes[:]:
-            if stroke.in_bounds(x, y):
-                for coord in stroke.coords:
-                    s_x = coord[0]
-                    s_y = coord[1]
-                    if ((s_x - x) ** 2 + (s_y - y) ** 2) < radius ** 2:
-                        yield stroke
-                        break
+        candidates = [stroke for stroke in self.spatial_index.find_near(x, y, radius) if stroke.in_bounds(x, y)]
+        for stroke in find_strokes_near(candidates, x, y, radius):
+            yield stroke
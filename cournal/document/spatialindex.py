@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of Cournal.
+# Copyright (C) 2012 Fabian Henze
+#
+# Cournal is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cournal is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cournal.  If not, see <http://www.gnu.org/licenses/>.
+
+from itertools import count
+
+CELL_SIZE = 32  # pt
+
+
+class SpatialIndex:
+    """
+    Finds strokes near a point without testing every stroke on a page.
+
+    The page is divided into a grid of square cells. Every stroke is stored in
+    all cells, that its bounding box or its line intersects with.
+    """
+    def __init__(self, cell_size=CELL_SIZE):
+        """
+        Constructor
+
+        Keyword arguments:
+        cell_size -- Width and height of a cell in pt (defaults to CELL_SIZE)
+        """
+        self.cell_size = cell_size
+        # Maps (column, row) to a dict, which is used as an ordered set of strokes
+        self._cells = dict()
+        # Maps strokes to the order, in which they were added. Strokes within
+        # a rectangle are returned in this order, so they can be drawn in it.
+        self._order = dict()
+        self._counter = count()
+
+    def _get_cells(self, x, y, x2, y2):
+        """
+        Returns a list of (column, row) tuples of all cells, which intersect
+        with a rectangle.
+
+        Positional arguments:
+        x, y, x2, y2 -- Corners of the rectangle in pt
+        """
+        size = self.cell_size
+        return [(column, row)
+                for column in range(int(x // size), int(x2 // size) + 1)
+                for row in range(int(y // size), int(y2 // size) + 1)]
+
+    def _get_stroke_cells(self, stroke):
+        """
+        Returns a list of all cells, that the bounding box of a stroke
+        intersects with. Wide strokes reach beyond their bounding box, so it
+        is enlarged by half of their width.
+
+        Positional arguments:
+        stroke -- The Stroke object
+        """
+        if not hasattr(stroke, "bound_min"):
+            stroke.calculate_bounding_box()
+        padding = stroke.get_max_width() / 2
+        return self._get_cells(stroke.bound_min[0] - padding, stroke.bound_min[1] - padding,
+                               stroke.bound_max[0] + padding, stroke.bound_max[1] + padding)
+
+    def add(self, stroke):
+        """
+        Add a stroke to the index.
+
+        Positional arguments:
+        stroke -- The Stroke object. Its coordinates must not change afterwards.
+        """
+        for cell in self._get_stroke_cells(stroke):
+            self._cells.setdefault(cell, dict())[stroke] = None
+        self._order[stroke] = next(self._counter)
+
+    def remove(self, stroke):
+        """
+        Remove a stroke from the index, if it is part of it.
+
+        Positional arguments:
+        stroke -- The Stroke object
+        """
+        self._order.pop(stroke, None)
+        for cell in self._get_stroke_cells(stroke):
+            strokes = self._cells.get(cell)
+            if strokes is None:
+                continue
+            strokes.pop(stroke, None)
+            if len(strokes) == 0:
+                del self._cells[cell]
+
+    def find_near(self, x, y, radius):
+        """
+        Find all strokes, whose bounding box might be within a radius around a
+        point. Use Stroke.is_near() to find out, whether they really are.
+
+        Positional arguments:
+        x, y -- The point in pt
+        radius -- The radius in pt
+
+        Return value: List of Stroke objects
+        """
+        found = dict()
+        for cell in self._get_cells(x - radius, y - radius, x + radius, y + radius):
+            found.update(self._cells.get(cell, {}))
+        return list(found)
+
+    def find_in_rect(self, x, y, x2, y2):
+        """
+        Find all strokes, which might be drawn within a rectangle.
+
+        Positional arguments:
+        x, y, x2, y2 -- Corners of the rectangle in pt
+
+        Return value: List of Stroke objects in the order they were added
+        """
+        found = dict()
+        for cell in self._get_cells(x, y, x2, y2):
+            found.update(self._cells.get(cell, {}))
+        return sorted(found, key=self._order.__getitem__)
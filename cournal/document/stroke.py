@@ -17,19 +17,30 @@
 # You should have received a copy of the GNU General Public License
 # along with Cournal.  If not, see <http://www.gnu.org/licenses/>.
 
+from array import array
+
 import cairo
 from twisted.spread import pb
+try:
+    import numpy
+except ImportError:
+    # NumPy is optional. Without it, hit testing is done in pure Python.
+    numpy = None
+
+from cournal.document.codec import encode_coords, decode_coords
 
 
 class Stroke(pb.Copyable, pb.RemoteCopy):
     """
     A pen stroke on a layer, having a color, a linewidth and a list of coordinates
 
-    If a stroke has variable width, self.coords contains tuples of three,
-    else tuples of two floats.
+    To save memory, the coordinates are not stored as a list of points, but
+    packed into an array of floats: self.coords contains x and y of every point
+    in turn (x0, y0, x1, y1, ...). If a stroke has variable width, self.widths
+    contains the width of every point, else it is None.
     FIXME: don't ignore the variable width
     """
-    def __init__(self, color, linewidth, layer=None, coords=None):
+    def __init__(self, color, linewidth, layer=None, coords=None, widths=None):
         """
         Constructor
 
@@ -39,14 +50,30 @@ def __init__(self, color, linewidth, layer=None, coords=None):
         linewidth -- Line width in pt
 
         Keyword arguments:
-        coords -- A list of coordinates (defaults to [])
+        coords -- Either a packed array of coordinates or a list of coordinates,
+                  where every coordinate is a list of two or three floats
+                  (defaults to [])
+        widths -- Packed array of widths. Only used, if coords is packed.
         """
         self.layer = layer
         self.color = color
         self.linewidth = linewidth
-        self.coords = coords
-        if self.coords is None:
-            self.coords = []
+        if isinstance(coords, array):
+            self.coords = coords
+            self.widths = widths
+        else:
+            self.coords, self.widths = pack_coords(coords or [])
+
+    @property
+    def key(self):
+        """
+        A hash of the coordinates of this stroke, used to look up strokes by their
+        coordinates. It is only calculated once, so the coordinates must not be
+        changed afterwards.
+        """
+        if not hasattr(self, "_key"):
+            self._key = coords_key(self.coords, self.widths)
+        return self._key
 
     def in_bounds(self, x, y):
         """
@@ -63,6 +90,25 @@ def in_bounds(self, x, y):
 
         return self.bound_min[0] <= x <= self.bound_max[0] and self.bound_min[1] <= y <= self.bound_max[1]
 
+    def is_near(self, x, y, radius):
+        """
+        Test if a point is near any line segment of the stroke.
+
+        Positional arguments:
+        x, y -- point
+        radius -- maximum distance in pt
+
+        Returns:
+        true, if the distance between point and stroke is less than radius
+        """
+        coords = self.coords
+        if len(coords) == 2:
+            return (coords[0] - x) ** 2 + (coords[1] - y) ** 2 < radius ** 2
+        for i in range(0, len(coords) - 2, 2):
+            if distance_to_segment_squared(x, y, coords[i], coords[i+1], coords[i+2], coords[i+3]) < radius ** 2:
+                return True
+        return False
+
     def calculate_bounding_box(self, radius=5):
         """
         Calculate the bounding box of the stroke
@@ -70,18 +116,41 @@ def calculate_bounding_box(self, radius=5):
         Keyword arguments:
         radius -- tolerance radius
         """
+        if numpy is not None and len(self.coords) > 0:
+            points = as_points(self.coords)
+            x_min, y_min = points.min(axis=0)
+            x_max, y_max = points.max(axis=0)
+            self.bound_min = [float(x_min) - radius, float(y_min) - radius]
+            self.bound_max = [float(x_max) + radius, float(y_max) + radius]
+            return
+        x_coords = self.coords[0::2]
+        y_coords = self.coords[1::2]
+        self.bound_min = [min(x_coords) - radius, min(y_coords) - radius]
+        self.bound_max = [max(x_coords) + radius, max(y_coords) + radius]
+
+    def get_max_width(self):
+        """Returns the width of the widest part of this stroke in pt."""
+        if self.widths is None or len(self.widths) == 0:
+            return self.linewidth
+        return max(self.linewidth, max(self.widths))
+
+    def get_state_to_save(self):
+        """Returns a subset of self.__dict__, which is to be stored on disk."""
+        return {"color": self.color, "coords": unpack_coords(self.coords, self.widths), "linewidth": self.linewidth}
+
+    def __setstate__(self, state):
+        """
+        Restore state after unpickling. cournal-server 0.2.1 and earlier pickled
+        strokes with a list of coordinates, which is packed here.
 
-        bb_min_x = self.coords[0][0]
-        bb_max_x = self.coords[0][0]
-        bb_min_y = self.coords[0][1]
-        bb_max_y = self.coords[0][1]
-        for coord in self.coords[1:]:
-            bb_min_x = min(bb_min_x, coord[0])
-            bb_min_y = min(bb_min_y, coord[1])
-            bb_max_x = max(bb_max_x, coord[0])
-            bb_max_y = max(bb_max_y, coord[1])
-        self.bound_min = [bb_min_x - radius, bb_min_y - radius]
-        self.bound_max = [bb_max_x + radius, bb_max_y + radius]
+        Positional arguments:
+        state -- The pickled self.__dict__
+        """
+        self.__dict__.update(state)
+        if not isinstance(self.coords, array):
+            self.coords, self.widths = pack_coords(self.coords)
+        elif "widths" not in state:
+            self.widths = None
 
     def getStateToCopy(self):
         """Gather state to send when I am serialized for a peer."""
@@ -89,10 +158,25 @@ def getStateToCopy(self):
         # d would be self.__dict__.copy()
         d = dict()
         d["color"] = self.color
-        d["coords"] = self.coords
+        d["data"] = encode_coords(self.coords, self.widths)
         d["linewidth"] = self.linewidth
         return d
 
+    def setCopyableState(self, state):
+        """
+        Restore state after I was received from a peer.
+
+        Positional arguments:
+        state -- The dict created by getStateToCopy() of the peer. Peers using
+                 protocol version 1 send a list of coordinates instead of
+                 the encoded data.
+        """
+        if "data" in state:
+            coords, widths = decode_coords(state["data"])
+            self.__init__(color=state["color"], linewidth=state["linewidth"], coords=coords, widths=widths)
+        else:
+            self.__init__(color=state["color"], linewidth=state["linewidth"], coords=state["coords"])
+
     def draw(self, context, scaling=1):
         """
         Render this stroke
@@ -112,13 +196,13 @@ def draw(self, context, scaling=1):
         context.set_line_cap(cairo.LINE_CAP_ROUND)
         context.set_line_width(self.linewidth)
 
-        first = self.coords[0]
-        context.move_to(first[0], first[1])
-        if len(self.coords) > 1:
-            for coord in self.coords[1:]:
-                context.line_to(coord[0], coord[1])
+        coords = self.coords
+        context.move_to(coords[0], coords[1])
+        if len(coords) > 2:
+            for x, y in zip(coords[2::2], coords[3::2]):
+                context.line_to(x, y)
         else:
-            context.line_to(first[0], first[1])
+            context.line_to(coords[0], coords[1])
         x, y, x2, y2 = (a * scaling for a in context.stroke_extents())
         context.stroke()
         context.restore()
@@ -126,5 +210,140 @@ def draw(self, context, scaling=1):
         return (x, y, x2, y2)
 
 
+def pack_coords(coords):
+    """
+    Pack a list of coordinates into arrays of floats, as used by Stroke.
+
+    Positional arguments:
+    coords -- A list of coordinates, where every coordinate is a list of
+              two floats (x, y) or three floats (x, y, width)
+
+    Return value: tuple of two: (packed coordinates, packed widths or None)
+    """
+    packed = array("d")
+    widths = None
+    if len(coords) > 0 and len(coords[0]) > 2:
+        widths = array("d", [coord[2] for coord in coords])
+    for coord in coords:
+        packed.append(coord[0])
+        packed.append(coord[1])
+    return packed, widths
+
+
+def unpack_coords(coords, widths=None):
+    """
+    Convert packed coordinates back to a list of coordinates. Used to store
+    strokes on disk and to transfer them over the network.
+
+    Positional arguments:
+    coords -- The packed coordinates of a stroke
+
+    Keyword arguments:
+    widths -- The packed widths of a stroke or None
+
+    Return value: A list of coordinates, where every coordinate is a list of
+                  two floats (x, y) or three floats (x, y, width)
+    """
+    if widths is None:
+        return [[x, y] for x, y in zip(coords[0::2], coords[1::2])]
+    return [[x, y, width] for x, y, width in zip(coords[0::2], coords[1::2], widths)]
+
+
+def distance_to_segment_squared(x, y, x1, y1, x2, y2):
+    """
+    Calculate the squared distance between a point and a line segment.
+
+    Positional arguments:
+    x, y -- The point
+    x1, y1, x2, y2 -- Start and end of the line segment
+
+    Return value: The squared distance
+    """
+    dx, dy = x2 - x1, y2 - y1
+    length_squared = dx * dx + dy * dy
+    if length_squared == 0:
+        t = 0
+    else:
+        # Project the point onto the segment
+        t = max(0, min(1, ((x - x1) * dx + (y - y1) * dy) / length_squared))
+    px, py = x1 + t * dx - x, y1 + t * dy - y
+    return px * px + py * py
+
+
+def as_points(coords):
+    """
+    Returns a NumPy view of packed coordinates with one row (x, y) per point.
+    The coordinates are not copied, so the view must not be kept while the
+    array is extended (like the coordinates of an unfinished stroke).
+
+    Positional arguments:
+    coords -- The packed coordinates of a stroke
+    """
+    return numpy.frombuffer(coords, dtype=numpy.float64).reshape(-1, 2)
+
+
+def find_strokes_near(strokes, x, y, radius):
+    """
+    Find all strokes, which have a line segment near a given point. If NumPy is
+    available, all strokes are tested at once.
+
+    Positional arguments:
+    strokes -- List of Stroke objects to test
+    x, y -- point
+    radius -- maximum distance in pt
+
+    Return value: List of all strokes, which are near the point
+    """
+    strokes = [stroke for stroke in strokes if len(stroke.coords) > 0]
+    if numpy is None or len(strokes) == 0:
+        return [stroke for stroke in strokes if stroke.is_near(x, y, radius)]
+
+    counts = numpy.array([len(stroke.coords) // 2 for stroke in strokes])
+    offsets = numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+    coords = numpy.concatenate([numpy.frombuffer(stroke.coords, dtype=numpy.float64) for stroke in strokes])
+    x_coords, y_coords = coords[0::2], coords[1::2]
+
+    # Every point is the start of a segment to the next point. The last point
+    # of a stroke is a segment of length 0.
+    dx = numpy.zeros_like(x_coords)
+    dy = numpy.zeros_like(y_coords)
+    dx[:-1] = x_coords[1:] - x_coords[:-1]
+    dy[:-1] = y_coords[1:] - y_coords[:-1]
+    last = offsets + counts - 1
+    dx[last] = 0
+    dy[last] = 0
+
+    # Project the point onto every segment
+    px, py = x - x_coords, y - y_coords
+    length_squared = dx * dx + dy * dy
+    length_squared[length_squared == 0] = 1
+    t = (px * dx + py * dy) / length_squared
+    numpy.clip(t, 0, 1, out=t)
+    px -= t * dx
+    py -= t * dy
+    is_near = px * px + py * py < radius ** 2
+
+    near_strokes = numpy.logical_or.reduceat(is_near, offsets)
+    return [stroke for stroke, near in zip(strokes, near_strokes) if near]
+
+
+def coords_key(coords, widths=None):
+    """
+    Calculate the key of the coordinates of a stroke. Strokes with equal
+    coordinates have equal keys.
+
+    Positional arguments:
+    coords -- The packed coordinates of a stroke
+
+    Keyword arguments:
+    widths -- The packed widths of a stroke or None
+
+    Return value: A hashable object
+    """
+    if widths is None:
+        return hash(coords.tobytes())
+    return hash((coords.tobytes(), widths.tobytes()))
+
+
 # Tell Twisted, that this class is allowed to be transmitted over the network.
 pb.setUnjellyableForClass(Stroke, Stroke)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of Cournal.
+# Copyright (C) 2012 Fabian Henze
+#
+# Cournal is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cournal is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cournal.  If not, see <http://www.gnu.org/licenses/>.
+
+from cournal.document.stroke import coords_key, pack_coords
+
+
+class StrokeIndex:
+    """
+    Finds strokes by their coordinates without comparing the coordinates of
+    every stroke on a page. Used by both the client and the server.
+    """
+    def __init__(self):
+        """Constructor"""
+        # Maps Stroke.key to a list of all strokes with that key
+        self._strokes = dict()
+
+    def add(self, stroke):
+        """
+        Add a stroke to the index.
+
+        Positional arguments:
+        stroke -- The Stroke object. Its coordinates must not change afterwards.
+        """
+        self._strokes.setdefault(stroke.key, []).append(stroke)
+
+    def remove(self, stroke):
+        """
+        Remove a stroke from the index, if it is part of it.
+
+        Positional arguments:
+        stroke -- The Stroke object
+        """
+        strokes = self._strokes.get(stroke.key)
+        if strokes is None:
+            return
+        for i in range(len(strokes)):
+            if strokes[i] is stroke:
+                del strokes[i]
+                break
+        if len(strokes) == 0:
+            del self._strokes[stroke.key]
+
+    def find(self, coords):
+        """
+        Find all strokes, which have exactly the same coordinates as given.
+
+        Positional arguments:
+        coords -- The list of coordinates, where every coordinate is a list of
+                  two or three floats
+
+        Return value: List of Stroke objects
+        """
+        coords, widths = pack_coords(coords)
+        strokes = self._strokes.get(coords_key(coords, widths), [])
+        return [stroke for stroke in strokes if stroke.coords == coords and stroke.widths == widths]
@@ -17,18 +17,54 @@
 # You should have received a copy of the GNU General Public License
 # along with xoj2tikz.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import re
-from gzip import open as open_xoj
+import sys
+import warnings
+from array import array
+from functools import lru_cache
+from gzip import GzipFile
 
 import xml.etree.ElementTree as ET
+try:
+    import numpy
+except ImportError:
+    # NumPy is optional. Without it, numbers are parsed in pure Python.
+    numpy = None
 
 from cournal.document.document import Document
 from cournal.document.stroke import Stroke
 
-"""A simplified parser for Xournal files using the ElementTree API."""
-
-
-def new_document(filename, window):
+"""
+A simplified parser for Xournal files using the ElementTree API.
+
+Files are parsed in a single pass with iterparse(). Strokes are created page
+by page and elements are freed as soon as they are parsed, so large files do
+not have to fit into memory as element tree.
+"""
+
+# The predefined colors of Xournal as tuple (r, g, b)
+COLORS = {
+    "black": (0, 0, 0),
+    "blue": (51, 51, 204),
+    "red": (255, 0, 0),
+    "green": (0, 128, 0),
+    "gray": (128, 128, 128),
+    "lightblue": (0, 192, 255),
+    "lightgreen": (0, 255, 0),
+    "magenta": (255, 0, 255),
+    "orange": (255, 128, 0),
+    "yellow": (255, 255, 0),
+    "white": (255, 255, 255),
+}
+# Number of parsed colors, which are remembered
+COLOR_CACHE_SIZE = 256
+
+_color_regex = re.compile(r"#([0-9a-fA-F]{2})([0-9a-fA-F]{2})"
+                          r"([0-9a-fA-F]{2})([0-9a-fA-F]{2})")
+
+
+def new_document(filename, window, progress=None):
     """
     Open a Xournal .xoj file
 
@@ -36,18 +72,30 @@ def new_document(filename, window):
     filename -- The filename of the Xournal document
     window -- A Gtk.Window, which can be used as the parent of MessageDialogs or the like
 
+    Keyword arguments:
+    progress -- Function, which is called with the fraction of the file,
+                that was parsed so far (defaults to None)
+
     Return value: The new Document object
     """
-    with open_xoj(filename, "rb") as input:
-        tree = ET.parse(input)
-    pdfname = _get_background(tree)
-    document = Document(pdfname)
-
-    # We created an empty document with a PDF, now we will import the strokes:
-    return import_into_document(document, filename, window)
+    document = None
+    # Pages, which were parsed before the background PDF was known
+    pending = []
+    for pagenum, (pdfname, strokes) in enumerate(iterate_pages(filename, progress)):
+        if document is None:
+            if pdfname is None:
+                pending.append(strokes)
+                continue
+            document = Document(pdfname)
+            for previous, previous_strokes in enumerate(pending):
+                _add_strokes(document, previous, previous_strokes)
+        _add_strokes(document, pagenum, strokes)
+    if document is None:
+        raise Exception("The xournal document has no PDF background")
+    return document
 
 
-def import_into_document(document, filename, window):
+def import_into_document(document, filename, window, progress=None):
     """
     Parse a Xournal .xoj file and add all strokes to a given document.
 
@@ -59,23 +107,76 @@ def import_into_document(document, filename, window):
     filename -- The filename of the Xournal document
     window -- A Gtk.Window, which can be used as the parent of MessageDialogs or the like
 
+    Keyword arguments:
+    progress -- Function, which is called with the fraction of the file,
+                that was parsed so far (defaults to None)
+
     Return value: The modified Document object, that was given as an argument.
     """
-    with open_xoj(filename, "rb") as input:
-        tree = ET.parse(input)
+    for pagenum, (pdfname, strokes) in enumerate(iterate_pages(filename, progress)):
+        _add_strokes(document, pagenum, strokes)
+    return document
 
-    if tree.getroot().tag != "xournal":
-        raise Exception("Not a xournal document")
 
-    pages = tree.findall("page")
-    for p in range(len(pages)):
+def iterate_pages(filename, progress=None):
+    """
+    Parse a Xournal .xoj file page by page. This is a generator, which yields
+    a tuple (filename of the background PDF or None, list of Stroke objects)
+    for every page.
 
-        # we ignore layers for now. Cournal uses only layer 0
-        strokes = pages[p].findall("layer/stroke")
-        for s in range(len(strokes)):
-            stroke = _parse_stroke(strokes[s], document.pages[p].layers[0])
-            document.pages[p].new_stroke(stroke, send_to_network=True)
-    return document
+    Positional Arguments:
+    filename -- The filename of the Xournal document
+
+    Keyword arguments:
+    progress -- Function, which is called with the fraction of the file,
+                that was parsed so far, after every page (defaults to None)
+    """
+    size = max(os.path.getsize(filename), 1)
+    with open(filename, "rb") as raw, GzipFile(fileobj=raw) as input:
+        root = None
+        pdfname = None
+        strokes = []
+        for event, element in ET.iterparse(input, events=("start", "end")):
+            if event == "start":
+                if root is None:
+                    root = element
+                    if root.tag != "xournal":
+                        raise Exception("Not a xournal document")
+                continue
+
+            # we ignore layers for now. Cournal uses only layer 0
+            if element.tag == "stroke":
+                stroke = _parse_stroke(element, None)
+                if stroke is not None:
+                    strokes.append(stroke)
+                element.clear()
+            elif element.tag == "background":
+                pdfname = element.get("filename")
+            elif element.tag == "page":
+                yield pdfname, strokes
+                pdfname = None
+                strokes = []
+                # Free the page and all its children
+                root.clear()
+                if progress is not None:
+                    progress(raw.tell() / size)
+
+
+def _add_strokes(document, pagenum, strokes):
+    """
+    Add strokes to a page of a document and send them to the server.
+
+    Positional arguments:
+    document -- The Document object
+    pagenum -- Number of the page
+    strokes -- List of Stroke objects
+    """
+    if pagenum >= len(document.pages):
+        if len(strokes) > 0:
+            print("Warning: Ignoring strokes on page {}, which is not in the PDF.".format(pagenum + 1),
+                  file=sys.stderr)
+        return
+    document.pages[pagenum].add_strokes(strokes, send_to_network=True)
 
 
 def _parse_stroke(stroke, layer):
@@ -86,7 +187,7 @@ def _parse_stroke(stroke, layer):
     stroke -- A ElementTree SubElement representing a stroke from a .xoj document
     layer -- A Layer object. NOT from ElementTree
 
-    Return value: A Stroke instance
+    Return value: A Stroke instance or None, if the stroke is ignored
     """
 
     tool = stroke.attrib["tool"]
@@ -95,46 +196,69 @@ def _parse_stroke(stroke, layer):
               file=sys.stderr)
         return
 
-    coordinates = []
-    temp = [float(x) for x in stroke.text.strip().split(' ') if len(x) > 0]
-    widths = [max(0.0, float(x)) for x in stroke.attrib["width"].split(' ')]
-    nominal_width = widths.pop(0)
+    coordinates = parse_numbers(stroke.text)
+    if len(coordinates) < 2:
+        print("Warning: Stroke without coordinates, ignoring.", file=sys.stderr)
+        return
+    widths = parse_numbers(stroke.attrib["width"])
+    if min(widths) < 0:
+        widths = array("d", [max(0.0, x) for x in widths])
+    nominal_width = widths[0]
     if tool == "highlighter":
         color = parse_color(stroke.attrib["color"], default_opacity=128)
     else:
         color = parse_color(stroke.attrib["color"])
 
-    for i in range(0, len(temp), 2):
-        x = temp[i]
-        y = temp[i + 1]
-        if len(widths) > 0:
-            width = widths[int(i / 2) - 1]
-            coordinates.append([x, y, width])
-        else:
-            coordinates.append([x, y])
+    point_widths = None
+    if len(widths) > 1:
+        # Xournal stores a width for every segment. The first point gets the
+        # width of the last segment.
+        num_points = len(coordinates) // 2
+        point_widths = widths[-1:] + widths[1:num_points]
+        if len(point_widths) != num_points:
+            raise Exception("invalid widths")
 
     # If the stroke is just a point, Xournal saves the same coordinates twice
-    if len(coordinates) == 2 and coordinates[0] == coordinates[1]:
-        del coordinates[1]
+    if len(coordinates) == 4 and coordinates[0:2] == coordinates[2:4]:
+        if point_widths is None:
+            del coordinates[2:]
+        elif point_widths[0] == point_widths[1]:
+            del coordinates[2:]
+            del point_widths[1:]
 
-    return Stroke(layer=layer, color=color, linewidth=nominal_width, coords=coordinates)
+    return Stroke(layer=layer, color=color, linewidth=nominal_width, coords=coordinates, widths=point_widths)
 
 
-def _get_background(tree):
+def parse_numbers(text):
     """
-    Returns the background pdf file name of a Xournal document
+    Parse whitespace separated numbers, e.g. the coordinates of a stroke.
 
     Positional arguments:
-    tree -- An ElementTree representation of a .xoj XML tree
+    text -- The string to parse or None
+
+    Return value: Packed array of floats
     """
-    for bg in tree.findall("page/background"):
-        if "filename" in bg.attrib:
-            return bg.attrib["filename"]
+    numbers = array("d")
+    # NumPy returns [-1.0] for strings, which consist of whitespace only
+    if text is None or text.isspace():
+        return numbers
+    if numpy is not None:
+        with warnings.catch_warnings():
+            # Older versions of NumPy only warn about text, which is not a
+            # number, and return the numbers before it
+            warnings.filterwarnings("error", "string or file could not be read to its end", DeprecationWarning)
+            # Converts all numbers in C, without creating a Python object for each
+            numbers.frombytes(numpy.fromstring(text, sep=" ").tobytes())
+    else:
+        numbers.fromlist([float(x) for x in text.split()])
+    return numbers
 
 
+@lru_cache(maxsize=COLOR_CACHE_SIZE)
 def parse_color(code, default_opacity=255):
     """
-    Parse a xournal color name.
+    Parse a xournal color name. Results are cached, as most strokes of a
+    document have one of a few colors.
 
     Positional arguments:
     code -- The color string to parse (mandatory)
@@ -145,44 +269,15 @@ def parse_color(code, default_opacity=255):
 
     Return value: tuple of four: (r, g, b, opacity)
     """
-    opacity = default_opacity
-    regex = re.compile(r"#([0-9a-fA-F]{2})([0-9a-fA-F]{2})"
-                       r"([0-9a-fA-F]{2})([0-9a-fA-F]{2})")
-
-    if code == "black":
-        r, g, b = (0, 0, 0)
-    elif code == "blue":
-        r, g, b = (51, 51, 204)
-    elif code == "red":
-        r, g, b = (255, 0, 0)
-    elif code == "green":
-        r, g, b = (0, 128, 0)
-    elif code == "gray":
-        r, g, b = (128, 128, 128)
-    elif code == "lightblue":
-        r, g, b = (0, 192, 255)
-    elif code == "lightgreen":
-        r, g, b = (0, 255, 0)
-    elif code == "magenta":
-        r, g, b = (255, 0, 255)
-    elif code == "orange":
-        r, g, b = (255, 128, 0)
-    elif code == "yellow":
-        r, g, b = (255, 255, 0)
-    elif code == "white":
-        r, g, b = (255, 255, 255)
-    elif re.match(regex, code):
-        r, g, b, opacity = re.match(regex, code).groups()
-        r = int(r, 16)
-        g = int(g, 16)
-        b = int(b, 16)
-        opacity = int(opacity, 16)
-    else:
+    if code in COLORS:
+        return COLORS[code] + (default_opacity,)
+    match = _color_regex.match(code)
+    if match is None:
         raise Exception("invalid color")
-    return (r, g, b, opacity)
+    return tuple(int(x, 16) for x in match.groups())
 
 
 # For testing purposes:
 if __name__ == "__main__":
-    import sys
-    f = open_xoj(sys.argv[1], "rb")
+    for pagenum, (pdfname, strokes) in enumerate(iterate_pages(sys.argv[1])):
+        print(pagenum + 1, pdfname, len(strokes))
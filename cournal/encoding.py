@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of Cournal.
+# Copyright (C) 2012 Fabian Henze
+#
+# Cournal is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cournal is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cournal.  If not, see <http://www.gnu.org/licenses/>.
+
+from twisted.spread import banana, jelly
+
+"""
+Encoding of remote method arguments, which are sent to many users.
+
+Perspective Broker serializes the arguments of a remote call once for every
+connection. When the server broadcasts a change to all users of a document,
+the arguments are encoded once with encode_arguments() instead and the
+resulting bytes are sent to every user, who decodes them with
+decode_arguments().
+"""
+
+# Version of the network protocol. Clients and servers tell each other their
+# version after logging in and use the lower one.
+# 1 - Strokes are sent as lists of coordinates
+# 2 - Strokes are sent encoded by cournal.document.codec
+# 3 - Pages are sent encoded by cournal.document.codec, when joining
+# 4 - Clients ask the server, which worker process owns a document, before
+#     they join it
+# 5 - Many strokes on one page can be sent at once with new_strokes
+PROTOCOL_VERSION = 5
+# Peers with an older version can not be understood
+MIN_PROTOCOL_VERSION = 2
+
+
+class _Invoker:
+    """
+    Takes the place of a pb.Broker while jellying, so that pb.Copyable objects
+    are serialized the same way as in a remote call.
+    """
+    serializingPerspective = None
+
+
+def encode_arguments(args):
+    """
+    Encode the arguments of a remote method.
+
+    Positional arguments:
+    args -- List of arguments. Must consist of types, which can be sent with
+            Perspective Broker, but not of references.
+
+    Return value: bytes
+    """
+    return banana.encode(jelly.jelly(list(args), invoker=_Invoker()))
+
+
+def decode_arguments(data, broker):
+    """
+    Decode the arguments of a remote method encoded by encode_arguments().
+
+    Positional arguments:
+    data -- The encoded bytes
+    broker -- The pb.Broker, which received the data. Its security options
+              decide, which classes may be unjellied.
+
+    Return value: List of arguments
+    """
+    return jelly.unjelly(banana.decode(data), taster=broker.security, invoker=broker)
@@ -0,0 +1,557 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of Cournal.
+# Copyright (C) 2012 Fabian Henze
+#
+# Cournal is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cournal is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cournal.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import gettext
+import math
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+from time import time
+
+from twisted.internet import reactor, task
+from twisted.internet.defer import DeferredList
+
+import cournal.network
+from cournal.network import _Network
+from cournal.document.codec import quantize
+from cournal.document.stroke import Stroke, unpack_coords
+
+"""
+A load test for Cournal servers. Simulates clients without user interface,
+which join one or more documents and draw and erase strokes like real users.
+Reports percentiles of the time needed to join a document, of the time until
+other clients receive a stroke or deletion and of the ping round trip time.
+
+Usage: python3 -m cournal.loadtest [-c clients] [-w writers] [-t seconds] [hostname port]
+
+If no server is given, a server is started on the loopback interface. With
+--server-workers, it runs documents in several worker processes.
+"""
+
+DEFAULT_CLIENTS = 10
+DEFAULT_WRITERS = 1
+DEFAULT_RATE = 1  # strokes per second and writer
+DEFAULT_ERASE_RATIO = 0.2
+DEFAULT_DURATION = 30  # seconds
+DEFAULT_DOCUMENT = "loadtest"
+DEFAULT_DOCUMENTS = 1
+LOCAL_PORT = 16524
+# Interval in seconds between two points of a simulated stroke
+POINT_INTERVAL = 0.01
+# Interval in seconds between two pings of a client
+PING_INTERVAL = 1
+# Time in seconds to wait for outstanding messages after the test
+RECEIVE_TIMEOUT = 10
+# Number of attempts to connect to a server started by the load test
+CONNECT_ATTEMPTS = 50
+
+
+class LoadTestClient(_Network):
+    """
+    A client without user interface, which records how long operations take.
+    """
+    def __init__(self, results, documentname):
+        """
+        Constructor
+
+        Positional arguments:
+        results -- The LoadTest object, which collects the measurements
+        documentname -- Name of the document to join
+        """
+        super().__init__()
+        self.results = results
+        self.documentname = documentname
+        # Strokes drawn by this client, which are not erased yet
+        self.strokes = []
+        self.current_stroke = None
+        self.join_started = None
+        self.has_joined = False
+
+    def connect(self, hostname, port):
+        """
+        Connect to a server.
+
+        Positional arguments:
+        hostname -- The hostname of the server
+        port -- The port to connect to
+
+        Return value: A deferred, which fires when we are logged in
+        """
+        d = self.login(hostname, port)
+        d.addCallback(self.connected)
+        return d
+
+    def connected(self, perspective):
+        """
+        Called, when the connection succeeded.
+
+        Positional arguments:
+        perspective -- a reference to our user object
+        """
+        self.perspective = perspective
+        self.perspective.notifyOnDisconnect(self.disconnect_event)
+        self.is_connected = True
+        self.is_stalled = False
+
+    def disconnect_event(self, event):
+        """Called, when the client gets disconnected from the server."""
+        self.is_connected = False
+
+    def connection_problems(self):
+        """The load test does not detect stalled connections."""
+        pass
+
+    def join_document_session(self, documentname):
+        """
+        Join a document and measure how long it takes.
+
+        Positional arguments:
+        documentname -- Name of the document
+        """
+        self.join_started = time()
+        return super().join_document_session(documentname)
+
+    def got_server_document(self, server_document, name):
+        """
+        Called, when the server sent a reference to the remote document.
+        All strokes of the document were received before.
+
+        Positional arguments:
+        server_document -- remote reference to the document we are editing
+        name -- Name of the document
+        """
+        super().got_server_document(server_document, name)
+        self.has_joined = True
+        self.results.join_times.append(time() - self.join_started)
+
+    def ping(self):
+        """Measure the round trip time to the server."""
+        if self.is_connected:
+            sent = time()
+            d = self.perspective.callRemote("ping")
+            d.addCallback(self.ping_successful, sent)
+            # Pings, which are not answered when the test ends, fail
+            d.addErrback(lambda reason: None)
+
+    def ping_successful(self, result, sent):
+        """
+        Called, when we receive a ping response from the server.
+
+        Positional arguments:
+        result -- The response
+        sent -- Time the ping was sent
+        """
+        self.results.ping_times.append(time() - sent)
+        if self.results.is_running:
+            reactor.callLater(PING_INTERVAL, self.ping)
+
+    def draw_stroke(self):
+        """
+        Start drawing a stroke. Points are added every POINT_INTERVAL seconds
+        and streamed to the server like the pen tool does.
+        """
+        if self.current_stroke is not None:
+            # Still drawing the last stroke
+            return
+        if len(self.strokes) > 0 and random.random() < self.results.args.erase_ratio:
+            self.erase_stroke()
+            return
+        points = random_walk(random.randint(20, 80))
+        self.current_stroke = Stroke((0, 0, 128, 255), 1.5, coords=[points.pop()])
+        reactor.callLater(POINT_INTERVAL, self.draw_point, points)
+
+    def draw_point(self, points):
+        """
+        Add the next point to the current stroke or finish it.
+
+        Positional arguments:
+        points -- List of the remaining points of the stroke
+        """
+        if len(points) == 0 or not self.results.is_running:
+            stroke, self.current_stroke = self.current_stroke, None
+            self.strokes.append(stroke)
+            self.results.send(self, stroke_id(stroke.coords))
+            self.new_stroke(0, stroke)
+            return
+        self.current_stroke.coords.extend(points.pop())
+        self.stream_stroke(0, self.current_stroke)
+        reactor.callLater(POINT_INTERVAL, self.draw_point, points)
+
+    def erase_stroke(self):
+        """Erase a random stroke, that was drawn by this client."""
+        stroke = self.strokes.pop(random.randrange(len(self.strokes)))
+        self.results.send(self, ("erase",) + stroke_id(stroke.coords))
+        self.delete_stroke_with_coords(0, unpack_coords(stroke.coords, stroke.widths))
+
+    def remote_new_stroke(self, pagenum, stroke):
+        """
+        Called by the server, to inform us about a new stroke
+
+        Positional arguments:
+        pagenum -- On which page shall we add the stroke
+        stroke -- The received Stroke object
+        """
+        self.results.received(self.results.stroke_times, stroke_id(stroke.coords))
+
+    def remote_delete_stroke_with_coords(self, pagenum, coords):
+        """
+        Called by the server, when a remote user deleted a stroke
+
+        Positional arguments:
+        pagenum -- On which page the stroke was deleted
+        coords -- The list of coordinates identifying a stroke
+        """
+        self.results.received(self.results.erase_times, ("erase", coords[0][0], coords[0][1]))
+
+    def remote_page_snapshot(self, pagenum, strokes):
+        """Strokes of previous load tests are not needed."""
+        pass
+
+    def remote_stroke_points(self, user_id, pagenum, color, linewidth, start, deltas):
+        """Unfinished strokes are not shown."""
+        pass
+
+    def remote_end_stroke_stream(self, user_id):
+        """Unfinished strokes are not shown."""
+        pass
+
+
+class LoadTest:
+    """
+    Connects the clients, simulates the users and reports the results.
+    """
+    def __init__(self, args):
+        """
+        Constructor
+
+        Positional arguments:
+        args -- A CmdlineParser object
+        """
+        self.args = args
+        if args.documents == 1:
+            documents = [args.document]
+        else:
+            documents = ["{}-{}".format(args.document, i) for i in range(args.documents)]
+        self.clients = [LoadTestClient(self, documents[i % len(documents)]) for i in range(args.clients)]
+        self.server = None
+        self.autosave_directory = None
+        self.is_running = False
+        self.writers = []
+        # Maps ids of strokes and deletions to the time they were sent
+        self.sent = dict()
+        # Number of strokes and deletions, which other clients should receive
+        self.expected = 0
+        # Measured durations in seconds
+        self.join_times = []
+        # Error messages of clients, which could not join their document
+        self.failed_joins = []
+        self.has_failed = False
+        self.stroke_times = []
+        self.erase_times = []
+        self.ping_times = []
+        self.timeout = None
+
+    def run(self):
+        """Start a local server, if needed, and connect all clients."""
+        if self.args.hostname is None:
+            self.start_server()
+            self.connect_first_client(CONNECT_ATTEMPTS)
+        else:
+            self.connect_clients()
+
+    def start_server(self):
+        """Start a server on the loopback interface."""
+        self.autosave_directory = tempfile.mkdtemp(prefix="cournal-loadtest-")
+        self.args.hostname = "localhost"
+        self.args.port = LOCAL_PORT
+        self.server = subprocess.Popen([sys.executable, "-c",
+                                        "import sys; from cournal.server import server; sys.exit(server.main())",
+                                        "-p", str(LOCAL_PORT), "-s", self.autosave_directory,
+                                        "-w", str(self.args.server_workers)],
+                                       stdout=subprocess.DEVNULL)
+
+    def connect_first_client(self, attempts):
+        """
+        Connect the first client to a server, which is starting up. Its worker
+        processes, if any, must be running, too.
+
+        Positional arguments:
+        attempts -- Number of remaining attempts
+        """
+        def failed(reason):
+            self.clients[0].disconnect()
+            if attempts <= 1:
+                self.failed(reason)
+            else:
+                reactor.callLater(0.1, self.connect_first_client, attempts - 1)
+
+        client = self.clients[0]
+        d = client.connect(self.args.hostname, self.args.port)
+        # The server asks all its workers for the list of documents
+        d.addCallback(lambda x: client.perspective.callRemote("list_documents"))
+        d.addCallbacks(lambda x: self.connect_clients(), failed)
+
+    def connect_clients(self):
+        """Connect all clients, that are not connected and let them join their documents."""
+        d = DeferredList([client.connect(self.args.hostname, self.args.port)
+                          for client in self.clients if not client.is_connected],
+                         fireOnOneErrback=True, consumeErrors=True)
+        d.addCallback(lambda x: DeferredList([self.join(client) for client in self.clients], consumeErrors=True))
+        d.addCallbacks(lambda x: self.start(), self.failed)
+
+    def join(self, client):
+        """
+        Let a client join its document and record, if it fails.
+
+        Positional arguments:
+        client -- The LoadTestClient object
+
+        Return value: A deferred, which fires when the client joined
+        """
+        def join_failed(reason):
+            self.failed_joins.append(reason.getErrorMessage())
+            return reason
+
+        d = client.join_document_session(client.documentname)
+        d.addErrback(join_failed)
+        return d
+
+    def start(self):
+        """Let the writers draw and all clients ping."""
+        joined = [client for client in self.clients if client.has_joined]
+        if len(self.failed_joins) > 0:
+            self.has_failed = True
+            print(_("{} clients could not join: {}").format(len(self.failed_joins), self.failed_joins[0]),
+                  file=sys.stderr)
+        if len(joined) == 0:
+            self.shutdown()
+            return
+        print(_("{} clients joined, running for {} seconds").format(len(joined), self.args.duration))
+        self.is_running = True
+        for client in joined:
+            client.ping()
+        for client in joined[:self.args.writers]:
+            writer = task.LoopingCall(client.draw_stroke)
+            # Don't let all writers draw at the same time
+            writer.start(1 / self.args.rate, now=False)
+            self.writers.append(writer)
+        reactor.callLater(self.args.duration, self.stop)
+
+    def stop(self):
+        """Stop drawing and wait for outstanding messages."""
+        self.is_running = False
+        for writer in self.writers:
+            writer.stop()
+        self.timeout = reactor.callLater(RECEIVE_TIMEOUT, self.finish)
+
+    def send(self, client, id):
+        """
+        Called by a client, which sends a stroke or deletion.
+
+        Positional arguments:
+        client -- The LoadTestClient object
+        id -- The id of the stroke or deletion
+        """
+        self.sent[id] = time()
+        self.expected += len([other for other in self.clients
+                              if other.has_joined and other.documentname == client.documentname]) - 1
+
+    def received(self, times, id):
+        """
+        Called by a client, which received a stroke or deletion.
+
+        Positional arguments:
+        times -- The list to add the measured duration to
+        id -- The id of the stroke or deletion
+        """
+        sent = self.sent.get(id)
+        if sent is None:
+            return
+        times.append(time() - sent)
+        if not self.is_running and self.timeout is not None and self.is_complete():
+            self.timeout.cancel()
+            self.finish()
+
+    def is_complete(self):
+        """Returns True, if all clients received all strokes and deletions."""
+        return len(self.stroke_times) + len(self.erase_times) >= self.expected
+
+    def failed(self, reason):
+        """Called, when a client could not connect or join."""
+        print(_("Load test failed: {}").format(reason.getErrorMessage()), file=sys.stderr)
+        self.has_failed = True
+        self.shutdown()
+
+    def finish(self):
+        """Print the results and stop."""
+        self.timeout = None
+        strokes = len([id for id in self.sent if id[0] != "erase"])
+        print(_("{} clients, {} writers: {} strokes and {} deletions sent, "
+                "{} of {} received").format(len(self.clients), len(self.writers), strokes,
+                                            len(self.sent) - strokes,
+                                            len(self.stroke_times) + len(self.erase_times),
+                                            self.expected))
+        if len(self.failed_joins) > 0:
+            print(_("{} of {} clients could not join").format(len(self.failed_joins), len(self.clients)))
+        if not self.is_complete():
+            self.has_failed = True
+        print(format_percentiles(_("Join time"), self.join_times))
+        print(format_percentiles(_("Stroke latency"), self.stroke_times))
+        print(format_percentiles(_("Deletion latency"), self.erase_times))
+        print(format_percentiles(_("Ping round trip time"), self.ping_times))
+        self.shutdown()
+
+    def shutdown(self):
+        """Disconnect all clients, stop the local server and the reactor."""
+        for client in self.clients:
+            client.disconnect()
+        if self.server is not None:
+            self.server.terminate()
+            self.server.wait()
+            shutil.rmtree(self.autosave_directory, ignore_errors=True)
+        reactor.stop()
+
+
+class CmdlineParser:
+    """
+    Parse commandline options. Results are available as attributes of this class
+    """
+    def __init__(self):
+        """Constructor. All variables initialized here are public."""
+        self.hostname = None
+        self.port = None
+        self.clients = DEFAULT_CLIENTS
+        self.writers = DEFAULT_WRITERS
+        self.rate = DEFAULT_RATE
+        self.erase_ratio = DEFAULT_ERASE_RATIO
+        self.duration = DEFAULT_DURATION
+        self.document = DEFAULT_DOCUMENT
+        self.documents = DEFAULT_DOCUMENTS
+        self.server_workers = 0
+
+    def parse(self):
+        """
+        Parse commandline options.
+        """
+        parser = argparse.ArgumentParser(description=_("Load test for Cournal servers."),
+                                         epilog=_("e.g.: %(prog)s -c 60 -w 2 localhost 6524"))
+        parser.add_argument("hostname", nargs="?",
+                            help=_("Hostname of the server. If omitted, a local server is started."))
+        parser.add_argument("port", nargs="?", type=int,
+                            help=_("Port of the server"))
+        parser.add_argument("-c", "--clients", nargs=1, type=int, default=[self.clients],
+                            help=_("Number of clients to connect"))
+        parser.add_argument("-w", "--writers", nargs=1, type=int, default=[self.writers],
+                            help=_("Number of clients, which draw and erase strokes"))
+        parser.add_argument("-r", "--rate", nargs=1, type=float, default=[self.rate],
+                            help=_("Strokes to draw or erase per second and writer"))
+        parser.add_argument("-e", "--erase-ratio", nargs=1, type=float, default=[self.erase_ratio],
+                            help=_("Fraction of operations, which erase a stroke"))
+        parser.add_argument("-t", "--duration", nargs=1, type=float, default=[self.duration],
+                            help=_("Duration of the test in seconds"))
+        parser.add_argument("-d", "--document", nargs=1, default=[self.document],
+                            help=_("Name of the document to use"))
+        parser.add_argument("-n", "--documents", nargs=1, type=int, default=[self.documents],
+                            help=_("Number of documents. The clients are distributed among them."))
+        parser.add_argument("-W", "--server-workers", nargs=1, type=int, default=[self.server_workers],
+                            help=_("Number of worker processes of the local server"))
+        args = parser.parse_args()
+        if args.hostname is not None and args.port is None:
+            parser.error(_("A port is required, if a hostname is given"))
+
+        self.hostname = args.hostname
+        self.port = args.port
+        self.clients = max(args.clients[0], 2)
+        self.writers = min(max(args.writers[0], 1), self.clients)
+        self.rate = args.rate[0]
+        self.erase_ratio = args.erase_ratio[0]
+        self.duration = args.duration[0]
+        self.document = args.document[0]
+        self.documents = max(args.documents[0], 1)
+        self.server_workers = args.server_workers[0]
+        return self
+
+
+def stroke_id(coords):
+    """
+    Returns the id of a simulated stroke. Strokes start at random positions,
+    so the first point is used as id.
+
+    Positional arguments:
+    coords -- The packed coordinates of the stroke
+    """
+    return (coords[0], coords[1])
+
+
+def random_walk(length):
+    """
+    Returns a list of points, which looks like handwriting.
+
+    Positional arguments:
+    length -- Number of points
+    """
+    x, y = random.uniform(50, 550), random.uniform(50, 750)
+    angle = random.uniform(0, 2 * math.pi)
+    points = []
+    for i in range(length):
+        angle += random.gauss(0, 0.5)
+        x += 2 * math.cos(angle)
+        y += 2 * math.sin(angle)
+        points.append((quantize(x), quantize(y)))
+    points.reverse()
+    return points
+
+
+def format_percentiles(name, values):
+    """
+    Returns a line with the 50th, 90th and 99th percentile and the maximum of
+    a list of durations.
+
+    Positional arguments:
+    name -- Name of the measured values
+    values -- List of durations in seconds
+    """
+    if len(values) == 0:
+        return _("{}: no values").format(name)
+    values = sorted(values)
+
+    def percentile(p):
+        return values[min(int(len(values) * p / 100), len(values) - 1)] * 1000
+
+    return _("{}: p50 {:.1f} ms, p90 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms").format(
+        name, percentile(50), percentile(90), percentile(99), values[-1] * 1000)
+
+
+def main():
+    """Run a load test"""
+    gettext.install("cournal")
+    cournal.network.DEBUGLEVEL = 0
+
+    args = CmdlineParser().parse()
+    loadtest = LoadTest(args)
+    reactor.callWhenRunning(loadtest.run)
+    reactor.run()
+    return 1 if loadtest.has_failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
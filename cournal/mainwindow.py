@@ -28,6 +28,7 @@
 from cournal.viewer.tools import pen
 from cournal.document.document import Document
 from cournal.document import xojparser
+from cournal.document import export
 from cournal.network import network
 from cournal.connectiondialog.connectiondialog import ConnectionDialog
 from cournal.aboutdialog import AboutDialog
@@ -99,6 +100,7 @@ def __init__(self, **args):
         action_pensize_normal = builder.get_object("action_pensize_normal")
         action_pensize_big = builder.get_object("action_pensize_big")
         tool_pen_color = builder.get_object("tool_pen_color")
+        self.actiongroup_always_sensitive = builder.get_object("actiongroup_always_sensitive")
         self.actiongroup_document_specific = builder.get_object("actiongroup_document_specific")
         self.actiongroup_document_specific.set_sensitive(False)
         builder.get_object("tool_pensize_normal").set_active(True)
@@ -154,6 +156,7 @@ def __init__(self, **args):
         self.button_next_page = builder.get_object("btn_next_page")
         self.vadjustment = self.scrolledwindow.get_vadjustment()
         self.vadjustment.connect("value_changed", self.show_page_numbers)
+        self.vadjustment.connect("value_changed", self.prefetch)
         self.statusbar_pagenum_entry.connect("insert-text", self.jump_to_page_control)
         self.statusbar_pagenum_entry.connect("activate", self.jump_to_page)
         self.button_prev_page.connect("clicked", self.jump_to_prev_page)
@@ -300,6 +303,16 @@ def _set_document(self, document):
         if self.overlaybox:
             self.overlaybox.destroy()
 
+    def prefetch(self, vadjustment):
+        """
+        Render the pages, the user is scrolling to, in the background.
+
+        Positional arguments:
+        vadjustment -- vertical adjustment of the scrollbar
+        """
+        if self.layout:
+            self.layout.prefetch(vadjustment, self.hadjustment)
+
     def show_page_numbers(self, curr_vadjustment):
         """
         Show current and absolute page number in the center of the status bar.
@@ -444,10 +457,12 @@ def run_import_xoj_dialog(self, menuitem):
                                         Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL))
         dialog.set_filter(xoj_filter)
 
+        filename = None
         if dialog.run() == Gtk.ResponseType.ACCEPT:
             filename = dialog.get_filename()
-            xojparser.import_into_document(self.document, filename, self)
         dialog.destroy()
+        if filename is not None:
+            self._parse_xoj(xojparser.import_into_document, self.document, filename)
 
     def run_open_xoj_dialog(self, menuitem):
         """
@@ -462,7 +477,8 @@ def run_open_xoj_dialog(self, menuitem):
             network.disconnect()
             filename = dialog.get_filename()
             try:
-                document = xojparser.new_document(filename, self)
+                dialog.hide()
+                document = self._parse_xoj(xojparser.new_document, filename)
             except Exception as ex:
                 import traceback
                 traceback.print_tb(ex.__traceback__)
@@ -473,6 +489,49 @@ def run_open_xoj_dialog(self, menuitem):
             self.last_filename = filename
         dialog.destroy()
 
+    def _parse_xoj(self, function, *args):
+        """
+        Run a function of the xojparser, while showing its progress.
+
+        Positional arguments:
+        function -- xojparser.new_document or xojparser.import_into_document
+        *args -- Arguments passed to the function before the window
+
+        Return value: The return value of the function
+        """
+        window = Gtk.Window(title=_("Importing .xoj file"), transient_for=self, modal=True)
+        window.set_border_width(10)
+        window.set_default_size(300, -1)
+        progressbar = Gtk.ProgressBar()
+        progressbar.set_show_text(True)
+        window.add(progressbar)
+        window.show_all()
+
+        def progress(fraction):
+            progressbar.set_fraction(fraction)
+            # Redraw the progress bar, while the file is parsed
+            while Gtk.events_pending():
+                Gtk.main_iteration()
+
+        # The events handled by progress() must not open, connect or close
+        # anything, until the document is parsed completely
+        document_specific = self.actiongroup_document_specific.get_sensitive()
+        self.actiongroup_always_sensitive.set_sensitive(False)
+        self.actiongroup_document_specific.set_sensitive(False)
+        if self.overlaybox is not None:
+            self.overlaybox.set_sensitive(False)
+        handler = self.connect("delete-event", lambda widget, event: True)
+        window.connect("delete-event", lambda widget, event: True)
+        try:
+            return function(*args, self, progress=progress)
+        finally:
+            self.disconnect(handler)
+            if self.overlaybox is not None:
+                self.overlaybox.set_sensitive(True)
+            self.actiongroup_document_specific.set_sensitive(document_specific)
+            self.actiongroup_always_sensitive.set_sensitive(True)
+            window.destroy()
+
     def save(self, menuitem):
         """
         Save document to the last known filename or ask the user for a location.
@@ -511,10 +570,58 @@ def run_export_pdf_dialog(self, menuitem):
         dialog.set_filter(pdf_filter)
         dialog.set_current_name("annotated_document.pdf")
 
+        filename = None
         if dialog.run() == Gtk.ResponseType.ACCEPT:
             filename = dialog.get_filename()
-            self.document.export_pdf(filename)
         dialog.destroy()
+        if filename is not None:
+            self._export_pdf(filename)
+
+    def _export_pdf(self, filename):
+        """
+        Export the document to a PDF file in the background and show the
+        progress in a dialog, which allows to cancel the export.
+
+        Positional arguments:
+        filename -- Filename of the new PDF file
+        """
+        dialog = Gtk.Dialog(_("Exporting PDF"), self, Gtk.DialogFlags.DESTROY_WITH_PARENT,
+                            (Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL))
+        dialog.set_default_size(300, -1)
+        progressbar = Gtk.ProgressBar()
+        progressbar.set_show_text(True)
+        progressbar.set_margin_left(10)
+        progressbar.set_margin_right(10)
+        progressbar.set_margin_top(10)
+        dialog.get_content_area().pack_start(progressbar, True, True, 0)
+
+        def finished(error):
+            dialog.destroy()
+            if error is None:
+                return
+            print(_("Error exporting document: {}").format(error))
+            message = Gtk.MessageDialog(self,
+                                        Gtk.DialogFlags.MODAL | Gtk.DialogFlags.DESTROY_WITH_PARENT,
+                                        Gtk.MessageType.ERROR,
+                                        Gtk.ButtonsType.OK,
+                                        _("Unable to export the document"))
+            message.format_secondary_text(error)
+            message.set_title(_("Error"))
+            message.connect("response", lambda _, x: message.destroy())
+            message.show()
+
+        def response(widget, response_id):
+            pdf_export.cancel()
+            dialog.destroy()
+
+        pdf_export = export.PDFExport(self.document, filename, progressbar.set_fraction, finished)
+        dialog.connect("response", response)
+        dialog.show_all()
+        try:
+            pdf_export.start()
+        except (IOError, OSError) as ex:
+            pdf_export.cancel()
+            finished(str(ex))
 
     def run_about_dialog(self, menuitem):
         """
@@ -17,12 +17,17 @@
 # You should have received a copy of the GNU General Public License
 # along with Cournal.  If not, see <http://www.gnu.org/licenses/>.
 
+import zlib
 from time import time
 
 from twisted.spread import pb
 from twisted.internet import reactor
 from twisted.cred import credentials
 
+from cournal.document.codec import decode_page, delta_encode, delta_decode
+from cournal.document.stroke import Stroke
+from cournal.encoding import decode_arguments, PROTOCOL_VERSION, MIN_PROTOCOL_VERSION
+
 # 0 - none
 # 1 - minimal
 # 2 - medium
@@ -31,6 +36,13 @@
 
 PING_INTERVAL = 5
 PING_TIMEOUT = 5
+# Interval in seconds, in which new points of an unfinished stroke are sent
+STREAM_INTERVAL = 0.05
+# Changes made within this interval in seconds are sent in a single message
+BATCH_INTERVAL = 0.02
+# Many new strokes, e.g. of an imported file, are sent in messages of at most
+# this many strokes
+UPLOAD_CHUNK_SIZE = 500
 
 USERNAME = "test"
 PASSWORD = "testpw"
@@ -51,8 +63,26 @@ def __init__(self):
         self.window = None
         self.is_connected = False
         self.is_stalled = True
+        self.protocol_version = None
         self.last_data_received = 0
         self.watchdog = None
+        # The local unfinished stroke, which is streamed to the server
+        self.streamed_stroke = None
+        self.stream_pagenum = None
+        self.stream_sent = 0
+        self.stream_last_point = (0, 0)
+        self.stream_flush = None
+        # Unfinished strokes of remote users. Maps user id to a tuple
+        # (page, Stroke object, last point)
+        self.remote_streams = dict()
+        # Received parts of an encoded page, which is not complete yet
+        self.page_data_parts = []
+        # Changes, which are not sent yet, as list of (method, arguments)
+        self.send_queue = []
+        self.send_flush = None
+        # Statistics: number of sent changes and number of messages used for them
+        self.operations_sent = 0
+        self.messages_sent = 0
 
     def set_document(self, document):
         """
@@ -82,12 +112,56 @@ def connect(self, hostname, port):
         """
         if self.document is None:
             return
+        d = self.login(hostname, port)
+        d.addCallbacks(self.connected, self.connection_failed)
+        return d
+
+    def login(self, hostname, port):
+        """
+        Connect to a server, log in and negotiate the protocol version.
+
+        Positional arguments:
+        hostname -- The hostname of the server
+        port -- The port to connect to
+
+        Return value: A deferred, which fires with a reference to our user object
+        """
+        self.hostname = hostname
         self.factory = pb.PBClientFactory()
         reactor.connectTCP(hostname, port, self.factory)
 
         d = self.factory.login(credentials.UsernamePassword(USERNAME.encode(), PASSWORD.encode()),
                                client=self)
-        d.addCallbacks(self.connected, self.connection_failed)
+        d.addCallback(self.negotiate_protocol)
+        return d
+
+    def negotiate_protocol(self, perspective):
+        """
+        Tell the server, which version of the network protocol we understand,
+        and check whether we understand the server.
+
+        Positional arguments:
+        perspective -- a reference to our user object
+
+        Return value: A deferred, which fires with the perspective, if the
+                      server is compatible
+        """
+        def check_version(version):
+            self.protocol_version = min(version, PROTOCOL_VERSION)
+            if self.protocol_version < MIN_PROTOCOL_VERSION:
+                perspective.broker.transport.loseConnection()
+                raise pb.Error(_("The server is too old for this version of Cournal."))
+            return perspective
+
+        def no_negotiation(reason):
+            # Servers with protocol version 1 do not negotiate. They raise an
+            # AttributeError, as they don't know perspective_negotiate_protocol.
+            if reason.check(pb.NoSuchMethod, AttributeError) is None:
+                return reason
+            return check_version(1)
+
+        d = perspective.callRemote("negotiate_protocol", PROTOCOL_VERSION)
+        d.addCallbacks(check_version, no_negotiation)
         return d
 
     def connected(self, perspective):
@@ -132,6 +206,8 @@ def disconnect(self, _=None):
     def disconnect_event(self, event):
         """Called, when the client gets disconnected from the server."""
         self.is_connected = False
+        self.send_queue = []
+        self.page_data_parts = []
         self.connection_problems()
         if self.window:
             self.window.disconnect_event()
@@ -167,10 +243,58 @@ def join_document_session(self, documentname):
 
         Return value: A deferred, which fires when we got a reference to the document
         """
-        d = self.perspective.callRemote("join_document", documentname)
-        d.addCallbacks(self.got_server_document, self.disconnect, callbackArgs=[documentname])
+        if self.protocol_version < 4:
+            d = self.perspective.callRemote("join_document", documentname)
+        else:
+            # The document might be owned by another process of the server
+            d = self.perspective.callRemote("locate_document", documentname)
+            d.addCallback(self.document_located, documentname)
+        d.addCallbacks(self.got_server_document, self.join_failed, callbackArgs=[documentname])
+        return d
+
+    def join_failed(self, reason):
+        """
+        Called, when joining a document failed. Disconnects from the server.
+
+        Positional arguments:
+        reason -- The Failure object, which is passed on
+        """
+        self.disconnect()
+        return reason
+
+    def document_located(self, port, documentname):
+        """
+        Called, when the server told us, which of its processes owns the
+        document we want to join. Connect to it, if it is not the one we are
+        connected to.
+
+        Positional arguments:
+        port -- Port of the process owning the document or None
+        documentname -- Name of the document
+
+        Return value: A deferred, which fires with a reference to the document
+        """
+        if port is None:
+            return self.perspective.callRemote("join_document", documentname)
+        debug(2, _("Document {} is on port {}").format(documentname, port))
+        d = self.login(self.hostname, port)
+        d.addCallback(self.switch_server)
+        d.addCallback(lambda x: self.perspective.callRemote("join_document", documentname))
         return d
 
+    def switch_server(self, perspective):
+        """
+        Replace the connection to the server by a connection to one of its
+        worker processes, without informing the user.
+
+        Positional arguments:
+        perspective -- a reference to our user object on the worker
+        """
+        self.perspective.dontNotifyOnDisconnect(self.disconnect_event)
+        self.perspective.broker.transport.loseConnection()
+        self.perspective = perspective
+        self.perspective.notifyOnDisconnect(self.disconnect_event)
+
     def got_server_document(self, server_document, name):
         """
         Called, when the server sent a reference to the remote document we requested
@@ -183,6 +307,21 @@ def got_server_document(self, server_document, name):
         debug(2, _("Started editing {}").format(name))
         self.server_document = server_document
 
+    def remote_encoded_call(self, method, data):
+        """
+        Called by the server to call one of our remote methods with arguments,
+        which were encoded once for all users of a document.
+
+        Positional arguments:
+        method -- Name of the remote method without the "remote_" prefix
+        data -- The encoded arguments
+        """
+        function = getattr(self, "remote_" + method, None)
+        if function is None:
+            debug(1, _("Server called unknown method: {}").format(method))
+            return
+        function(*decode_arguments(data, self.perspective.broker))
+
     def remote_new_stroke(self, pagenum, stroke):
         """
         Called by the server, to inform us about a new stroke
@@ -195,6 +334,53 @@ def remote_new_stroke(self, pagenum, stroke):
         if self.document and pagenum < len(self.document.pages):
             self.document.pages[pagenum].new_stroke(stroke)
 
+    def remote_page_snapshot(self, pagenum, strokes):
+        """
+        Called by the server after we joined a document, to send us the strokes
+        that already exist on a page. Large pages are split into several calls.
+
+        Positional arguments:
+        pagenum -- On which page shall we add the strokes
+        strokes -- A list of received Stroke objects
+        """
+        self.data_received()
+        if self.document and pagenum < len(self.document.pages):
+            self.document.pages[pagenum].add_strokes(strokes)
+
+    def remote_new_strokes(self, pagenum, strokes):
+        """
+        Called by the server, when a remote user added many strokes at once.
+
+        Positional arguments:
+        pagenum -- On which page shall we add the strokes
+        strokes -- A list of received Stroke objects
+        """
+        self.data_received()
+        if self.document and pagenum < len(self.document.pages):
+            self.document.pages[pagenum].add_strokes(strokes)
+
+    def remote_page_data(self, pagenum, data, compressed, is_last):
+        """
+        Called by the server after we joined a document, to send us the encoded
+        strokes of a page. Large pages are split into several calls.
+
+        Positional arguments:
+        pagenum -- On which page shall we add the strokes
+        data -- A part of the strokes encoded by
+                cournal.document.codec.encode_page()
+        compressed -- True, if the data is compressed with zlib
+        is_last -- True, if this is the last part of the page
+        """
+        self.page_data_parts.append(data)
+        if not is_last:
+            self.data_received()
+            return
+        data = b"".join(self.page_data_parts)
+        self.page_data_parts = []
+        if compressed:
+            data = zlib.decompress(data)
+        self.remote_page_snapshot(pagenum, decode_page(data))
+
     def new_stroke(self, pagenum, stroke):
         """
         Called by local code to send a new stroke to the server
@@ -203,9 +389,127 @@ def new_stroke(self, pagenum, stroke):
         pagenum -- On which page the stroke was added
         stroke -- The Stroke object to send
         """
-        if self.is_connected:
-            d = self.server_document.callRemote("new_stroke", pagenum, stroke)
+        if stroke is self.streamed_stroke:
+            self.end_stroke_stream()
+        self.queue_call("new_stroke", pagenum, stroke)
+
+    def new_strokes(self, pagenum, strokes):
+        """
+        Called by local code to send many new strokes to the server, e.g. when
+        a file was imported. The strokes are sent in chunks of at most
+        UPLOAD_CHUNK_SIZE strokes.
+
+        Positional arguments:
+        pagenum -- On which page the strokes were added
+        strokes -- List of Stroke objects to send
+        """
+        if not self.is_connected:
+            return
+        if self.protocol_version < 5:
+            for stroke in strokes:
+                self.queue_call("new_stroke", pagenum, stroke)
+            return
+        # Send queued changes first, so the server applies all changes in order
+        if self.send_flush is not None:
+            self.send_flush.cancel()
+            self.flush_send_queue()
+        for start in range(0, len(strokes), UPLOAD_CHUNK_SIZE):
+            chunk = strokes[start:start + UPLOAD_CHUNK_SIZE]
+            d = self.server_document.callRemote("new_strokes", pagenum, chunk)
             d.addCallbacks(lambda x: self.data_received(), self.disconnect)
+            self.operations_sent += len(chunk)
+            self.messages_sent += 1
+
+    def stream_stroke(self, pagenum, stroke):
+        """
+        Called by local code, while a stroke is drawn. The new points of the
+        stroke are sent to the server in batches, so other users can watch the
+        stroke being drawn. Call new_stroke(), when the stroke is finished.
+
+        Positional arguments:
+        pagenum -- On which page the stroke is drawn
+        stroke -- The unfinished Stroke object
+        """
+        if not self.is_connected:
+            return
+        if stroke is not self.streamed_stroke:
+            self.end_stroke_stream()
+            self.streamed_stroke = stroke
+            self.stream_pagenum = pagenum
+            self.stream_sent = 0
+            self.stream_last_point = (0, 0)
+        if self.stream_flush is None:
+            self.stream_flush = reactor.callLater(STREAM_INTERVAL, self.flush_stroke_stream)
+
+    def flush_stroke_stream(self):
+        """
+        Send all points of the streamed stroke, which were not sent yet.
+        """
+        self.stream_flush = None
+        stroke = self.streamed_stroke
+        if stroke is None or not self.is_connected:
+            return
+        coords = stroke.coords[self.stream_sent * 2:]
+        if len(coords) == 0:
+            return
+        deltas, self.stream_last_point = delta_encode(coords, self.stream_last_point)
+        self.queue_call("stroke_points", self.stream_pagenum, stroke.color, stroke.linewidth,
+                        self.stream_sent, deltas)
+        self.stream_sent += len(coords) // 2
+
+    def end_stroke_stream(self):
+        """
+        Stop streaming the current stroke.
+        """
+        if self.stream_flush is not None:
+            self.stream_flush.cancel()
+            self.stream_flush = None
+        self.streamed_stroke = None
+
+    def remote_stroke_points(self, user_id, pagenum, color, linewidth, start, deltas):
+        """
+        Called by the server, when a remote user is drawing a stroke. Show the
+        new points of the unfinished stroke.
+
+        Positional arguments:
+        user_id -- Id of the user, who draws the stroke
+        pagenum -- On which page the stroke is drawn
+        color -- Color of the stroke
+        linewidth -- Line width of the stroke
+        start -- Index of the first point in this batch
+        deltas -- List of delta encoded coordinates
+        """
+        self.data_received()
+        if not self.document or pagenum >= len(self.document.pages):
+            return
+        page = self.document.pages[pagenum]
+        if start == 0:
+            self.remote_end_stroke_stream(user_id)
+            self.remote_streams[user_id] = (page, Stroke(color, linewidth, coords=[]), (0, 0))
+        if user_id not in self.remote_streams:
+            return
+        page, stroke, last_point = self.remote_streams[user_id]
+        # Ignore batches, that don't continue the stroke
+        if page.number != pagenum or len(stroke.coords) // 2 != start:
+            return
+        coords, last_point = delta_decode(deltas, last_point)
+        stroke.coords.extend(coords)
+        self.remote_streams[user_id] = (page, stroke, last_point)
+        if page.widget:
+            page.widget.draw_stroke_preview(user_id, stroke, start)
+
+    def remote_end_stroke_stream(self, user_id):
+        """
+        Called by the server, when a remote user finished or aborted a stroke.
+        The finished stroke is sent separately.
+
+        Positional arguments:
+        user_id -- Id of the user, who drew the stroke
+        """
+        self.data_received()
+        page, stroke, last_point = self.remote_streams.pop(user_id, (None, None, None))
+        if page is not None and page.widget:
+            page.widget.delete_stroke_preview(user_id)
 
     def remote_delete_stroke_with_coords(self, pagenum, coords):
         """
@@ -227,9 +531,43 @@ def delete_stroke_with_coords(self, pagenum, coords):
         pagenum -- On which page the stroke was deleted
         coords -- The list of coordinates identifying the stroke
         """
-        if self.is_connected:
-            d = self.server_document.callRemote("delete_stroke_with_coords", pagenum, coords)
-            d.addCallback(lambda x, y: self.data_received(), self.disconnect)
+        self.queue_call("delete_stroke_with_coords", pagenum, coords)
+
+    def queue_call(self, method, *args):
+        """
+        Send a change to the server. Changes are collected for BATCH_INTERVAL
+        seconds and then sent in one message, in the order they were made.
+
+        Positional arguments:
+        method -- Name of the remote method of the server document
+        *args -- Arguments of the remote method
+        """
+        if not self.is_connected:
+            return
+        self.send_queue.append((method, args))
+        if self.send_flush is None:
+            self.send_flush = reactor.callLater(BATCH_INTERVAL, self.flush_send_queue)
+
+    def flush_send_queue(self):
+        """
+        Send all queued changes to the server. A single change is sent as it is,
+        multiple changes are sent as one batch.
+        """
+        self.send_flush = None
+        operations, self.send_queue = self.send_queue, []
+        if len(operations) == 0 or not self.is_connected:
+            return
+        if len(operations) == 1:
+            method, args = operations[0]
+            d = self.server_document.callRemote(method, *args)
+        else:
+            d = self.server_document.callRemote("batch", operations)
+        d.addCallbacks(lambda x: self.data_received(), self.disconnect)
+
+        self.operations_sent += len(operations)
+        self.messages_sent += 1
+        debug(3, _("Sent {} changes in one message ({} changes in {} messages so far)").format(
+              len(operations), self.operations_sent, self.messages_sent))
 
     def ping(self):
         """
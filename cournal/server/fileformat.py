@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of Cournal.
+# Copyright (C) 2012 Fabian Henze
+#
+# Cournal is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cournal is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cournal.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import mmap
+import struct
+import zlib
+
+import cournal.server as server
+
+"""
+Reading and writing of saved documents.
+
+Every file starts with a line containing the file format version. Versions 1
+and 2 are followed by the document encoded by CournalEncoder as JSON.
+
+Version 3 is binary. All numbers are little-endian:
+header -- flags (1 byte), sequence number of the last change (8 bytes),
+          number of pages (4 bytes)
+offset table -- for every page: offset of the page from the start of the
+                header (8 bytes) and its length (4 bytes)
+pages -- every page encoded by cournal.document.codec.encode_page(). If
+         FLAG_COMPRESSED is set, every page is compressed with zlib.
+
+Files are mapped into memory when they are loaded. Pages are only decoded,
+when they are needed, so memory is only used for pages, which are in use.
+"""
+
+FLAG_COMPRESSED = 1
+# Fast compression, higher levels barely reduce the size of packed coordinates
+COMPRESSION_LEVEL = 1
+
+_header = struct.Struct("<BQI")
+_page_entry = struct.Struct("<QI")
+
+
+def dump(document, file, compress=False):
+    """
+    Write a document in file format version 3.
+
+    Positional arguments:
+    document -- The Document object to write
+    file -- A file object opened in binary mode
+
+    Keyword arguments:
+    compress -- Compress the pages with zlib (defaults to False)
+    """
+    pages = []
+    for page in document.pages:
+        data, compressed = page.get_data()
+        if compressed and not compress:
+            data = zlib.decompress(data)
+        elif compress and not compressed:
+            data = zlib.compress(data, COMPRESSION_LEVEL)
+        pages.append(data)
+
+    file.write(b"3\n")
+    file.write(_header.pack(FLAG_COMPRESSED if compress else 0, document.sequence, len(pages)))
+    offset = _header.size + len(pages) * _page_entry.size
+    for page in pages:
+        file.write(_page_entry.pack(offset, len(page)))
+        offset += len(page)
+    for page in pages:
+        file.write(page)
+
+
+def load(file, documentname):
+    """
+    Read a document written in any file format version. Files of version 3
+    are mapped into memory and their pages are decoded, when they are needed.
+
+    Positional arguments:
+    file -- A file object opened in binary mode
+    documentname -- Name of the document. It is not stored in the file.
+
+    Return value: The Document object
+    """
+    file_format_version = int(file.readline())
+    if file_format_version > server.server.FILE_FORMAT_VERSION:
+        raise Exception(_("Could not load document '{}' because it was created with a newer version of cournal-server.").format(documentname))
+    if file_format_version < 3:
+        return json.loads(file.read().decode("utf-8"), cls=server.server.CournalDecoder, documentname=documentname)
+
+    # The mapping stays valid after the file is closed or replaced, as long as
+    # any page refers to it
+    data = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))[file.tell():]
+    flags, sequence, page_count = _header.unpack_from(data)
+    position = _header.size
+    pages = []
+    for i in range(page_count):
+        offset, length = _page_entry.unpack_from(data, position)
+        position += _page_entry.size
+        pages.append(server.server.Page(data=data[offset:offset + length],
+                                        compressed=bool(flags & FLAG_COMPRESSED)))
+    return server.server.Document(documentname, pages, sequence)
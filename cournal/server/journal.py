@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of Cournal.
+# Copyright (C) 2012 Fabian Henze
+#
+# Cournal is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cournal is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cournal.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import sys
+
+
+class Journal:
+    """
+    An append-only file, which records all changes to a document since the
+    document was saved the last time.
+
+    Every line of the file is a JSON list, containing the sequence number of the
+    change, the name of the Document method, which applies the change, and the
+    arguments of that method.
+
+    While a document is saved, new changes are recorded in a new file and the
+    previous file is kept under the name path + ".old" until the document was
+    saved successfully.
+    """
+    def __init__(self, path, encoder, decoder):
+        """
+        Constructor
+
+        Positional arguments:
+        path -- Path of the journal file. It is created, when the first change is
+                recorded.
+        encoder -- JSONEncoder subclass, which encodes the arguments of changes.
+                   It is called with single_line=True.
+        decoder -- JSONDecoder subclass, which decodes them again. It is
+                   called with the name of the document as documentname.
+        """
+        self.path = path
+        self.encoder = encoder
+        self.decoder = decoder
+        self.rotated_path = path + ".old"
+        self.file = None
+        self.has_unsynced_changes = False
+
+    def append(self, sequence, method, *args):
+        """
+        Record a change. Call sync() to make sure, that it is stored on disk.
+
+        Positional arguments:
+        sequence -- Sequence number of the change
+        method -- Name of the Document method, which applies the change
+        *args -- Arguments of that method
+        """
+        if self.file is None:
+            self.file = open(self.path, "a")
+        record = [sequence, method] + list(args)
+        self.file.write(json.dumps(record, cls=self.encoder, single_line=True) + "\n")
+        self.has_unsynced_changes = True
+
+    def sync(self):
+        """Write all recorded changes to the disk."""
+        if self.file is not None and self.has_unsynced_changes:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.has_unsynced_changes = False
+
+    def close(self):
+        """Sync and close the journal file."""
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+    def rotate(self):
+        """
+        Start a new journal file. Call this before a copy of the document is
+        saved and call discard_rotated() when saving it succeeded.
+        """
+        self.close()
+        if not os.path.exists(self.path):
+            return
+        if os.path.exists(self.rotated_path):
+            # Saving the document failed last time, so keep the older changes
+            with open(self.rotated_path, "a") as rotated, open(self.path, "r") as current:
+                rotated.write(current.read())
+                rotated.flush()
+                os.fsync(rotated.fileno())
+            os.remove(self.path)
+        else:
+            os.rename(self.path, self.rotated_path)
+
+    def discard_rotated(self):
+        """Delete the changes, that were recorded before the last rotate()."""
+        if os.path.exists(self.rotated_path):
+            os.remove(self.rotated_path)
+
+    def clear(self):
+        """
+        Delete all recorded changes. Call this after the document was saved.
+        """
+        self.close()
+        self.discard_rotated()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def replay(self, document):
+        """
+        Apply all recorded changes to a document, which are newer than the
+        document itself.
+
+        Positional arguments:
+        document -- The Document object, that was loaded from disk
+
+        Return value: Number of applied changes
+        """
+        applied = 0
+        decoder = self.decoder(documentname=document.name)
+        for path in [self.rotated_path, self.path]:
+            if not os.path.exists(path):
+                continue
+            with open(path, "r") as file:
+                for line in file:
+                    try:
+                        record = decoder.decode(line)
+                    except ValueError:
+                        # The last line is incomplete, if we crashed while writing it
+                        print(_("WARNING: Ignoring incomplete change in journal '{}'").format(path), file=sys.stderr)
+                        break
+                    sequence, method, args = record[0], record[1], record[2:]
+                    if sequence <= document.sequence:
+                        # The document was saved after this change was recorded
+                        continue
+                    getattr(document, method)(*args)
+                    document.sequence = sequence
+                    applied += 1
+        return applied
@@ -18,42 +18,67 @@
 # You should have received a copy of the GNU General Public License
 # along with Cournal.  If not, see <http://www.gnu.org/licenses/>.
 
-import json
 import os
 import pickle
 from tempfile import NamedTemporaryFile
 
 import cournal.server as server
+from cournal.document.stroke import Stroke
 
 
 def run(from_dir, to_dir=None):
     """
-    Convert the pickled documents (cnl-*.save) to the new json file format
+    Convert the pickled documents (cnl-*.save) to the current file format and
+    rename the documents saved in the JSON file formats (see rename_json())
 
     Arguments:
     from_dir -- Path of the directory where the old .save files are
-    to_dir -- Path of the directory where the new .json files shall be saved to
+    to_dir -- Path of the directory where the new .cnl files shall be saved to
              (defaults to `from_dir`)
     """
     if to_dir is None:
         to_dir = from_dir
+    rename_json(to_dir)
 
     for filename in [s for s in os.listdir(from_dir) if s.startswith("cnl-") and s.endswith(".save")]:
-        if os.path.exists(os.path.join(to_dir, filename[:-5] + ".json")):
+        if os.path.exists(os.path.join(to_dir, filename[:-5] + server.server.DOCUMENT_EXTENSION)):
             continue
         name = server.server.filename_to_docname(filename)
         with open(os.path.join(from_dir, filename), "rb") as file:
-            document = server.server.Document(name)
-            document.pages = pickle.load(file)
-        _save(document, to_dir)
+            old_pages = pickle.load(file)
+        # The unpickled pages only have a list of strokes in their __dict__,
+        # which is hidden by Page.strokes, so the pages are created again.
+        pages = [server.server.Page(strokes=[Stroke(stroke.color, stroke.linewidth, coords=stroke.coords,
+                                                    widths=stroke.widths)
+                                             for stroke in vars(page)["strokes"]])
+                 for page in old_pages]
+        _save(server.server.Document(name, pages), to_dir)
         print(_("NOTE: Found document '{}' saved by cournal-server 0.2.1 or earlier.\n"
                 "      It will be converted to a new file format. Please make sure the\n"
                 "      conversion went fine and delete the old file: '{}'.").format(name, filename))
 
 
+def rename_json(dir):
+    """
+    Rename the documents saved in the JSON file formats (cnl-*.json) to the
+    current extension. fileformat.load() detects the format by the content of
+    a file, so only the name changes.
+
+    Arguments:
+    dir -- Path of the directory where the old .json files are
+    """
+    for filename in [s for s in os.listdir(dir) if s.startswith("cnl-") and s.endswith(server.server.LEGACY_EXTENSION)]:
+        new_filename = filename[:-len(server.server.LEGACY_EXTENSION)] + server.server.DOCUMENT_EXTENSION
+        if os.path.exists(os.path.join(dir, new_filename)):
+            print(_("WARNING: '{}' and '{}' contain the same document. Ignoring '{}'.")
+                  .format(new_filename, filename, filename))
+            continue
+        os.rename(os.path.join(dir, filename), os.path.join(dir, new_filename))
+
+
 def _save(document, dir):
     """
-    Saves the given Document() in the given directory as a .json file
+    Saves the given Document() in the given directory in the current file format
 
     Arguments:
     document -- The Document instance which shall be saved
@@ -63,8 +88,12 @@ def _save(document, dir):
     # atomic writing of the file, meaning: In case of a crash, either the
     # old or the new version of that file is on the disk
     filename = server.server.docname_to_filename(document.name)
-    tmpfile = NamedTemporaryFile(prefix=filename[:-5] + '-', suffix='.delete-me', dir=dir, mode='w', delete=False)
-    tmpfile.write(str(server.server.FILE_FORMAT_VERSION) + '\n')
-    json.dump(document, tmpfile, cls=server.server.CournalEncoder)
-    tmpfile.close()
-    os.rename(tmpfile.name, os.path.join(dir, filename))
+    tmpfile = NamedTemporaryFile(prefix=os.path.splitext(filename)[0] + '-', suffix='.delete-me', dir=dir, mode='wb', delete=False)
+    try:
+        server.fileformat.dump(document, tmpfile)
+        tmpfile.close()
+        os.rename(tmpfile.name, os.path.join(dir, filename))
+    finally:
+        tmpfile.close()
+        if os.path.exists(tmpfile.name):
+            os.remove(tmpfile.name)
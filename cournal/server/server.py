@@ -25,19 +25,27 @@
 import string
 import subprocess
 import sys
+import zlib
 from io import StringIO
+from itertools import count
 from tempfile import NamedTemporaryFile
+from time import time
 
 from zope.interface import implementer
 from twisted.cred import portal, checkers
 from twisted.spread import pb
-from twisted.internet import reactor
+from twisted.internet import reactor, threads
+from twisted.internet.defer import Deferred, DeferredList, succeed, fail
 from twisted.internet.error import CannotListenError
 from twisted.python.failure import Failure
 
 from cournal import __versionstring__ as cournal_version
+from cournal.encoding import encode_arguments, PROTOCOL_VERSION, MIN_PROTOCOL_VERSION
+from cournal.document import codec
 from cournal.document.stroke import Stroke
-from cournal.server import pickle_legacy
+from cournal.document.strokeindex import StrokeIndex
+from cournal.server import pickle_legacy, fileformat, supervisor
+from cournal.server.journal import Journal
 
 # 0 - none
 # 1 - minimum
@@ -47,10 +55,24 @@
 
 DEFAULT_AUTOSAVE_DIRECTORY = os.path.expanduser("~/.cournal/documents")
 DEFAULT_AUTOSAVE_INTERVAL = 60
+DEFAULT_UNLOAD_TIMEOUT = 600
+# Interval in seconds within which changes are synced to the journals on disk
+JOURNAL_SYNC_INTERVAL = 1
 DEFAULT_PORT = 6524
 USERNAME = "test"
 PASSWORD = "testpw"
-FILE_FORMAT_VERSION = 1
+FILE_FORMAT_VERSION = 3
+# Extension of saved documents. Documents saved by earlier versions in the
+# JSON formats (1 and 2) end with LEGACY_EXTENSION and are renamed on startup.
+DOCUMENT_EXTENSION = ".cnl"
+LEGACY_EXTENSION = ".json"
+# Maximum number of strokes sent in one message, when a user joins a document
+SNAPSHOT_CHUNK_SIZE = 500
+# Maximum number of bytes of an encoded page sent in one message. Must be less
+# than the maximum size of a string in Perspective Broker (640 KB).
+SNAPSHOT_CHUNK_BYTES = 256 * 1024
+# Methods of Document, which clients may call in a batch (without view_ prefix)
+BATCH_METHODS = ("new_stroke", "delete_stroke_with_coords", "stroke_points")
 
 # List of all characters that are allowed in filenames. Must not contain ; and :
 valid_characters = string.ascii_letters + string.digits + ' _()+,.-=^~'
@@ -60,9 +82,14 @@ class CournalEncoder(json.JSONEncoder):
     """
     Encodes a any given object and all its properties to JSON.
     """
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, single_line=False, **kwargs):
+        """
+        Keyword arguments:
+        single_line -- Don't insert line breaks, e.g. to store one object per line.
+                       (defaults to False)
+        """
         kwargs["separators"] = (',', ':')
-        kwargs["indent"] = 0
+        kwargs["indent"] = None if single_line else 0
         super().__init__(*args, **kwargs)
 
     def default(self, obj):
@@ -109,30 +136,149 @@ def dict_to_object(self, d):
 class Page:
     """
     A page in a document, having multiple strokes.
+
+    Pages of saved documents keep the encoded strokes from the file, which is
+    mapped into memory, and decode them only when they are needed. Users,
+    who join the document, receive the encoded strokes.
     """
-    def __init__(self, strokes=None):
-        if strokes is None:
-            self.strokes = []
-        else:
-            self.strokes = strokes
+    def __init__(self, strokes=None, data=None, compressed=False):
+        """
+        Keyword arguments:
+        strokes -- List of Stroke objects (default [])
+        data -- The strokes encoded by codec.encode_page() instead of a
+                list of Stroke objects (default None)
+        compressed -- True, if data is compressed with zlib (default False)
+        """
+        # The strokes in the order they were drawn. A dict is used as an
+        # ordered set, which allows to remove strokes in constant time.
+        # None, until data is decoded.
+        self._strokes = None
+        if data is None:
+            self._strokes = dict.fromkeys(strokes or [])
+        # The encoded strokes, if they did not change since they were encoded
+        self.data = data
+        self.compressed = compressed
+        # Only needed to delete strokes, so it is created on demand.
+        self._index = None
+
+    @property
+    def strokes(self):
+        """The strokes of this page. Decodes them, if needed."""
+        if self._strokes is None:
+            data = zlib.decompress(self.data) if self.compressed else self.data
+            self._strokes = dict.fromkeys(codec.decode_page(data))
+        return self._strokes
+
+    @property
+    def index(self):
+        """A StrokeIndex of all strokes on this page."""
+        if self._index is None:
+            self._index = StrokeIndex()
+            for stroke in self.strokes:
+                self._index.add(stroke)
+        return self._index
+
+    def get_state_to_save(self):
+        """Returns a subset of self.__dict__, which is to be stored on disk."""
+        return {"strokes": list(self.strokes)}
+
+    def get_data(self):
+        """
+        Returns the strokes of this page encoded by codec.encode_page()
+        as tuple (data, compressed). The result is kept until the page changes.
+        """
+        if self.data is None:
+            self.data = codec.encode_page(list(self.strokes))
+            self.compressed = False
+        return self.data, self.compressed
+
+    def copy(self):
+        """
+        Returns a copy of this page, which can be saved while this page is
+        changed. Strokes and encoded data never change, so they are shared.
+        """
+        page = Page(data=self.data, compressed=self.compressed)
+        if self._strokes is not None:
+            page._strokes = self._strokes.copy()
+        return page
+
+    def add_stroke(self, stroke):
+        """
+        Add a stroke to this page.
+
+        Positional arguments:
+        stroke -- The new Stroke object
+        """
+        self.strokes[stroke] = None
+        self.data = None
+        if self._index is not None:
+            self._index.add(stroke)
+
+    def add_strokes(self, strokes):
+        """
+        Add several strokes to this page at once.
+
+        Positional arguments:
+        strokes -- List of new Stroke objects
+        """
+        self.strokes.update(dict.fromkeys(strokes))
+        self.data = None
+        if self._index is not None:
+            for stroke in strokes:
+                self._index.add(stroke)
+
+    def delete_strokes_with_coords(self, coords):
+        """
+        Delete all strokes, which have exactly the same coordinates as given.
+
+        Positional arguments:
+        coords -- The list of coordinates
+
+        Return value: Number of deleted strokes
+        """
+        strokes = self.index.find(coords)
+        for stroke in strokes:
+            del self.strokes[stroke]
+            self.index.remove(stroke)
+        if len(strokes) > 0:
+            self.data = None
+        return len(strokes)
 
 
 class CournalServer:
     """
     The server object, that holds global state, which is shared between all users.
     """
-    def __init__(self, autosave_directory, autosave_interval, save_hook):
+    def __init__(self, autosave_directory, autosave_interval, save_hook, unload_timeout=DEFAULT_UNLOAD_TIMEOUT,
+                 compress=False):
         """
         Constructor.
 
-        Test, if the autosave directory is writable and load saved data.
+        Test, if the autosave directory is writable and find saved documents.
+        They are not loaded, until a user joins them.
 
         Positional arguments:
         autosave_directory -- The directory within which to store the documents
         autosave_interval -- Interval in seconds within which to save the documents
         save_hook -- Script or application to execute after the documents were saved
+
+        Keyword arguments:
+        unload_timeout -- Unload documents without users from memory after this
+                          many seconds. 0 keeps all documents in memory.
+        compress -- Compress saved documents with zlib (defaults to False)
         """
+        # All documents, that are loaded
         self.documents = dict()
+        # Maps the names of all saved documents to a tuple (size, mtime) of their file
+        self.catalogue = dict()
+        # Maps the names of documents, which are being loaded, to a list of
+        # deferreds, which fire when loading finished
+        self.loading = dict()
+        self.unload_timeout = unload_timeout
+        self.compress = compress
+        # Longest time in seconds the reactor was blocked since the last autosave
+        self.max_reactor_lag = 0
+        self.next_journal_sync = time() + JOURNAL_SYNC_INTERVAL
         self.autosave_directory = os.path.abspath(autosave_directory)
         self.autosave_interval = autosave_interval
         self.save_hook = save_hook
@@ -160,21 +306,14 @@ def __init__(self, autosave_directory, autosave_interval, save_hook):
         else:
             pickle_legacy.run(self.autosave_directory)
 
-        # Load saved documents
-        for filename in [s for s in os.listdir(self.autosave_directory) if s.startswith("cnl-") and s.endswith(".json")]:
-            name = filename_to_docname(filename)
-            with open(os.path.join(self.autosave_directory, filename), "r") as file:
-                file_format_version = int(file.readline())
-                if file_format_version > FILE_FORMAT_VERSION:
-                    print(_("ERROR: Could not load document '{}' because it was created with a newer version of cournal-server.").format(name), file=sys.stderr)
-                    continue
-                document = json.load(file, cls=CournalDecoder, documentname=name)
-                if document:
-                    self.documents[name] = document
+        # Find saved documents
+        for filename in [s for s in os.listdir(self.autosave_directory) if s.startswith("cnl-") and s.endswith(DOCUMENT_EXTENSION)]:
+            self.update_catalogue(filename_to_docname(filename))
 
-        debug(1, _("Loaded {} documents").format(len(self.documents)))
+        debug(1, _("Found {} documents").format(len(self.catalogue)))
 
         reactor.callLater(self.autosave_interval, self.save_documents)
+        reactor.callLater(JOURNAL_SYNC_INTERVAL, self.sync_journals)
 
     def obtain_lockfile(self):
         """
@@ -233,60 +372,259 @@ def exit(self):
         The program is about to terminate. Save documents and release lockfile
         """
         if self.autosave_interval > 0:
-            # Save on exit, if the user enabled autosave
-            self.save_documents()
+            saving = [document for document in self.documents.values() if document.is_saving]
+            if len(saving) > 0:
+                # Wait for documents, which are written in a thread. Otherwise
+                # they could overwrite the files saved below.
+                threadpool = reactor.getThreadPool()
+                if not threadpool.joined:
+                    threadpool.stop()
+            # Save on exit, if the user enabled autosave. The callbacks of
+            # saves in a thread don't run anymore, so those documents are saved
+            # again to clear their journals.
+            savedfiles = []
+            for document in self.documents.values():
+                if document.has_unsaved_changes or document in saving:
+                    savedfiles.append(self.save_document(document))
+                document.journal.close()
+            self.run_save_hook(savedfiles)
             # and release the directory lock
             self.release_lockfile()
 
+    def update_catalogue(self, documentname):
+        """
+        Update the catalogue entry of a saved document.
+
+        Positional arguments:
+        documentname -- Name of the document
+        """
+        stat = os.stat(os.path.join(self.autosave_directory, docname_to_filename(documentname)))
+        self.catalogue[documentname] = (stat.st_size, stat.st_mtime)
+
+    def list_documents(self):
+        """
+        Returns a list of the names of all documents, loaded or not.
+        """
+        return list(self.catalogue) + [name for name in self.documents if name not in self.catalogue]
+
+    def load_document(self, documentname):
+        """
+        Load a saved document and apply the changes from its journal. Called in
+        a thread by get_document().
+
+        Positional arguments:
+        documentname -- Name of the document
+
+        Return value: The Document object
+        """
+        filename = docname_to_filename(documentname)
+        with open(os.path.join(self.autosave_directory, filename), "rb") as file:
+            document = fileformat.load(file, documentname)
+
+        # Apply the changes, which were made after the document was saved
+        document.journal = Journal(os.path.join(self.autosave_directory, docname_to_journal_filename(documentname)),
+                                   CournalEncoder, CournalDecoder)
+        if document.journal.replay(document) > 0:
+            document.has_unsaved_changes = True
+        debug(2, _("Loaded document '{}'").format(documentname))
+        return document
+
+    def document_loaded(self, result, documentname):
+        """
+        Called, when a document was loaded by load_document().
+
+        Positional arguments:
+        result -- The Document object or a Failure, if loading failed
+        documentname -- Name of the document
+        """
+        if isinstance(result, Failure):
+            print(_("ERROR: {}").format(result.getErrorMessage()), file=sys.stderr)
+        else:
+            self.documents[documentname] = result
+        for d in self.loading.pop(documentname):
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def unload_idle_documents(self):
+        """
+        Remove documents from memory, that had no users for unload_timeout
+        seconds and were saved since.
+        """
+        if self.unload_timeout == 0:
+            return
+        for name, document in list(self.documents.items()):
+            if (len(document.users) == 0 and not document.has_unsaved_changes and not document.is_saving
+                    and time() - document.last_used > self.unload_timeout):
+                debug(2, _("Unloading document '{}'").format(name))
+                document.journal.close()
+                del self.documents[name]
+
+    def sync_journals(self):
+        """
+        Make sure, that all changes written to the journals are stored on disk.
+
+        Changes are appended to the journals immediately, but syncing them is
+        expensive, so it is done for all changes within JOURNAL_SYNC_INTERVAL
+        seconds at once.
+
+        As this is called regularly, it also measures for how long the reactor
+        was blocked by comparing the actual and the scheduled time of the call.
+        """
+        self.max_reactor_lag = max(self.max_reactor_lag, time() - self.next_journal_sync)
+
+        for document in self.documents.values():
+            document.journal.sync()
+
+        self.next_journal_sync = time() + JOURNAL_SYNC_INTERVAL
+        reactor.callLater(JOURNAL_SYNC_INTERVAL, self.sync_journals)
+
     def save_documents(self):
         """
-        Save all documents to files named "autosave_directory/cnl-documentname.json".
+        Save all documents to files named "autosave_directory/cnl-documentname.cnl".
+
+        All changes are already stored in the journals of the documents, so this
+        compacts them into a snapshot of the document and clears the journal.
+        Only a copy of each document is made here, encoding and writing it is
+        done in a thread to keep the reactor responsive.
         """
+        self.unload_idle_documents()
+
         debug(3, _("Saving all documents."))
-        savedfiles = []
-        for name, document in self.documents.items():
-            if not document.has_unsaved_changes:
-                continue
-            debug(2, _("Saving document '{}' to '{}'").format(name, os.path.join(self.autosave_directory, docname_to_filename(name))))
-            # We write to a tmpfile and move it to the actual location to ensure
-            # atomic writing of the file, meaning: In case of a crash, either the
-            # old or the new version of that file is on the disk
-            filename = docname_to_filename(name)
-            tmpfile = NamedTemporaryFile(prefix=filename[:-5] + '-', suffix='.delete-me', dir=self.autosave_directory, mode='w', delete=False)
-            tmpfile.write(str(FILE_FORMAT_VERSION) + '\n')
-            json.dump(document, tmpfile, cls=CournalEncoder)
-            tmpfile.close()
-            os.rename(tmpfile.name, os.path.join(self.autosave_directory, filename))
-            document.has_unsaved_changes = False
-            savedfiles.append(filename)
+        start = time()
+        deferreds = []
+        for document in self.documents.values():
+            if document.has_unsaved_changes and not document.is_saving:
+                deferreds.append(self.save_document_in_thread(document))
+        blocked = time() - start
 
-        if self.save_hook is not None and savedfiles:
-            subprocess.Popen([self.save_hook, self.autosave_directory] + savedfiles)
+        debug(3, _("Autosave blocked the reactor for {:.1f} ms. The reactor was blocked "
+                   "for up to {:.1f} ms since the last autosave.").format(blocked * 1000, self.max_reactor_lag * 1000))
+        self.max_reactor_lag = 0
+
+        d = DeferredList(deferreds, consumeErrors=True)
+        d.addCallback(lambda results: self.run_save_hook([filename for success, filename in results if success]))
 
         reactor.callLater(self.autosave_interval, self.save_documents)
 
+    def save_document_in_thread(self, document):
+        """
+        Save a copy of a document in a thread. Changes to the document, that are
+        made meanwhile, are recorded in a new journal.
+
+        Positional arguments:
+        document -- The Document object to save
+
+        Return value: A deferred, which fires with the filename of the saved document
+        """
+        def saved(filename):
+            document.is_saving = False
+            self.update_catalogue(document.name)
+            # The changes in the old journal are part of the saved copy now
+            document.journal.discard_rotated()
+            return filename
+
+        def failed(failure):
+            document.is_saving = False
+            document.has_unsaved_changes = True
+            print(_("Error saving document '{}': {}").format(document.name, failure.getErrorMessage()), file=sys.stderr)
+            return failure
+
+        snapshot = document.get_snapshot()
+        document.journal.rotate()
+        document.has_unsaved_changes = False
+        document.is_saving = True
+
+        d = threads.deferToThread(self.write_document, snapshot)
+        d.addCallbacks(saved, failed)
+        return d
+
+    def save_document(self, document):
+        """
+        Save a document to a file named "autosave_directory/cnl-documentname.cnl"
+        and clear its journal. Blocks, until the document was written.
+
+        Positional arguments:
+        document -- The Document object to save
+
+        Return value: The filename of the saved document
+        """
+        filename = self.write_document(document)
+        self.update_catalogue(document.name)
+        # The snapshot contains the sequence number of the last change, so it
+        # does not matter, if we crash before the journal is cleared.
+        document.journal.clear()
+        document.has_unsaved_changes = False
+        return filename
+
+    def write_document(self, document):
+        """
+        Write a document to a file named "autosave_directory/cnl-documentname.cnl".
+        May be called from a thread, as long as the document is not changed
+        meanwhile.
+
+        Positional arguments:
+        document -- The Document object to write
+
+        Return value: The filename of the written document
+        """
+        filename = docname_to_filename(document.name)
+        debug(2, _("Saving document '{}' to '{}'").format(document.name, os.path.join(self.autosave_directory, filename)))
+        # We write to a tmpfile and move it to the actual location to ensure
+        # atomic writing of the file, meaning: In case of a crash, either the
+        # old or the new version of that file is on the disk
+        tmpfile = NamedTemporaryFile(prefix=os.path.splitext(filename)[0] + '-', suffix='.delete-me', dir=self.autosave_directory, mode='wb', delete=False)
+        fileformat.dump(document, tmpfile, compress=self.compress)
+        tmpfile.close()
+        os.rename(tmpfile.name, os.path.join(self.autosave_directory, filename))
+        return filename
+
+    def run_save_hook(self, savedfiles):
+        """
+        Execute the save hook, if the user specified one.
+
+        Positional arguments:
+        savedfiles -- List of the filenames of all documents that were saved
+        """
+        if self.save_hook is not None and savedfiles:
+            subprocess.Popen([self.save_hook, self.autosave_directory] + savedfiles)
+
     def get_document(self, documentname):
         """
-        Returns a Document object given its name. If none with this name exists,
-        it will be created.
+        Get a Document object given its name. Saved documents are loaded in a
+        thread, if they are not in memory yet. If no document with this name
+        exists, it will be created.
 
         Positional arguments:
         documentname -- Name of the document you want to get
+
+        Return value: A deferred, which fires with the Document object
         """
-        if documentname not in self.documents:
-            if self.autosave_interval > 0:
-                # Try to create a savefile, if it fails deny the document creation
-                filename = docname_to_filename(documentname)
-                try:
-                    file = open(os.path.join(self.autosave_directory, filename), mode="w")
-                    json.dump([], file)
-                    file.close()
-                except Exception as ex:
-                    print(_("Error creating file:"), ex)
-                    return Failure(str(ex))
-            self.documents[documentname] = Document(documentname)
-            self.documents[documentname].has_unsaved_changes = True
-        return self.documents[documentname]
+        if documentname in self.documents:
+            return succeed(self.documents[documentname])
+
+        if documentname in self.catalogue:
+            if documentname not in self.loading:
+                self.loading[documentname] = []
+                d = threads.deferToThread(self.load_document, documentname)
+                d.addBoth(self.document_loaded, documentname)
+            d = Deferred()
+            self.loading[documentname].append(d)
+            return d
+
+        document = Document(documentname)
+        if self.autosave_interval > 0:
+            # Try to create a savefile, if it fails deny the document creation
+            document.journal = Journal(os.path.join(self.autosave_directory, docname_to_journal_filename(documentname)),
+                                       CournalEncoder, CournalDecoder)
+            try:
+                self.save_document(document)
+            except Exception as ex:
+                print(_("Error creating file:"), ex)
+                return fail(ex)
+        self.documents[documentname] = document
+        return succeed(document)
 
 
 @implementer(portal.IRealm)
@@ -316,6 +654,9 @@ class User(pb.Avatar):
     """
     A remote user.
     """
+    # Every user gets a unique id, which identifies his unfinished strokes
+    ids = count(1)
+
     def __init__(self, name, server):
         """
         Constructor
@@ -326,9 +667,12 @@ def __init__(self, name, server):
         """
         debug(1, _("New User connected: {}").format(name))
         self.name = name
+        self.id = next(User.ids)
         self.server = server
         self.remote = None
         self.documents = []
+        # Clients, which do not negotiate a version, use the first one
+        self.protocol_version = 1
 
     def __del__(self):
         """Destructor. Called when the user disconnects."""
@@ -356,13 +700,39 @@ def detached(self, mind):
         for document in self.documents:
             document.remove_user(self)
 
+    def perspective_negotiate_protocol(self, version):
+        """
+        Called by the user after logging in to tell us the newest version of
+        the network protocol it understands.
+
+        Positional arguments:
+        version -- The protocol version of the client
+
+        Return value: Our protocol version
+        """
+        self.protocol_version = min(version, PROTOCOL_VERSION)
+        debug(2, _("User {} uses protocol version {}").format(self.name, self.protocol_version))
+        return PROTOCOL_VERSION
+
     def perspective_list_documents(self):
         """
         Return a list of all our documents.
         """
         debug(2, _("User {} requested document list").format(self.name))
 
-        return list(self.server.documents.keys())
+        return self.server.list_documents()
+
+    def perspective_locate_document(self, documentname):
+        """
+        Called by the user before joining a document to find the server owning
+        it. See cournal.server.supervisor.
+
+        Positional arguments:
+        documentname -- Name of the document
+
+        Return value: None, as we own all documents
+        """
+        return None
 
     def perspective_join_document(self, documentname):
         """
@@ -371,13 +741,26 @@ def perspective_join_document(self, documentname):
         Positional arguments:
         documentname -- Name of the requested document session
         """
+        if self.protocol_version < MIN_PROTOCOL_VERSION:
+            debug(1, _("User {} uses an outdated client").format(self.name))
+            raise pb.Error(_("Your version of Cournal is too old for this server. Please update it."))
         debug(2, _("User {} started editing {}").format(self.name, documentname))
 
-        document = self.server.get_document(documentname)
-        if isinstance(document, Failure):
-            return document
-        document.add_user(self)
-        self.documents.append(document)
+        d = self.server.get_document(documentname)
+        d.addCallback(self.joined_document)
+        return d
+
+    def joined_document(self, document):
+        """
+        Called, when the document the user wants to join is available.
+
+        Positional arguments:
+        document -- The Document object
+        """
+        # The user might have disconnected, while the document was loaded
+        if self.remote is not None:
+            document.add_user(self)
+            self.documents.append(document)
         return document
 
     def perspective_ping(self):
@@ -393,42 +776,89 @@ def call_remote(self, method, *args):
         *args -- Arguments of the remote method
         """
 
-        self.remote.callRemote(method, *args)
+        d = self.remote.callRemote(method, *args)
+        d.addErrback(self.call_remote_failed, method)
+
+    def call_remote_failed(self, reason, method):
+        """
+        Called, when a remote method of this user failed.
+
+        Positional arguments:
+        reason -- The Failure object
+        method -- Name of the remote method
+        """
+        # The user disconnected, before the call was answered. detached()
+        # removes the user from its documents.
+        if reason.check(pb.PBConnectionLost, pb.DeadReferenceError) is None:
+            debug(1, _("Calling '{}' of user {} failed: {}").format(method, self.name, reason.getErrorMessage()))
 
 
 class Document(pb.Viewable):
     """
     A Cournal document, having multiple pages.
     """
-    def __init__(self, name, pages=None):
+    def __init__(self, name, pages=None, sequence=0):
         """
         Arguments:
         name -- Name of this document
         pages -- List of Page objects (default  [])
+        sequence -- Sequence number of the last change to this document (default 0)
         """
         self.name = name
         self.users = []
+        # Users, who are drawing a stroke, which is streamed to the other users
+        self.streaming_users = set()
         self.pages = pages
         if self.pages is None:
             self.pages = []
+        self.sequence = sequence
         self.has_unsaved_changes = False
+        self.is_saving = False
+        # Time when the last user joined or left
+        self.last_used = time()
+        # A Journal object, set by CournalServer if autosave is enabled
+        self.journal = None
 
     def get_state_to_save(self):
         """Returns a subset of self.__dict__, which is to be stored on disk."""
-        return {"pages": self.pages}
+        return {"pages": self.pages, "sequence": self.sequence}
+
+    def get_snapshot(self):
+        """
+        Returns a copy of this document, which can be saved while this document
+        is changed. Strokes never change, so they are shared with the copy.
+        """
+        pages = [page.copy() for page in self.pages]
+        return Document(self.name, pages, self.sequence)
 
     def add_user(self, user):
         """
         Called, when a user starts editing this document. Send him all strokes
         that are currently in the document.
 
+        The strokes are sent page by page in chunks of at most SNAPSHOT_CHUNK_SIZE
+        strokes, instead of calling a remote method for every single stroke.
+        Users with protocol version 3 or newer receive the encoded pages in
+        chunks of at most SNAPSHOT_CHUNK_BYTES bytes instead, so pages, that
+        were not changed since the document was loaded, are sent without
+        decoding them.
+
         Positional arguments:
         user -- The concerning User object.
         """
         self.users.append(user)
-        for pagenum in range(len(self.pages)):
-            for stroke in self.pages[pagenum].strokes:
-                user.call_remote("new_stroke", pagenum, stroke)
+        self.last_used = time()
+        for pagenum, page in enumerate(self.pages):
+            if user.protocol_version >= 3:
+                data, compressed = page.get_data()
+                for start in range(0, len(data), SNAPSHOT_CHUNK_BYTES):
+                    chunk = bytes(data[start:start + SNAPSHOT_CHUNK_BYTES])
+                    user.call_remote("page_data", pagenum, chunk, compressed,
+                                     start + SNAPSHOT_CHUNK_BYTES >= len(data))
+                continue
+            strokes = list(page.strokes)
+            for start in range(0, len(strokes), SNAPSHOT_CHUNK_SIZE):
+                user.call_remote("page_snapshot", pagenum, strokes[start:start + SNAPSHOT_CHUNK_SIZE])
 
     def remove_user(self, user):
         """
@@ -438,21 +868,80 @@ def remove_user(self, user):
         user -- The concerning User object.
         """
         self.users.remove(user)
+        self.last_used = time()
+        self.end_stroke_stream(user)
 
-    def broadcast(self, method, *args, except_user=None):
+    def broadcast(self, method, *args, except_user=None, min_version=1):
         """
         Broadcast a method call to all clients
 
+        The arguments are encoded only once and the encoded bytes are sent to
+        every client, which calls the method as remote_encoded_call(method, data).
+
         Positional arguments:
         method -- Name of the remote method
         *args -- Arguments of the remote method
 
         Keyword arguments:
         except_user -- Don't broadcast to this user.
+        min_version -- Don't broadcast to users with an older protocol version.
         """
-        for user in self.users:
-            if user != except_user:
-                user.call_remote(method, *args)
+        users = [user for user in self.users if user != except_user and user.protocol_version >= min_version]
+        if len(users) == 0:
+            return
+        data = encode_arguments(args)
+        for user in users:
+            user.call_remote("encoded_call", method, data)
+
+    def new_stroke(self, pagenum, stroke):
+        """
+        Add a stroke to a page of this document.
+
+        Positional arguments:
+        pagenum -- Page number the new stroke.
+        stroke -- The new stroke
+        """
+        while len(self.pages) <= pagenum:
+            self.pages.append(Page())
+        self.pages[pagenum].add_stroke(stroke)
+
+    def new_strokes(self, pagenum, strokes):
+        """
+        Add several strokes to a page of this document.
+
+        Positional arguments:
+        pagenum -- Page number the new strokes.
+        strokes -- List of new Stroke objects
+        """
+        while len(self.pages) <= pagenum:
+            self.pages.append(Page())
+        self.pages[pagenum].add_strokes(strokes)
+
+    def delete_strokes_with_coords(self, pagenum, coords):
+        """
+        Delete all strokes on a page, which have exactly the same coordinates
+        as given.
+
+        Positional arguments:
+        pagenum -- Page number the deleted stroke
+        coords -- The list coordinates of the deleted stroke
+
+        Return value: Number of deleted strokes
+        """
+        return self.pages[pagenum].delete_strokes_with_coords(coords)
+
+    def log_change(self, method, *args):
+        """
+        Mark this document as changed and record the change in the journal.
+
+        Positional arguments:
+        method -- Name of the method of this class, which applies the change
+        *args -- Arguments of that method
+        """
+        self.has_unsaved_changes = True
+        self.sequence += 1
+        if self.journal is not None:
+            self.journal.append(self.sequence, method, *args)
 
     def view_new_stroke(self, from_user, pagenum, stroke):
         """
@@ -464,14 +953,80 @@ def view_new_stroke(self, from_user, pagenum, stroke):
         pagenum -- Page number the new stroke.
         stroke -- The new stroke
         """
-        self.has_unsaved_changes = True
-
-        while len(self.pages) <= pagenum:
-            self.pages.append(Page())
-        self.pages[pagenum].strokes.append(stroke)
+        self.new_stroke(pagenum, stroke)
+        self.log_change("new_stroke", pagenum, stroke)
 
         debug(3, _("New stroke on page {}").format(pagenum + 1))
         self.broadcast("new_stroke", pagenum, stroke, except_user=from_user)
+        self.end_stroke_stream(from_user)
+
+    def view_new_strokes(self, from_user, pagenum, strokes):
+        """
+        Broadcast several strokes received from one to all other clients.
+        Called by clients to add many strokes at once, e.g. when importing a
+        file.
+
+        Positional arguments:
+        from_user -- The User object of the initiating user.
+        pagenum -- Page number the new strokes.
+        strokes -- List of new Stroke objects
+        """
+        self.new_strokes(pagenum, strokes)
+        self.log_change("new_strokes", pagenum, strokes)
+
+        debug(3, _("{} new strokes on page {}").format(len(strokes), pagenum + 1))
+        self.broadcast("new_strokes", pagenum, strokes, except_user=from_user, min_version=5)
+        # Users with an older protocol version don't know new_strokes
+        for user in self.users:
+            if user != from_user and user.protocol_version < 5:
+                for stroke in strokes:
+                    user.call_remote("new_stroke", pagenum, stroke)
+
+    def view_stroke_points(self, from_user, pagenum, color, linewidth, start, deltas):
+        """
+        Broadcast points of a stroke, which a user is still drawing, to all other
+        clients. These points are only shown and not stored. When the stroke is
+        finished, it is sent as a new stroke.
+
+        Positional arguments:
+        from_user -- The User object of the initiating user.
+        pagenum -- Page number of the stroke
+        color -- Color of the stroke
+        linewidth -- Line width of the stroke
+        start -- Index of the first point in this batch
+        deltas -- List of delta encoded coordinates
+        """
+        self.streaming_users.add(from_user)
+        self.broadcast("stroke_points", from_user.id, pagenum, color, linewidth, start, deltas,
+                       except_user=from_user)
+
+    def view_batch(self, from_user, operations):
+        """
+        Apply multiple changes of a client in the order they were made.
+        Called by clients, which made several changes within a short time.
+
+        Positional arguments:
+        from_user -- The User object of the initiating user.
+        operations -- List of (method, arguments) tuples, where method is one
+                      of BATCH_METHODS
+        """
+        for method, args in operations:
+            if method not in BATCH_METHODS:
+                debug(1, _("User {} sent an invalid change: {}").format(from_user.name, method))
+                continue
+            getattr(self, "view_" + method)(from_user, *args)
+
+    def end_stroke_stream(self, user):
+        """
+        Tell all other clients, that they can stop showing the unfinished stroke
+        of a user.
+
+        Positional arguments:
+        user -- The concerning User object.
+        """
+        if user in self.streaming_users:
+            self.streaming_users.remove(user)
+            self.broadcast("end_stroke_stream", user.id, except_user=user)
 
     def view_delete_stroke_with_coords(self, from_user, pagenum, coords):
         """
@@ -483,14 +1038,10 @@ def view_delete_stroke_with_coords(self, from_user, pagenum, coords):
         pagenum -- Page number the deleted stroke
         coords -- The list coordinates of the deleted stroke
         """
-        self.has_unsaved_changes = True
-
-        for stroke in self.pages[pagenum].strokes:
-            if stroke.coords == coords:
-                self.pages[pagenum].strokes.remove(stroke)
-
-                debug(3, _("Deleted stroke on page {}").format(pagenum + 1))
-                self.broadcast("delete_stroke_with_coords", pagenum, coords, except_user=from_user)
+        if self.delete_strokes_with_coords(pagenum, coords) > 0:
+            self.log_change("delete_strokes_with_coords", pagenum, coords)
+            debug(3, _("Deleted stroke on page {}").format(pagenum + 1))
+            self.broadcast("delete_stroke_with_coords", pagenum, coords, except_user=from_user)
 
 
 class CmdlineParser:
@@ -503,6 +1054,9 @@ def __init__(self):
         self.autosave_directory = DEFAULT_AUTOSAVE_DIRECTORY
         self.autosave_interval = DEFAULT_AUTOSAVE_INTERVAL
         self.save_hook = None
+        self.unload_timeout = DEFAULT_UNLOAD_TIMEOUT
+        self.compress = False
+        self.workers = 0
 
     def parse(self):
         """
@@ -521,6 +1075,15 @@ def parse(self):
                             help=_("Script or application to execute after all documents were saved. "
                                    "The first argument is the autosave directory, "
                                    "followed by all filenames of files that were changed."))
+        parser.add_argument("-u", "--unload-timeout", nargs=1, type=int, default=[self.unload_timeout],
+                            help=_("Time in seconds after which documents without users are unloaded from memory. "
+                                   "Set to 0 to keep all documents in memory. Requires autosave."))
+        parser.add_argument("-z", "--compress", action="store_true",
+                            help=_("Compress saved documents. Saves disk space, but saving and loading takes longer."))
+        parser.add_argument("-w", "--workers", nargs=1, type=int, default=[self.workers],
+                            help=_("Number of worker processes. Documents are distributed among them, "
+                                   "so that more than one processor core is used. The workers listen "
+                                   "on the ports following the given port. Set to 0 to run a single process."))
         parser.add_argument("-v", "--version", action="version",
                             version="%(prog)s " + cournal_version)
         args = parser.parse_args()
@@ -530,14 +1093,18 @@ def parse(self):
         self.autosave_interval = args.autosave_interval[0]
         if args.save_hook:
             self.save_hook = args.save_hook[0]
+        self.unload_timeout = args.unload_timeout[0]
+        self.compress = args.compress
+        self.workers = args.workers[0]
         return self
 
 
 def filename_to_docname(filename):
     """
     Convert the filename of a saved document to a documentname. Filenames have the
-    form "cnl-[documentname].save" where [documentname] is the name of the
-    document with escaped special characters
+    form "cnl-[documentname].cnl" where [documentname] is the name of the
+    document with escaped special characters. Legacy files end with ".json" or
+    ".save" instead.
 
     Positional arguments:
     filename -- Name of the file with escaped special characters
@@ -545,7 +1112,7 @@ def filename_to_docname(filename):
     Return value: Name of the document without escaped special characters.
     """
     result = ""
-    input = StringIO(filename[4:-5])
+    input = StringIO(os.path.splitext(filename)[0][4:])
 
     while True:
         char = input.read(1)
@@ -564,7 +1131,7 @@ def filename_to_docname(filename):
 def docname_to_filename(name):
     """
     Convert the name of a document to a valid filename. Filenames have the
-    form "cnl-[documentname].save" where [documentname] is the name of the
+    form "cnl-[documentname].cnl" where [documentname] is the name of the
     document with escaped special characters.
 
     Positional arguments:
@@ -580,7 +1147,20 @@ def docname_to_filename(name):
         else:
             result += ":" + hex(ord(char))[2:] + ";"
 
-    return "cnl-" + result + ".json"
+    return "cnl-" + result + DOCUMENT_EXTENSION
+
+
+def docname_to_journal_filename(name):
+    """
+    Convert the name of a document to the filename of its journal. It is the
+    filename of the document with ".journal" instead of ".cnl" as extension.
+
+    Positional arguments:
+    name -- Name of the document without escaped special characters.
+
+    Return value: Name of the journal file with escaped special characters
+    """
+    return os.path.splitext(docname_to_filename(name))[0] + ".journal"
 
 
 def main():
@@ -594,9 +1174,12 @@ def main():
 
     args = CmdlineParser().parse()
     port = args.port
+    if args.workers > 0:
+        return supervisor.run(args)
 
     realm = CournalRealm()
-    realm.server = CournalServer(args.autosave_directory, args.autosave_interval, args.save_hook)
+    realm.server = CournalServer(args.autosave_directory, args.autosave_interval, args.save_hook, args.unload_timeout,
+                                 args.compress)
     atexit.register(realm.server.exit)
     checker = checkers.InMemoryUsernamePasswordDatabaseDontUse()
     checker.addUser(USERNAME.encode(), PASSWORD.encode())
@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of Cournal.
+# Copyright (C) 2012 Fabian Henze
+#
+# Cournal is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cournal is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cournal.  If not, see <http://www.gnu.org/licenses/>.
+
+import atexit
+import os
+import subprocess
+import sys
+import zlib
+from time import time
+
+from zope.interface import implementer
+from twisted.cred import portal, checkers, credentials
+from twisted.spread import pb
+from twisted.internet import reactor, task
+from twisted.internet.defer import DeferredList
+from twisted.internet.error import CannotListenError
+
+import cournal
+import cournal.server as server
+from cournal.encoding import PROTOCOL_VERSION
+
+"""
+Runs a Cournal server as several processes, so that documents are edited on
+more than one processor core.
+
+The supervisor starts a given number of worker processes, e.g. one for every
+core. Workers are normal Cournal servers listening on the ports following the
+port of the supervisor. Every document is owned by one worker, chosen by a
+hash of its name, and saved in the autosave directory of that worker. Clients
+log in at the supervisor, which tells them the port of the worker owning the
+document they want to join. Then they connect to the worker.
+"""
+
+# Workers, which exit within this many seconds after they were started, are
+# not restarted, as they will most likely fail again.
+WORKER_STARTUP_TIME = 10
+# Interval in seconds in which the supervisor checks, whether its workers run
+WORKER_CHECK_INTERVAL = 1
+
+
+def worker_for_document(documentname, workers):
+    """
+    Returns the number of the worker, which owns a document.
+
+    Positional arguments:
+    documentname -- Name of the document
+    workers -- Number of workers
+    """
+    return zlib.crc32(documentname.encode("utf-8")) % workers
+
+
+class Supervisor:
+    """
+    Starts and watches the worker processes and assigns documents to them.
+    """
+    def __init__(self, args):
+        """
+        Constructor
+
+        Positional arguments:
+        args -- A CmdlineParser object of cournal-server
+        """
+        self.args = args
+        self.autosave_directory = os.path.abspath(args.autosave_directory)
+        # The Popen objects of all workers and the time they were started
+        self.workers = [None] * args.workers
+        self.started = [0] * args.workers
+        # Workers, which answered a query at least once. Until all of them did,
+        # the server is still starting up.
+        self.has_answered = [False] * args.workers
+        self.lockfile = None
+
+    def worker_port(self, worker):
+        """Returns the port a worker listens on."""
+        return self.args.port + 1 + worker
+
+    def worker_directory(self, worker):
+        """Returns the autosave directory of a worker."""
+        return os.path.join(self.autosave_directory, "worker-{}".format(worker))
+
+    def prepare_directories(self):
+        """
+        Create the autosave directories of the workers and move saved
+        documents into the directory of the worker owning them. Documents
+        move, when the number of workers changes or when they were saved by a
+        server without workers.
+
+        Return value: True on success
+        """
+        if not os.path.isdir(self.autosave_directory):
+            # Only create the autosave directory, if it wasn't changed by the user
+            if self.autosave_directory != server.server.DEFAULT_AUTOSAVE_DIRECTORY:
+                print(_("Autosave directory '{}' does not exist.").format(self.autosave_directory), file=sys.stderr)
+                return False
+            os.makedirs(self.autosave_directory)
+
+        # Convert saved documents pickled by cournal-server 0.2.1 or earlier
+        if server.server.DEFAULT_AUTOSAVE_DIRECTORY == self.autosave_directory:
+            server.pickle_legacy.run(from_dir=os.path.expanduser("~/.cournal"), to_dir=self.autosave_directory)
+        else:
+            server.pickle_legacy.run(self.autosave_directory)
+
+        directories = [self.autosave_directory]
+        directories += [os.path.join(self.autosave_directory, name) for name in os.listdir(self.autosave_directory)
+                        if name.startswith("worker-")]
+        for directory in directories:
+            lockfile = os.path.join(directory, "lock")
+            if os.path.exists(lockfile):
+                with open(lockfile, "r") as f:
+                    pid = int(f.read())
+                if not server.server.CournalServer.is_pid_dead(pid):
+                    print(_("The autosave directory '{}' is locked by another instance of cournal-server.")
+                          .format(directory), file=sys.stderr)
+                    return False
+
+        # Lock the autosave directory, so that no server without workers uses it
+        self.lockfile = os.path.join(self.autosave_directory, "lock")
+        with open(self.lockfile, "w") as f:
+            f.write(str(os.getpid()))
+
+        for worker in range(len(self.workers)):
+            os.makedirs(self.worker_directory(worker), exist_ok=True)
+
+        for directory in directories:
+            server.pickle_legacy.rename_json(directory)
+            for filename in os.listdir(directory):
+                if filename.startswith("cnl-") and filename.endswith(server.server.DOCUMENT_EXTENSION):
+                    self.move_document(directory, server.server.filename_to_docname(filename))
+        return True
+
+    def move_document(self, directory, documentname):
+        """
+        Move a saved document and its journal into the autosave directory of
+        the worker owning it.
+
+        Positional arguments:
+        directory -- The directory the document is saved in
+        documentname -- Name of the document
+        """
+        target = self.worker_directory(worker_for_document(documentname, len(self.workers)))
+        if target == directory:
+            return
+        filename = server.server.docname_to_filename(documentname)
+        if os.path.exists(os.path.join(target, filename)):
+            print(_("WARNING: Document '{}' is saved in '{}' and '{}'. Ignoring the copy in '{}'.")
+                  .format(documentname, directory, target, directory), file=sys.stderr)
+            return
+        journal = server.server.docname_to_journal_filename(documentname)
+        # The document is moved last, so it is not lost, if we crash meanwhile
+        for name in [journal + ".old", journal, filename]:
+            if os.path.exists(os.path.join(directory, name)):
+                os.rename(os.path.join(directory, name), os.path.join(target, name))
+        debug(2, _("Moved document '{}' to '{}'").format(documentname, target))
+
+    def start_worker(self, worker):
+        """
+        Start a worker process.
+
+        Positional arguments:
+        worker -- Number of the worker
+        """
+        command = [sys.executable, "-m", "cournal.server",
+                   "-p", str(self.worker_port(worker)),
+                   "-s", self.worker_directory(worker),
+                   "-i", str(self.args.autosave_interval),
+                   "-u", str(self.args.unload_timeout)]
+        if self.args.save_hook is not None:
+            command += ["-k", self.args.save_hook]
+        if self.args.compress:
+            command.append("-z")
+        # Make sure, that the worker finds this version of cournal
+        environment = dict(os.environ)
+        package_root = os.path.dirname(os.path.dirname(os.path.abspath(cournal.__file__)))
+        environment["PYTHONPATH"] = os.pathsep.join(filter(None, [package_root, environment.get("PYTHONPATH")]))
+
+        self.workers[worker] = subprocess.Popen(command, env=environment)
+        self.started[worker] = time()
+        debug(2, _("Started worker {} on port {}").format(worker, self.worker_port(worker)))
+
+    def check_workers(self):
+        """Restart workers, which exited."""
+        for worker, process in enumerate(self.workers):
+            if process.poll() is None:
+                continue
+            if time() - self.started[worker] < WORKER_STARTUP_TIME:
+                debug(0, _("ERROR: Worker {} failed to start").format(worker))
+                reactor.stop()
+                return
+            debug(0, _("ERROR: Worker {} exited with status {}, restarting it").format(worker, process.returncode))
+            self.start_worker(worker)
+
+    def exit(self):
+        """Stop all workers. They save their documents before they exit."""
+        for process in self.workers:
+            if process is not None and process.poll() is None:
+                process.terminate()
+        for process in self.workers:
+            if process is not None:
+                process.wait()
+        if self.lockfile is not None:
+            os.remove(self.lockfile)
+
+    def list_documents(self):
+        """
+        Ask all workers for their documents. Workers, which are restarting, are
+        skipped.
+
+        Return value: A deferred, which fires with a list of all document names.
+                      It fails, while a worker did not start for the first time.
+        """
+        def query(worker):
+            factory = pb.PBClientFactory()
+            reactor.connectTCP("localhost", self.worker_port(worker), factory)
+            d = factory.login(credentials.UsernamePassword(server.server.USERNAME.encode(),
+                                                           server.server.PASSWORD.encode()))
+            d.addCallback(lambda perspective: perspective.callRemote("list_documents"))
+            d.addCallback(answered, worker)
+            d.addBoth(lambda result: (factory.disconnect(), result)[1])
+            return d
+
+        def answered(documents, worker):
+            self.has_answered[worker] = True
+            return documents
+
+        def collect(results):
+            documents = []
+            for worker, (success, result) in enumerate(results):
+                if success:
+                    documents.extend(result)
+                elif not self.has_answered[worker]:
+                    raise pb.Error(_("The server is starting up, worker {} is not running yet").format(worker))
+                else:
+                    debug(1, _("Could not list the documents of worker {}: {}").format(worker, result.getErrorMessage()))
+            return sorted(documents)
+
+        d = DeferredList([query(worker) for worker in range(len(self.workers))], consumeErrors=True)
+        d.addCallback(collect)
+        return d
+
+    def locate_document(self, documentname):
+        """Returns the port of the worker, which owns a document."""
+        return self.worker_port(worker_for_document(documentname, len(self.workers)))
+
+
+@implementer(portal.IRealm)
+class SupervisorRealm:
+    """
+    The realm of the supervisor, which creates a Client object for every user.
+
+    see: http://twistedmatrix.com/documents/current/api/twisted.cred.portal.IRealm.html
+    """
+    def requestAvatar(self, avatarID, mind, *interfaces):
+        """
+        Return a Client object for a user, who just logged in.
+
+        Positional arguments: see CournalRealm.requestAvatar()
+        """
+        assert pb.IPerspective in interfaces
+        return pb.IPerspective, Client(avatarID, self.supervisor), lambda: None
+
+
+class Client(pb.Avatar):
+    """
+    A user logged in at the supervisor to find the worker owning a document.
+    """
+    def __init__(self, name, supervisor):
+        """
+        Constructor
+
+        Positional arguments:
+        name -- Name of the user
+        supervisor -- The Supervisor object
+        """
+        self.name = name
+        self.supervisor = supervisor
+        self.protocol_version = 1
+
+    def perspective_negotiate_protocol(self, version):
+        """
+        Called by the user after logging in. See User.perspective_negotiate_protocol()
+
+        Positional arguments:
+        version -- The protocol version of the client
+
+        Return value: Our protocol version
+        """
+        self.protocol_version = min(version, PROTOCOL_VERSION)
+        return PROTOCOL_VERSION
+
+    def perspective_list_documents(self):
+        """Returns a deferred, which fires with a list of all documents."""
+        return self.supervisor.list_documents()
+
+    def perspective_locate_document(self, documentname):
+        """
+        Returns the port of the worker process, which owns a document.
+
+        Positional arguments:
+        documentname -- Name of the document
+        """
+        return self.supervisor.locate_document(documentname)
+
+    def perspective_join_document(self, documentname):
+        """
+        Called by clients, which do not know about workers.
+
+        Positional arguments:
+        documentname -- Name of the requested document session
+        """
+        raise pb.Error(_("Your version of Cournal is too old for this server. Please update it."))
+
+    def perspective_ping(self):
+        """Called by clients to verify, that the connection is still up."""
+        return True
+
+
+def run(args):
+    """
+    Start the workers and accept logins.
+
+    Positional arguments:
+    args -- A CmdlineParser object of cournal-server
+
+    Return value: Exit status
+    """
+    supervisor = Supervisor(args)
+    if args.autosave_interval > 0 and not supervisor.prepare_directories():
+        return 1
+
+    realm = SupervisorRealm()
+    realm.supervisor = supervisor
+    checker = checkers.InMemoryUsernamePasswordDatabaseDontUse()
+    checker.addUser(server.server.USERNAME.encode(), server.server.PASSWORD.encode())
+    p = portal.Portal(realm, [checker])
+
+    try:
+        reactor.listenTCP(args.port, pb.PBServerFactory(p))
+    except CannotListenError as err:
+        debug(0, _("ERROR: Failed to listen on port {}").format(err.port))
+        return 1
+    debug(2, _("Listening on port {}").format(args.port))
+
+    for worker in range(args.workers):
+        supervisor.start_worker(worker)
+    atexit.register(supervisor.exit)
+    task.LoopingCall(supervisor.check_workers).start(WORKER_CHECK_INTERVAL, now=False)
+
+    reactor.run()
+
+
+def debug(level, *args):
+    """Helper function for debug output"""
+    server.server.debug(level, *args)
@@ -21,6 +21,8 @@
 from gi.repository import Gtk, Gdk
 
 from cournal.viewer.pagewidget import PageWidget
+from cournal.viewer.tilecache import cache
+from cournal.viewer.pdfrenderer import renderer
 
 PAGE_SEPARATOR = 10  # px
 
@@ -44,11 +46,16 @@ def __init__(self, document, **args):
         self.document = document
         self.children = []
         self.zoomlevel = 1
+        self.last_scroll_position = 0
 
         # The background color is visible between the PageWidgets
         self.override_background_color(Gtk.StateFlags.NORMAL, Gdk.RGBA(79 / 255, 78 / 255, 77 / 255, 1))
         self.connect("realize", self.set_cursor)
 
+        # Tiles of the previous document are of no use anymore
+        cache.clear()
+        renderer.clear()
+
         for page in self.document.pages:
             self.children.append(PageWidget(page, self))
             self.put(self.children[-1], 0, 0)
@@ -86,6 +93,8 @@ def do_size_allocate(self, allocation):
         adjustment = self.get_vadjustment()
 
         if old_width != new_width:
+            # Don't render tiles in the old size anymore
+            renderer.clear()
             new_height = 0
             for child in self.children:
                 new_height += self.allocate_child(child, 0, new_height, new_width)
@@ -124,6 +133,35 @@ def allocate_child(self, child, x, y, width):
         child.size_allocate(r)
         return r.height
 
+    def prefetch(self, vadjustment, hadjustment):
+        """
+        Render the part of the document, which the user is scrolling towards,
+        before it becomes visible.
+
+        Positional arguments:
+        vadjustment -- The vertical Gtk.Adjustment of the scrolled window
+        hadjustment -- The horizontal Gtk.Adjustment of the scrolled window
+        """
+        position = vadjustment.get_value()
+        direction = position - self.last_scroll_position
+        self.last_scroll_position = position
+        if direction == 0:
+            return
+
+        # Prefetch one screen height ahead
+        height = vadjustment.get_page_size()
+        x = hadjustment.get_value()
+        x2 = x + hadjustment.get_page_size()
+        if direction > 0:
+            y, y2 = position + height, position + 2 * height
+        else:
+            y, y2 = position - height, position
+
+        for child in self.children:
+            alloc = child.get_allocation()
+            if alloc.y < y2 and alloc.y + alloc.height > y:
+                child.prefetch_pdf_tiles(x - alloc.x, y - alloc.y, x2 - alloc.x, y2 - alloc.y)
+
     def set_zoomlevel(self, absolute=None, change=None):
         """
         Set zoomlevel of all child widgets.
@@ -17,16 +17,31 @@
 # You should have received a copy of the GNU General Public License
 # along with Cournal.  If not, see <http://www.gnu.org/licenses/>.
 
-from gi.repository import Gtk, Gdk
+from math import ceil, floor
+
+from gi.repository import Gtk, Gdk, GLib
 import cairo
 
 from cournal.viewer.tools import pen, eraser, navigation
+from cournal.viewer.tilecache import cache, TILE_SIZE
+from cournal.viewer import pdfrenderer
 from cournal.document import search
 
+# The layers of a page, which are cached in separate tiles
+PDF_LAYER = "pdf"
+STROKE_LAYER = "strokes"
+
 
 class PageWidget(Gtk.DrawingArea):
     """
     A widget displaying a PDF page and its annotations
+
+    The page is rendered in tiles of TILE_SIZE x TILE_SIZE pixels, which are
+    kept in the shared tile cache. Only tiles, that are (nearly) visible, are
+    rendered. The PDF and the strokes are cached in separate tiles, so that the
+    PDF does not need to be rendered again, if strokes change. PDF tiles are
+    rendered in a background thread, meanwhile the page is shown in the
+    previous zoom level (if available).
     """
 
     def __init__(self, page, parent, **args):
@@ -46,10 +61,16 @@ def __init__(self, page, parent, **args):
         page.widget = self
         self.widget_width = 1
         self.widget_height = 1
-        self.backbuffer = None
-        self.backbuffer_valid = True
+        # Width before the last resize. Its tiles are shown, till the PDF is
+        # rendered in the new size.
+        self.previous_width = None
         self.active_tool = None
         self.preview_item = None
+        # Unfinished strokes of remote users. Maps user id to Stroke object
+        self.stroke_previews = dict()
+        # Stroke tiles next to the visible ones, which will be rendered when idle
+        self.prefetch_queue = []
+        self.prefetch_source = None
 
         self.set_events(Gdk.EventMask.BUTTON_PRESS_MASK |
                         Gdk.EventMask.BUTTON_RELEASE_MASK |
@@ -85,6 +106,13 @@ def on_size_allocate(self, widget, alloc):
         alloc -- A Gtk.Allocation object
         """
         self.set_allocation(alloc)
+        if alloc.width != self.widget_width:
+            self.previous_width = self.widget_width
+            # Changes of the strokes only update the tiles of the current
+            # width, so stroke tiles of other widths would show old strokes.
+            # PDF tiles never change and are kept as placeholders.
+            cache.remove_matching(lambda key: key[0] is self.page and key[2] == STROKE_LAYER
+                                  and key[1] != alloc.width)
         self.widget_width = alloc.width
         self.widget_height = alloc.height
 
@@ -92,48 +120,358 @@ def draw(self, widget, context):
         """
         Draw the widget (the PDF, all strokes and the background). Called by Gtk.
 
+        Only the tiles within the area Gtk asks us to redraw are painted.
+        Stroke tiles, that are not in the cache, are rendered first. PDF tiles,
+        that are not in the cache, are requested from the PDF renderer and a
+        placeholder is painted instead.
+
         Positional arguments:
         widget -- The widget to redraw
         context -- A Cairo context to draw on
         """
         scaling = self.widget_width / self.page.width
-
-        # Check if the page has already been rendered in the correct size
-        if not self.backbuffer or self.backbuffer.get_width() != self.widget_width or self.backbuffer_valid is False:
-            self.backbuffer = cairo.ImageSurface(
-                cairo.FORMAT_ARGB32, self.widget_width, self.widget_height)
-            self.backbuffer_valid = True
-            bb_ctx = cairo.Context(self.backbuffer)
-
-            # For correct rendering of PDF, the PDF is first rendered to a
-            # transparent image (all alpha = 0).
-            bb_ctx.scale(scaling, scaling)
-            bb_ctx.save()
-            self.page.pdf.render(bb_ctx)
-            bb_ctx.restore()
-
-            for stroke in self.page.layers[0].strokes:
-                stroke.draw(bb_ctx, scaling)
-
-            # Highlight search result
-            if self.page.search_marker:
-                search.draw(bb_ctx, self.page)
-
-            # Then the image is painted on top of a white "page". Instead of
-            # creating a second image, painting it white, then painting the
-            # PDF image over it we can use the cairo.OPERATOR_DEST_OVER
-            # operator to achieve the same effect with the one image.
-            bb_ctx.set_operator(cairo.OPERATOR_DEST_OVER)
-            bb_ctx.set_source_rgb(1, 1, 1)
-            bb_ctx.paint()
-
-        context.set_source_surface(self.backbuffer, 0, 0)
-        context.paint()
+        x, y, x2, y2 = context.clip_extents()
+
+        for tile_x, tile_y in self.get_tiles_in_rect(x, y, x2, y2):
+            pdf_tile = cache.get(self.get_tile_key(PDF_LAYER, tile_x, tile_y))
+            if pdf_tile is None:
+                self.request_pdf_tile(tile_x, tile_y)
+                self.draw_pdf_placeholder(context, tile_x, tile_y)
+            else:
+                self.paint_tile(context, pdf_tile, tile_x, tile_y)
+            # The stroke tile is transparent and painted over the PDF tile
+            self.paint_tile(context, self.get_tile(STROKE_LAYER, tile_x, tile_y), tile_x, tile_y)
+
+        self.prefetch_tiles(x - TILE_SIZE, y - TILE_SIZE, x2 + TILE_SIZE, y2 + TILE_SIZE)
+
+        if self.stroke_previews:
+            context.save()
+            context.scale(scaling, scaling)
+            for stroke in self.stroke_previews.values():
+                stroke.draw(context, scaling)
+            context.restore()
 
         if self.preview_item:
             context.scale(scaling, scaling)
             self.preview_item.draw(context, scaling)
 
+    def paint_tile(self, context, tile, tile_x, tile_y):
+        """
+        Paint a tile on the widget.
+
+        Positional arguments:
+        context -- The cairo context of the widget
+        tile -- The cairo.ImageSurface of the tile
+        tile_x, tile_y -- Column and row of the tile
+        """
+        context.set_source_surface(tile, tile_x * TILE_SIZE, tile_y * TILE_SIZE)
+        context.rectangle(tile_x * TILE_SIZE, tile_y * TILE_SIZE, tile.get_width(), tile.get_height())
+        context.fill()
+
+    def draw_pdf_placeholder(self, context, tile_x, tile_y):
+        """
+        Paint a PDF tile, which is not rendered yet. The cached tiles of the
+        previous zoom level are scaled to fit, the rest of the tile is white.
+
+        Positional arguments:
+        context -- The cairo context of the widget
+        tile_x, tile_y -- Column and row of the tile
+        """
+        x, y, x2, y2 = self.get_tile_rect(tile_x, tile_y)
+        context.save()
+        context.rectangle(x, y, x2 - x, y2 - y)
+        context.clip()
+        context.set_source_rgb(1, 1, 1)
+        context.paint()
+
+        if self.previous_width:
+            factor = self.widget_width / self.previous_width
+            context.scale(factor, factor)
+            for old_y in range(int(y / factor // TILE_SIZE), int(ceil(y2 / factor / TILE_SIZE))):
+                for old_x in range(int(x / factor // TILE_SIZE), int(ceil(x2 / factor / TILE_SIZE))):
+                    tile = cache.get(self.get_tile_key(PDF_LAYER, old_x, old_y, self.previous_width))
+                    if tile is not None:
+                        self.paint_tile(context, tile, old_x, old_y)
+        context.restore()
+
+    def get_tile_key(self, layer, tile_x, tile_y, widget_width=None):
+        """
+        Returns the key of a tile of this page in the tile cache.
+
+        Positional arguments:
+        layer -- PDF_LAYER or STROKE_LAYER
+        tile_x, tile_y -- Column and row of the tile
+
+        Keyword arguments:
+        widget_width -- The width of the page, the tile belongs to
+                        (defaults to the current width)
+        """
+        return (self.page, widget_width or self.widget_width, layer, tile_x, tile_y)
+
+    def get_tile(self, layer, tile_x, tile_y):
+        """
+        Returns a tile from the cache. If it is not cached, it is rendered.
+
+        Positional arguments:
+        layer -- PDF_LAYER or STROKE_LAYER
+        tile_x, tile_y -- Column and row of the tile
+
+        Return value: A cairo.ImageSurface
+        """
+        key = self.get_tile_key(layer, tile_x, tile_y)
+        tile = cache.get(key)
+        if tile is None:
+            if layer == PDF_LAYER:
+                tile = self.render_pdf_tile(tile_x, tile_y)
+            else:
+                tile = self.render_stroke_tile(tile_x, tile_y)
+            cache.put(key, tile)
+        return tile
+
+    def get_tiles_in_rect(self, x, y, x2, y2):
+        """
+        Returns a list of (column, row) tuples of all tiles, which intersect
+        with a rectangle.
+
+        Positional arguments:
+        x, y, x2, y2 -- Corners of the rectangle in widget coordinates
+        """
+        x, y = max(x, 0), max(y, 0)
+        x2, y2 = min(x2, self.widget_width), min(y2, self.widget_height)
+        return [(tile_x, tile_y)
+                for tile_y in range(int(y // TILE_SIZE), int(ceil(y2 / TILE_SIZE)))
+                for tile_x in range(int(x // TILE_SIZE), int(ceil(x2 / TILE_SIZE)))]
+
+    def get_tile_context(self, tile, tile_x, tile_y):
+        """
+        Returns a cairo context to draw on a tile using page coordinates.
+
+        Positional arguments:
+        tile -- The cairo.ImageSurface of the tile
+        tile_x, tile_y -- Column and row of the tile
+        """
+        scaling = self.widget_width / self.page.width
+        context = cairo.Context(tile)
+        context.translate(-tile_x * TILE_SIZE, -tile_y * TILE_SIZE)
+        context.scale(scaling, scaling)
+        return context
+
+    def get_stroke_rect(self, stroke):
+        """
+        Returns the bounding box of a stroke in widget coordinates as a tuple
+        (x, y, x2, y2).
+
+        Positional arguments:
+        stroke -- The Stroke object
+        """
+        scaling = self.widget_width / self.page.width
+        if not hasattr(stroke, "bound_min"):
+            stroke.calculate_bounding_box()
+        # Wide strokes reach beyond the bounding box used for hit testing and
+        # antialiasing touches one more pixel
+        padding = stroke.get_max_width() / 2 * scaling + 1
+        return (stroke.bound_min[0] * scaling - padding, stroke.bound_min[1] * scaling - padding,
+                stroke.bound_max[0] * scaling + padding, stroke.bound_max[1] * scaling + padding)
+
+    def get_tile_area(self, tile_x, tile_y):
+        """
+        Returns the area of a tile as a tuple (x, y, width, height). Tiles at
+        the right and bottom edge of the page are smaller than TILE_SIZE.
+
+        Positional arguments:
+        tile_x, tile_y -- Column and row of the tile
+        """
+        x, y = tile_x * TILE_SIZE, tile_y * TILE_SIZE
+        return (x, y, min(TILE_SIZE, self.widget_width - x), min(TILE_SIZE, self.widget_height - y))
+
+    def create_tile(self, tile_x, tile_y):
+        """
+        Returns a new, transparent tile.
+
+        Positional arguments:
+        tile_x, tile_y -- Column and row of the tile
+        """
+        x, y, width, height = self.get_tile_area(tile_x, tile_y)
+        return cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+
+    def render_pdf_tile(self, tile_x, tile_y):
+        """
+        Render the PDF within a tile in the main thread.
+
+        Positional arguments:
+        tile_x, tile_y -- Column and row of the tile
+
+        Return value: A new cairo.ImageSurface
+        """
+        scaling = self.widget_width / self.page.width
+        return pdfrenderer.render_pdf_tile(self.page.pdf, scaling, *self.get_tile_area(tile_x, tile_y))
+
+    def request_pdf_tile(self, tile_x, tile_y, prefetch=False):
+        """
+        Let the PDF renderer render a tile in the background.
+
+        Positional arguments:
+        tile_x, tile_y -- Column and row of the tile
+
+        Keyword arguments:
+        prefetch -- Set to True, if the tile is not visible yet
+        """
+        scaling = self.widget_width / self.page.width
+        pdfrenderer.renderer.render(self.get_tile_key(PDF_LAYER, tile_x, tile_y),
+                                    self.page.document.pdfname, self.page.number, scaling,
+                                    self.get_tile_area(tile_x, tile_y), self.pdf_tile_rendered,
+                                    prefetch=prefetch)
+
+    def pdf_tile_rendered(self, key, tile):
+        """
+        Cache a tile rendered by the PDF renderer and show it.
+
+        Positional arguments:
+        key -- The key of the tile
+        tile -- The rendered cairo.ImageSurface or None, if rendering failed
+        """
+        page, widget_width, layer, tile_x, tile_y = key
+        if widget_width != self.widget_width:
+            if tile is not None:
+                cache.put(key, tile)
+            return
+        if tile is None:
+            tile = self.render_pdf_tile(tile_x, tile_y)
+        cache.put(key, tile)
+        self.invalidate_widget_rect(*self.get_tile_rect(tile_x, tile_y))
+
+    def render_stroke_tile(self, tile_x, tile_y):
+        """
+        Render the strokes and the search marker within a transparent tile.
+
+        Positional arguments:
+        tile_x, tile_y -- Column and row of the tile
+
+        Return value: A new cairo.ImageSurface
+        """
+        tile = self.create_tile(tile_x, tile_y)
+        context = self.get_tile_context(tile, tile_x, tile_y)
+        self.draw_strokes_in_rect(context, *self.get_tile_rect(tile_x, tile_y))
+        return tile
+
+    def draw_strokes_in_rect(self, context, x, y, x2, y2):
+        """
+        Draw all strokes, whose bounding box intersects with a rectangle, and
+        the search marker.
+
+        Positional arguments:
+        context -- The cairo context of a tile, as returned by get_tile_context()
+        x, y, x2, y2 -- Corners of the rectangle in widget coordinates
+        """
+        scaling = self.widget_width / self.page.width
+        # Antialiasing touches one more pixel around the rectangle
+        margin = 1 / scaling
+        candidates = self.page.spatial_index.find_in_rect(x / scaling - margin, y / scaling - margin,
+                                                         x2 / scaling + margin, y2 / scaling + margin)
+        for stroke in candidates:
+            # The stroke, that is currently drawn, is painted as preview
+            if stroke is self.preview_item:
+                continue
+            s_x, s_y, s_x2, s_y2 = self.get_stroke_rect(stroke)
+            if s_x < x2 and s_x2 > x and s_y < y2 and s_y2 > y:
+                stroke.draw(context, scaling)
+
+        # Highlight search result
+        if self.page.search_marker:
+            search.draw(context, self.page)
+
+    def redraw_stroke_rect(self, x, y, x2, y2):
+        """
+        Clear a rectangle on all cached stroke tiles and draw the strokes within
+        it again. Used to remove something from the tiles without rendering
+        them completely.
+
+        Positional arguments:
+        x, y, x2, y2 -- Corners of the rectangle in widget coordinates
+        """
+        scaling = self.widget_width / self.page.width
+        # Clip at pixel borders, else antialiasing leaves traces at the edges
+        x, y, x2, y2 = floor(x), floor(y), ceil(x2), ceil(y2)
+        for tile_x, tile_y in self.get_tiles_in_rect(x, y, x2, y2):
+            tile = cache.get(self.get_tile_key(STROKE_LAYER, tile_x, tile_y))
+            if tile is None:
+                continue
+            context = self.get_tile_context(tile, tile_x, tile_y)
+            context.rectangle(x / scaling, y / scaling, (x2 - x) / scaling, (y2 - y) / scaling)
+            context.clip()
+            context.set_operator(cairo.OPERATOR_CLEAR)
+            context.paint()
+            context.set_operator(cairo.OPERATOR_OVER)
+            self.draw_strokes_in_rect(context, x, y, x2, y2)
+
+        self.invalidate_widget_rect(x, y, x2, y2)
+
+    def prefetch_tiles(self, x, y, x2, y2):
+        """
+        Render all stroke tiles within a rectangle, that are not cached, when
+        Gtk is idle and let the PDF renderer render the PDF tiles.
+
+        Positional arguments:
+        x, y, x2, y2 -- Corners of the rectangle in widget coordinates
+        """
+        self.prefetch_pdf_tiles(x, y, x2, y2)
+        self.prefetch_queue = [(tile_x, tile_y) for tile_x, tile_y in self.get_tiles_in_rect(x, y, x2, y2)
+                               if self.get_tile_key(STROKE_LAYER, tile_x, tile_y) not in cache]
+        if self.prefetch_queue and self.prefetch_source is None:
+            self.prefetch_source = GLib.idle_add(self.render_prefetched_tile, priority=GLib.PRIORITY_LOW)
+
+    def render_prefetched_tile(self):
+        """
+        Render one tile from the prefetch queue. Called by Gtk, when it is idle.
+
+        Return value: True, if there are more tiles to render
+        """
+        while self.prefetch_queue:
+            tile_x, tile_y = self.prefetch_queue.pop()
+            key = self.get_tile_key(STROKE_LAYER, tile_x, tile_y)
+            # The widget might have been resized since the tile was queued
+            if key not in cache and (tile_x, tile_y) in self.get_tiles_in_rect(*self.get_tile_rect(tile_x, tile_y)):
+                self.get_tile(STROKE_LAYER, tile_x, tile_y)
+                return True
+        self.prefetch_source = None
+        return False
+
+    def prefetch_pdf_tiles(self, x, y, x2, y2):
+        """
+        Let the PDF renderer render all tiles within a rectangle, that are not
+        cached, after the visible tiles.
+
+        Positional arguments:
+        x, y, x2, y2 -- Corners of the rectangle in widget coordinates
+        """
+        for tile_x, tile_y in self.get_tiles_in_rect(x, y, x2, y2):
+            if self.get_tile_key(PDF_LAYER, tile_x, tile_y) not in cache:
+                self.request_pdf_tile(tile_x, tile_y, prefetch=True)
+
+    def get_tile_rect(self, tile_x, tile_y):
+        """
+        Returns the area of a tile in widget coordinates as a tuple (x, y, x2, y2).
+
+        Positional arguments:
+        tile_x, tile_y -- Column and row of the tile
+        """
+        return (tile_x * TILE_SIZE, tile_y * TILE_SIZE, (tile_x + 1) * TILE_SIZE, (tile_y + 1) * TILE_SIZE)
+
+    def invalidate_widget_rect(self, x, y, x2, y2):
+        """
+        Make Gtk redraw a part of the widget.
+
+        Positional arguments:
+        x, y, x2, y2 -- Corners of the rectangle in widget coordinates
+        """
+        update_rect = Gdk.Rectangle()
+        update_rect.x = x - 2
+        update_rect.y = y - 2
+        update_rect.width = x2 - x + 4
+        update_rect.height = y2 - y + 4
+        if self.get_window():
+            self.get_window().invalidate_rect(update_rect, False)
+
     def press(self, widget, event):
         """
         Mouse down event. Select a tool depending on the mouse button and call it.
@@ -173,26 +511,44 @@ def release(self, widget, event):
 
     def draw_remote_stroke(self, stroke):
         """
-        Draw a single stroke on the widget.
-        Meant to be called by networking code, when a remote user drew a stroke.
+        Draw a single stroke on the cached tiles of the widget.
+        Meant to be called by networking code, when a remote user drew a stroke,
+        and by the pen tool, when the user finished a stroke.
 
         Positional arguments:
         stroke -- The Stroke object, which is to be drawn.
         """
-        if self.backbuffer:
-            scaling = self.widget_width / self.page.width
-            context = cairo.Context(self.backbuffer)
+        self.draw_remote_strokes([stroke])
 
-            context.scale(scaling, scaling)
-            x, y, x2, y2 = stroke.draw(context, scaling)
+    def draw_remote_strokes(self, strokes):
+        """
+        Draw several strokes on the cached tiles of the widget. Every tile
+        gets a single cairo context and the widget is invalidated only once.
+        Meant to be called, when many strokes are added at once.
 
-            update_rect = Gdk.Rectangle()
-            update_rect.x = x - 2
-            update_rect.y = y - 2
-            update_rect.width = x2 - x + 4
-            update_rect.height = y2 - y + 4
-            if self.get_window():
-                self.get_window().invalidate_rect(update_rect, False)
+        Positional arguments:
+        strokes -- List of Stroke objects, which are to be drawn.
+        """
+        if len(strokes) == 0:
+            return
+        scaling = self.widget_width / self.page.width
+        # Maps (tile_x, tile_y) to a cairo context or None, if the tile is not cached
+        contexts = dict()
+        rects = [self.get_stroke_rect(stroke) for stroke in strokes]
+
+        for stroke, (x, y, x2, y2) in zip(strokes, rects):
+            for tile_x, tile_y in self.get_tiles_in_rect(x, y, x2, y2):
+                if (tile_x, tile_y) not in contexts:
+                    tile = cache.get(self.get_tile_key(STROKE_LAYER, tile_x, tile_y))
+                    if tile is not None:
+                        contexts[tile_x, tile_y] = self.get_tile_context(tile, tile_x, tile_y)
+                    else:
+                        contexts[tile_x, tile_y] = None
+                if contexts[tile_x, tile_y] is not None:
+                    stroke.draw(contexts[tile_x, tile_y], scaling)
+
+        self.invalidate_widget_rect(min(rect[0] for rect in rects), min(rect[1] for rect in rects),
+                                    max(rect[2] for rect in rects), max(rect[3] for rect in rects))
 
     def delete_remote_stroke(self, stroke):
         """
@@ -202,10 +558,43 @@ def delete_remote_stroke(self, stroke):
         Positional arguments:
         stroke -- The Stroke object, which was deleted.
         """
-        if self.backbuffer:
-            self.backbuffer_valid = False
-            if self.get_window():
-                self.get_window().invalidate_rect(None, False)
+        self.redraw_stroke_rect(*self.get_stroke_rect(stroke))
+
+    def draw_stroke_preview(self, user_id, stroke, start):
+        """
+        Show new points of an unfinished stroke of a remote user.
+        Meant to be called by networking code.
+
+        Positional arguments:
+        user_id -- Id of the user, who draws the stroke
+        stroke -- The unfinished Stroke object
+        start -- Index of the first new point
+        """
+        self.stroke_previews[user_id] = stroke
+        scaling = self.widget_width / self.page.width
+        # Include the last old point, as it is connected to the new points
+        coords = stroke.coords[max(start - 1, 0) * 2:]
+        if len(coords) == 0:
+            return
+        x_coords, y_coords = coords[0::2], coords[1::2]
+        # Same padding as in get_stroke_rect()
+        padding = stroke.get_max_width() / 2 * scaling + 1
+        self.invalidate_widget_rect(min(x_coords) * scaling - padding, min(y_coords) * scaling - padding,
+                                    max(x_coords) * scaling + padding, max(y_coords) * scaling + padding)
+
+    def delete_stroke_preview(self, user_id):
+        """
+        Stop showing an unfinished stroke of a remote user.
+        Meant to be called by networking code.
+
+        Positional arguments:
+        user_id -- Id of the user, who drew the stroke
+        """
+        stroke = self.stroke_previews.pop(user_id, None)
+        if stroke is not None and len(stroke.coords) > 0:
+            # The stroke got longer since its bounding box was calculated
+            stroke.calculate_bounding_box()
+            self.invalidate_widget_rect(*self.get_stroke_rect(stroke))
 
     def draw_search_marker(self, rect):
         """
@@ -215,27 +604,24 @@ def draw_search_marker(self, rect):
         rect -- The rect marking the found search text
         """
         self.page.search_marker = rect.x1, self.page.height - rect.y1, rect.x2, self.page.height - rect.y2
-        if self.backbuffer:
-            scaling = self.widget_width / self.page.width
-            context = cairo.Context(self.backbuffer)
+        scaling = self.widget_width / self.page.width
+        x, y = rect.x1 * scaling, (self.page.height - rect.y2) * scaling
+        x2, y2 = rect.x2 * scaling, (self.page.height - rect.y1) * scaling
 
-            context.scale(scaling, scaling)
-            search.draw(context, self.page)
-            update_rect = Gdk.Rectangle()
-            update_rect.x = rect.x1 * scaling
-            update_rect.y = (self.page.height - rect.y2) * scaling
-            update_rect.width = (rect.x2 - rect.x1) * scaling
-            update_rect.height = (rect.y2 - rect.y1) * scaling
+        for tile_x, tile_y in self.get_tiles_in_rect(x, y, x2, y2):
+            tile = cache.get(self.get_tile_key(STROKE_LAYER, tile_x, tile_y))
+            if tile is not None:
+                search.draw(self.get_tile_context(tile, tile_x, tile_y), self.page)
 
-            if self.get_window():
-                self.get_window().invalidate_rect(update_rect, False)
+        self.invalidate_widget_rect(x, y, x2, y2)
 
     def delete_search_marker(self):
         """
         Rerender the part of the widget, where the marker was deleted
         """
+        if self.page.search_marker is None:
+            return
+        scaling = self.widget_width / self.page.width
+        x, y2, x2, y = (a * scaling for a in self.page.search_marker)
         self.page.search_marker = None
-        if self.backbuffer:
-            self.backbuffer_valid = False
-            if self.get_window():
-                self.get_window().invalidate_rect(None, False)
+        self.redraw_stroke_rect(x, y, x2, y2)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of Cournal.
+# Copyright (C) 2012 Fabian Henze
+#
+# Cournal is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cournal is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cournal.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+from collections import deque
+from threading import Thread, Condition
+
+from gi.repository import Poppler, GLib
+import cairo
+
+"""
+Renders tiles of PDF pages in a background thread, so that complex pages do
+not block the user interface (and the network connection, which is handled
+in the same main loop).
+"""
+
+# Tiles, which are waiting to be rendered. If there are more, the least
+# important ones are dropped.
+MAX_QUEUED_TILES = 64
+
+
+class PDFRenderer:
+    """
+    A worker thread, which renders tiles of PDF pages.
+
+    Poppler documents must not be used by more than one thread, so the worker
+    opens its own copy of the PDF file. Tiles, which are requested for drawing,
+    are rendered before tiles, which are requested for prefetching.
+    """
+    def __init__(self):
+        """Constructor"""
+        self.jobs = deque()
+        self.pending = set()
+        self.condition = Condition()
+        self.thread = None
+
+    def render(self, key, pdfname, pagenum, scaling, rect, callback, prefetch=False):
+        """
+        Request a tile to be rendered. When it is done, callback(key, tile) is
+        called in the main thread. tile is None, if rendering failed.
+
+        Positional arguments:
+        key -- Key of the tile in the tile cache. Requests with the same key
+               are only rendered once.
+        pdfname -- Filename of the PDF document
+        pagenum -- Number of the page in the PDF document
+        scaling -- Zoom factor of the page
+        rect -- The area of the tile on the scaled page as a tuple
+                (x, y, width, height)
+        callback -- Function to call with the rendered tile
+
+        Keyword arguments:
+        prefetch -- Set to True, if the tile is not visible yet
+        """
+        job = (key, pdfname, pagenum, scaling, rect, callback)
+        with self.condition:
+            if key in self.pending:
+                if prefetch:
+                    return
+                # The tile became visible, so move it to the front of the queue
+                for queued in self.jobs:
+                    if queued[0] == key:
+                        self.jobs.remove(queued)
+                        break
+                else:
+                    # It is being rendered right now
+                    return
+            if prefetch:
+                self.jobs.append(job)
+            else:
+                self.jobs.appendleft(job)
+            self.pending.add(key)
+            while len(self.jobs) > MAX_QUEUED_TILES:
+                self.pending.discard(self.jobs.pop()[0])
+            self.condition.notify()
+
+        if self.thread is None:
+            self.thread = Thread(target=self.run, name="PDFRenderer")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def clear(self):
+        """
+        Forget all requests, which are not being rendered yet. Call this, when
+        the requested tiles are of no use anymore (e.g. after zooming).
+        """
+        with self.condition:
+            for job in self.jobs:
+                self.pending.discard(job[0])
+            self.jobs.clear()
+
+    def run(self):
+        """The main loop of the worker thread."""
+        pdfname = None
+        pdf = None
+        while True:
+            with self.condition:
+                while not self.jobs:
+                    self.condition.wait()
+                key, jobpdfname, pagenum, scaling, rect, callback = self.jobs.popleft()
+
+            tile = None
+            try:
+                if jobpdfname != pdfname:
+                    pdf = Poppler.Document.new_from_file(GLib.filename_to_uri(jobpdfname, None), None)
+                    pdfname = jobpdfname
+                tile = render_pdf_tile(pdf.get_page(pagenum), scaling, *rect)
+            except Exception as ex:
+                # Keep the worker alive, the tile is rendered in the main thread instead
+                pdfname = None
+                print(_("Error rendering PDF page {}: {}").format(pagenum + 1, ex), file=sys.stderr)
+            GLib.idle_add(self.finish, key, tile, callback)
+
+    def finish(self, key, tile, callback):
+        """
+        Deliver a rendered tile. Called in the main thread.
+
+        Positional arguments: see render()
+        tile -- The rendered cairo.ImageSurface or None
+        """
+        with self.condition:
+            self.pending.discard(key)
+        callback(key, tile)
+        return False
+
+
+def render_pdf_tile(pdf, scaling, x, y, width, height):
+    """
+    Render a part of a PDF page on a white background.
+
+    Positional arguments:
+    pdf -- The PopplerPage object
+    scaling -- Zoom factor of the page
+    x, y, width, height -- The area of the tile on the scaled page
+
+    Return value: A new cairo.ImageSurface
+    """
+    tile = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+    context = cairo.Context(tile)
+    context.translate(-x, -y)
+    context.scale(scaling, scaling)
+
+    # For correct rendering of PDF, the PDF is first rendered to a
+    # transparent image (all alpha = 0).
+    context.save()
+    pdf.render(context)
+    context.restore()
+
+    # Then the image is painted on top of a white "page". Instead of
+    # creating a second image, painting it white, then painting the
+    # PDF image over it we can use the cairo.OPERATOR_DEST_OVER
+    # operator to achieve the same effect with the one image.
+    context.set_operator(cairo.OPERATOR_DEST_OVER)
+    context.set_source_rgb(1, 1, 1)
+    context.paint()
+
+    return tile
+
+
+# This is, what will be exported and included by other modules:
+renderer = PDFRenderer()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of Cournal.
+# Copyright (C) 2012 Fabian Henze
+#
+# Cournal is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cournal is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cournal.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+
+"""
+A cache for rendered tiles of all pages, which limits the memory used by them.
+"""
+
+TILE_SIZE = 256  # px
+MEMORY_BUDGET = 128 * 1024 * 1024  # bytes
+
+
+class TileCache:
+    """
+    A least recently used cache of cairo.ImageSurfaces. If the tiles in the
+    cache need more memory than the budget allows, the tiles that were not
+    used for the longest time are dropped.
+    """
+    def __init__(self, budget):
+        """
+        Constructor
+
+        Positional arguments:
+        budget -- Memory in bytes, that all tiles together may use
+        """
+        self.budget = budget
+        self.size = 0
+        self._tiles = OrderedDict()
+
+    def __contains__(self, key):
+        """Returns True, if a tile with the given key is cached."""
+        return key in self._tiles
+
+    def get(self, key):
+        """
+        Returns the tile with the given key or None, if it is not cached.
+
+        Positional arguments:
+        key -- A tuple (page, zoom, tile x, tile y)
+        """
+        tile = self._tiles.get(key)
+        if tile is not None:
+            self._tiles.move_to_end(key)
+        return tile
+
+    def put(self, key, tile):
+        """
+        Add a tile to the cache and drop old tiles, if the budget is exceeded.
+
+        Positional arguments:
+        key -- A tuple (page, zoom, tile x, tile y)
+        tile -- The cairo.ImageSurface to cache
+        """
+        self.remove(key)
+        self._tiles[key] = tile
+        self.size += _surface_size(tile)
+        # Never drop the tile, that was just added
+        while self.size > self.budget and len(self._tiles) > 1:
+            _, dropped = self._tiles.popitem(last=False)
+            self.size -= _surface_size(dropped)
+
+    def remove(self, key):
+        """
+        Remove a tile from the cache, if it is cached.
+
+        Positional arguments:
+        key -- A tuple (page, zoom, tile x, tile y)
+        """
+        tile = self._tiles.pop(key, None)
+        if tile is not None:
+            self.size -= _surface_size(tile)
+
+    def remove_matching(self, function):
+        """
+        Remove all tiles, whose key matches a condition.
+
+        Positional arguments:
+        function -- Function, which is called with the key of every tile and
+                    returns True, if the tile is to be removed
+        """
+        for key in [key for key in self._tiles if function(key)]:
+            self.remove(key)
+
+    def clear(self):
+        """Remove all tiles."""
+        self._tiles.clear()
+        self.size = 0
+
+
+def _surface_size(surface):
+    """Returns the memory in bytes used by a cairo.ImageSurface."""
+    return surface.get_stride() * surface.get_height()
+
+
+# This is, what will be exported and included by other modules:
+cache = TileCache(MEMORY_BUDGET)
@@ -17,9 +17,11 @@
 # You should have received a copy of the GNU General Public License
 # along with Cournal.  If not, see <http://www.gnu.org/licenses/>.
 
-import cairo
 from gi.repository import Gdk
 
+from cournal.document.codec import quantize
+from cournal.network import network
+
 """
 A pen tool. Draws a stroke with a certain color and size.
 """
@@ -60,7 +62,7 @@ def motion(widget, event):
     global _last_point, _current_coords
 
     update_rect = Gdk.Rectangle()
-    scaling = widget.backbuffer.get_width() / widget.page.width
+    scaling = widget.widget_width / widget.page.width
 
     x = min(_last_point[0], event.x) - linewidth * scaling / 2
     y = min(_last_point[1], event.y) - linewidth * scaling / 2
@@ -74,7 +76,9 @@ def motion(widget, event):
     widget.get_window().invalidate_rect(update_rect, False)
 
     _last_point = [event.x, event.y]
-    _current_coords.append([event.x / scaling, event.y / scaling])
+    # Quantized coordinates need less space on the wire and on disk
+    _current_coords.extend((quantize(event.x / scaling), quantize(event.y / scaling)))
+    network.stream_stroke(widget.page.number, _current_stroke)
 
 
 def release(widget, event):
@@ -90,11 +94,7 @@ def release(widget, event):
     try:
         widget.page.finish_stroke(_current_stroke)
         widget.preview_item = None
-
-        context = cairo.Context(widget.backbuffer)
-        scaling = widget.backbuffer.get_width() / widget.page.width
-        context.scale(scaling, scaling)
-        _current_stroke.draw(context, scaling)
+        widget.draw_remote_stroke(_current_stroke)
     except Exception as ex:
         import traceback
         traceback.print_tb(ex.__traceback__)